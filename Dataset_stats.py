@@ -10,9 +10,10 @@ if __name__ == "__main__":
     config = Config('conf.json')
     config.remove_singleton = False
     ds = BuddhaDataset(config)
-    ds.load()
-    nb_artifacts = len(ds.artifacts)
-    faces_per_artifacts = np.asarray([len(art.pictures) for art in ds.artifacts])
+    # picture counts come from the manifest, no picture is read
+    manifest = ds.manifest()
+    faces_per_artifacts = np.asarray([art['nb_pictures'] for art in manifest.values() if art['failed'] is None])
+    nb_artifacts = len(faces_per_artifacts)
     fig, ax = plt.subplots()
     ax.boxplot(faces_per_artifacts, vert=False)
     plt.xticks(np.arange(0, faces_per_artifacts.max() + 1, step=5))
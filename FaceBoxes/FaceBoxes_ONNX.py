@@ -12,8 +12,7 @@ from .utils.box_utils import decode
 from .utils.timer import Timer
 from .utils.config import cfg
 from .onnx import convert_to_onnx
-
-import onnxruntime
+from utils.onnx_session import get_session, session_kvs
 
 # some global configs
 confidence_threshold = 0.05
@@ -46,10 +45,13 @@ def viz_bbox(img, dets, wfp='out.jpg'):
 
 
 class FaceBoxes_ONNX(object):
-    def __init__(self, timer_flag=False):
+    def __init__(self, timer_flag=False, **kvs):
+        """
+        :param kvs: options of the onnxruntime session, see utils/onnx_session.py
+        """
         if not osp.exists(onnx_path):
             convert_to_onnx(onnx_path)
-        self.session = onnxruntime.InferenceSession(onnx_path, None)
+        self.session = get_session(onnx_path, **session_kvs(kvs))
 
         self.timer_flag = timer_flag
 
@@ -17,7 +17,7 @@ from utils.functions import (
     crop_img, parse_roi_box_from_bbox, parse_roi_box_from_landmark,
 )
 from utils.tddfa_util import (
-    load_model, _parse_param, similar_transform,
+    load_model, recon_vers_batch,
     ToTensorGjz, NormalizeGjz
 )
 
@@ -36,12 +36,12 @@ class TDDFA(object):
             shape_dim=kvs.get('shape_dim', 40),
             exp_dim=kvs.get('exp_dim', 10)
         )
-        self.tri = self.bfm.tri
 
         # config
         self.gpu_mode = kvs.get('gpu_mode', False)
         self.gpu_id = kvs.get('gpu_id', 0)
         self.size = kvs.get('size', 120)
+        self.max_batch = kvs.get('max_batch', 64)
 
         param_mean_std_fp = kvs.get(
             'param_mean_std_fp', make_abs_path(f'configs/param_mean_std_62d_{self.size}x{self.size}.pkl')
@@ -76,6 +76,11 @@ class TDDFA(object):
 
         # print('param_mean and param_srd', self.param_mean, self.param_std)
 
+    @property
+    def tri(self):
+        # the triangles are only read for rendering
+        return self.bfm.tri
+
     def __call__(self, img_ori, objs, **kvs):
         """The main call of TDDFA, given image and box / landmark, return 3DMM params and roi_box
         :param img_ori: the input image
@@ -83,9 +88,10 @@ class TDDFA(object):
         :param kvs: options
         :return: param list and roi_box list
         """
-        # Crop image, forward to get the param
+        # Crop image, forward all the crops at once to get the params
         param_lst = []
         roi_box_lst = []
+        inp_lst = []
 
         crop_policy = kvs.get('crop_policy', 'box')
         for obj in objs:
@@ -101,7 +107,12 @@ class TDDFA(object):
             roi_box_lst.append(roi_box)
             img = crop_img(img_ori, roi_box)
             img = cv2.resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_LINEAR)
-            inp = self.transform(img).unsqueeze(0)
+            inp_lst.append(self.transform(img))
+
+        # very large requests are split in batches of at most max_batch crops
+        max_batch = kvs.get('max_batch', self.max_batch)
+        for start in range(0, len(inp_lst), max_batch):
+            inp = torch.stack(inp_lst[start:start + max_batch])
 
             if self.gpu_mode:
                 inp = inp.cuda(device=self.gpu_id)
@@ -114,30 +125,23 @@ class TDDFA(object):
             else:
                 param = self.model(inp)
 
-            param = param.squeeze().cpu().numpy().flatten().astype(np.float32)
+            param = param.cpu().numpy().reshape(len(inp), -1).astype(np.float32)
             param = param * self.param_std + self.param_mean  # re-scale
-            # print('output', param)
-            param_lst.append(param)
+            param_lst.extend(param)
 
         return param_lst, roi_box_lst
 
     def recon_vers(self, param_lst, roi_box_lst, **kvs):
-        dense_flag = kvs.get('dense_flag', False)
-        size = self.size
-
-        ver_lst = []
-        for param, roi_box in zip(param_lst, roi_box_lst):
-            if dense_flag:
-                R, offset, alpha_shp, alpha_exp = _parse_param(param)
-                pts3d = R @ (self.bfm.u + self.bfm.w_shp @ alpha_shp + self.bfm.w_exp @ alpha_exp). \
-                    reshape(3, -1, order='F') + offset
-                pts3d = similar_transform(pts3d, roi_box, size)
-            else:
-                R, offset, alpha_shp, alpha_exp = _parse_param(param)
-                pts3d = R @ (self.bfm.u_base + self.bfm.w_shp_base @ alpha_shp + self.bfm.w_exp_base @ alpha_exp). \
-                    reshape(3, -1, order='F') + offset
-                pts3d = similar_transform(pts3d, roi_box, size)
+        return list(self.recon_vers_batch(param_lst, roi_box_lst, **kvs))
 
-            ver_lst.append(pts3d)
-
-        return ver_lst
+    def recon_vers_batch(self, params, roi_boxes, **kvs):
+        """Reconstruct the vertices of all the faces at once
+        :param params: 3DMM params, shape=(N, 62)
+        :param roi_boxes: shape=(N, 4)
+        :return: shape=(N, 3, 68), or (N, 3, V) with dense_flag
+        """
+        if kvs.get('dense_flag', False):
+            u, w_shp, w_exp = self.bfm.u, self.bfm.w_shp, self.bfm.w_exp
+        else:
+            u, w_shp, w_exp = self.bfm.u_base, self.bfm.w_shp_base, self.bfm.w_exp_base
+        return recon_vers_batch(params, roi_boxes, u, w_shp, w_exp, self.size)
@@ -5,16 +5,16 @@ __author__ = 'cleardusk'
 import os.path as osp
 import numpy as np
 import cv2
-import onnxruntime
 
-from utils.onnx import convert_to_onnx
+from utils.onnx import convert_to_onnx, quantized_onnx_fp
+from utils.onnx_session import get_session, session_kvs
 from utils.io import _load
 from utils.functions import (
     crop_img, parse_roi_box_from_bbox, parse_roi_box_from_landmark,
 )
-from utils.tddfa_util import _parse_param, similar_transform
+from utils.tddfa_util import _parse_param, _parse_params, similar_transform_batch, recon_vers_batch
 from bfm.bfm import BFMModel
-from bfm.bfm_onnx import convert_bfm_to_onnx
+from bfm.bfm_onnx import convert_bfm_to_onnx, batch_onnx_fp
 
 make_abs_path = lambda fn: osp.join(osp.dirname(osp.realpath(__file__)), fn)
 
@@ -28,18 +28,24 @@ class TDDFA_ONNX(object):
         # load onnx version of BFM
         bfm_fp = kvs.get('bfm_fp', make_abs_path('configs/bfm_noneck_v3.pkl'))
         bfm_onnx_fp = bfm_fp.replace('.pkl', '.onnx')
+        # the batch decoder reconstructs all the faces of a call in one run, the other one face by face
+        self.bfm_batch = kvs.get('bfm_batch', True)
+        if self.bfm_batch:
+            bfm_onnx_fp = batch_onnx_fp(bfm_onnx_fp)
         if not osp.exists(bfm_onnx_fp):
             convert_bfm_to_onnx(
                 bfm_onnx_fp,
                 shape_dim=kvs.get('shape_dim', 40),
-                exp_dim=kvs.get('exp_dim', 10)
+                exp_dim=kvs.get('exp_dim', 10),
+                batch=self.bfm_batch
             )
-        self.bfm_session = onnxruntime.InferenceSession(bfm_onnx_fp, None)
+        # threads, execution mode and graph optimization of the onnxruntime sessions, see utils/onnx_session.py
+        sess_kvs = session_kvs(kvs)
+        self.bfm_session = get_session(bfm_onnx_fp, **sess_kvs)
 
         # load for optimization
-        bfm = BFMModel(bfm_fp, shape_dim=kvs.get('shape_dim', 40), exp_dim=kvs.get('exp_dim', 10))
-        self.tri = bfm.tri
-        self.u_base, self.w_shp_base, self.w_exp_base = bfm.u_base, bfm.w_shp_base, bfm.w_exp_base
+        self.bfm = BFMModel(bfm_fp, shape_dim=kvs.get('shape_dim', 40), exp_dim=kvs.get('exp_dim', 10))
+        self.u_base, self.w_shp_base, self.w_exp_base = self.bfm.u_base, self.bfm.w_shp_base, self.bfm.w_exp_base
 
         # config
         self.gpu_mode = kvs.get('gpu_mode', False)
@@ -57,19 +63,39 @@ class TDDFA_ONNX(object):
             print(f'{onnx_fp} does not exist, try to convert the `.pth` version to `.onnx` online')
             onnx_fp = convert_to_onnx(**kvs)
 
-        self.session = onnxruntime.InferenceSession(onnx_fp, None)
+        # INT8 variant ('dynamic' or 'static') written by quantize.py once it passed its accuracy check
+        quantization = kvs.get('quantization')
+        if quantization is not None:
+            if osp.exists(quantized_onnx_fp(onnx_fp, quantization)):
+                onnx_fp = quantized_onnx_fp(onnx_fp, quantization)
+            else:
+                print(f'WARNING: no {quantization} INT8 model for {onnx_fp}, run quantize.py, using the FP32 one')
+
+        self.session = get_session(onnx_fp, **sess_kvs)
+
+        # models exported before the batch dimension was dynamic only take one crop at a time
+        self.max_batch = kvs.get('max_batch', 64)
+        if self.session.get_inputs()[0].shape[0] == 1:
+            print(f'WARNING: {onnx_fp} has a fixed batch size of 1, delete it to export it again with a dynamic one')
+            self.max_batch = 1
 
         # params normalization config
         r = _load(param_mean_std_fp)
         self.param_mean = r.get('mean')
         self.param_std = r.get('std')
 
-    def __call__(self, img_ori, objs, **kvs):
-        # Crop image, forward to get the param
-        param_lst = []
+    @property
+    def tri(self):
+        # the triangles are only read for rendering
+        return self.bfm.tri
+
+    def preprocess(self, img_ori, objs, crop_policy='box'):
+        """
+        :return: the normalized network inputs of the objs, each of shape (3, size, size), and their roi boxes
+        """
+        inp_lst = []
         roi_box_lst = []
 
-        crop_policy = kvs.get('crop_policy', 'box')
         for obj in objs:
             if crop_policy == 'box':
                 # by face box
@@ -84,36 +110,58 @@ class TDDFA_ONNX(object):
             # img = crop_img(img_ori, roi_box)
             img = img_ori
             img = cv2.resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_LINEAR)
-            img = img.astype(np.float32).transpose(2, 0, 1)[np.newaxis, ...]
-            img = (img - 127.5) / 128.
+            img = img.astype(np.float32).transpose(2, 0, 1)
+            inp_lst.append((img - 127.5) / 128.)
 
-            inp_dct = {'input': img}
+        return inp_lst, roi_box_lst
+
+    def __call__(self, img_ori, objs, **kvs):
+        # Crop image, forward all the crops at once to get the params
+        param_lst = []
+        inp_lst, roi_box_lst = self.preprocess(img_ori, objs, kvs.get('crop_policy', 'box'))
+
+        # very large requests are split in batches of at most max_batch crops
+        max_batch = kvs.get('max_batch', self.max_batch)
+        for start in range(0, len(inp_lst), max_batch):
+            inp_dct = {'input': np.stack(inp_lst[start:start + max_batch])}
 
             param = self.session.run(None, inp_dct)[0]
-            param = param.flatten().astype(np.float32)
+            param = param.reshape(len(inp_dct['input']), -1).astype(np.float32)
             param = param * self.param_std + self.param_mean  # re-scale
-            param_lst.append(param)
+            param_lst.extend(param)
 
         return param_lst, roi_box_lst
 
     def recon_vers(self, param_lst, roi_box_lst, **kvs):
-        dense_flag = kvs.get('dense_flag', False)
-        size = self.size
-
-        ver_lst = []
-        for param, roi_box in zip(param_lst, roi_box_lst):
-            R, offset, alpha_shp, alpha_exp = _parse_param(param)
-            if dense_flag:
-                inp_dct = {
-                    'R': R, 'offset': offset, 'alpha_shp': alpha_shp, 'alpha_exp': alpha_exp
-                }
-                pts3d = self.bfm_session.run(None, inp_dct)[0]
-                pts3d = similar_transform(pts3d, roi_box, size)
+        return list(self.recon_vers_batch(param_lst, roi_box_lst, **kvs))
+
+    def recon_vers_batch(self, params, roi_boxes, **kvs):
+        """Reconstruct the vertices of all the faces at once
+        :param params: 3DMM params, shape=(N, 62)
+        :param roi_boxes: shape=(N, 4)
+        :return: shape=(N, 3, 68), or (N, 3, V) with dense_flag
+        """
+        if kvs.get('dense_flag', False):
+            if len(params) == 0:
+                return np.zeros((0, 3, 0), dtype=np.float32)
+            pts3d = []
+            if self.bfm_batch:
+                R, offset, alpha_shp, alpha_exp = _parse_params(np.asarray(params, dtype=np.float32))
+                max_batch = kvs.get('max_batch', self.max_batch)
+                for start in range(0, len(R), max_batch):
+                    batch = slice(start, start + max_batch)
+                    inp_dct = {
+                        'R': np.ascontiguousarray(R[batch]), 'offset': np.ascontiguousarray(offset[batch]),
+                        'alpha_shp': np.ascontiguousarray(alpha_shp[batch, :, None]),
+                        'alpha_exp': np.ascontiguousarray(alpha_exp[batch, :, None])
+                    }
+                    pts3d.extend(self.bfm_session.run(None, inp_dct)[0])
             else:
-                pts3d = R @ (self.u_base + self.w_shp_base @ alpha_shp + self.w_exp_base @ alpha_exp). \
-                    reshape(3, -1, order='F') + offset
-                pts3d = similar_transform(pts3d, roi_box, size)
-
-            ver_lst.append(pts3d)
-
-        return ver_lst
+                for param in params:
+                    R, offset, alpha_shp, alpha_exp = _parse_param(param)
+                    inp_dct = {
+                        'R': R, 'offset': offset, 'alpha_shp': alpha_shp, 'alpha_exp': alpha_exp
+                    }
+                    pts3d.append(self.bfm_session.run(None, inp_dct)[0])
+            return similar_transform_batch(np.stack(pts3d), roi_boxes, self.size)
+        return recon_vers_batch(params, roi_boxes, self.u_base, self.w_shp_base, self.w_exp_base, self.size)
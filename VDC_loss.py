@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import numpy as np
 import torch
 import torch.nn as nn
-from utils.io import _load, _numpy_to_cuda, _numpy_to_tensor
-from utils.params import *
+from utils import params
 
-_to_tensor = _numpy_to_cuda  # gpu
+# copied out of the memory-mapped params, the tensors follow the module with .to(device)
+_to_tensor = lambda x: torch.from_numpy(np.array(x))
 
 
 def _parse_param_batch(param):
@@ -21,23 +22,25 @@ def _parse_param_batch(param):
 
 
 class VDCLoss(nn.Module):
-    def __init__(self, opt_style='all'):
+    def __init__(self, opt_style='all', device=None):
         super(VDCLoss, self).__init__()
 
-        self.u = _to_tensor(u)
-        self.param_mean = _to_tensor(param_mean)
-        self.param_std = _to_tensor(param_std)
-        self.w_shp = _to_tensor(w_shp)
-        self.w_exp = _to_tensor(w_exp)
+        self.register_buffer('u', _to_tensor(params.u), persistent=False)
+        self.register_buffer('param_mean', _to_tensor(params.param_mean), persistent=False)
+        self.register_buffer('param_std', _to_tensor(params.param_std), persistent=False)
+        self.register_buffer('w_shp', _to_tensor(params.w_shp), persistent=False)
+        self.register_buffer('w_exp', _to_tensor(params.w_exp), persistent=False)
 
-        self.keypoints = _to_tensor(keypoints)
-        self.u_base = self.u[self.keypoints]
-        self.w_shp_base = self.w_shp[self.keypoints]
-        self.w_exp_base = self.w_exp[self.keypoints]
+        self.register_buffer('keypoints', _to_tensor(params.keypoints), persistent=False)
+        self.register_buffer('u_base', self.u[self.keypoints], persistent=False)
+        self.register_buffer('w_shp_base', self.w_shp[self.keypoints], persistent=False)
+        self.register_buffer('w_exp_base', self.w_exp[self.keypoints], persistent=False)
 
         self.w_shp_length = self.w_shp.shape[0] // 3
 
         self.opt_style = opt_style
+        if device is not None:
+            self.to(device)
 
     def reconstruct_and_parse(self, input, target):
         # reconstruct
@@ -71,7 +74,8 @@ class VDCLoss(nn.Module):
 
         # resample index
         index = torch.randperm(self.w_shp_length)[:resample_num].reshape(-1, 1)
-        keypoints_resample = torch.cat((3 * index, 3 * index + 1, 3 * index + 2), dim=1).view(-1).cuda()
+        keypoints_resample = torch.cat((3 * index, 3 * index + 1, 3 * index + 2), dim=1).view(-1) \
+            .to(self.keypoints.device)
         keypoints_mix = torch.cat((self.keypoints, keypoints_resample))
         w_shp_base = self.w_shp[keypoints_mix]
         u_base = self.u[keypoints_mix]
@@ -0,0 +1,122 @@
+import os
+import json
+import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _load_std_model(path):
+    with open(path) as f:
+        data = json.load(f)
+    std_model = np.asarray(data["std_model"])
+    std_model.flags.writeable = False
+    return std_model
+
+
+def get_std_model(path="./std_model.json"):
+    # empirical estimation of the length and oriented shape of the standard alignment, read once per process
+    return _load_std_model(os.path.abspath(path))
+
+
+def _homogeneous(clouds):
+    return np.concatenate((clouds, np.ones(clouds.shape[:-1] + (1,))), axis=-1)
+
+
+def best_fit_transform_batch(A, B):
+    """
+    Least-squares rigid transforms mapping every A[n] on B[n], with a single stacked SVD.
+    :param A: array of shape (N, P, m) or (P, m), broadcast against B
+    :param B: array of shape (N, P, m)
+    :return: homogeneous transforms of shape (N, m + 1, m + 1)
+    """
+    A, B = np.broadcast_arrays(np.asarray(A, dtype=np.float64), np.asarray(B, dtype=np.float64))
+    assert A.ndim == 3
+    m = A.shape[-1]
+    centroid_A = np.mean(A, axis=1)
+    centroid_B = np.mean(B, axis=1)
+    AA = A - centroid_A[:, np.newaxis]
+    BB = B - centroid_B[:, np.newaxis]
+    H = np.swapaxes(AA, 1, 2) @ BB
+    U, S, Vt = np.linalg.svd(H)
+    # special reflection case
+    reflection = np.linalg.det(np.swapaxes(Vt, 1, 2) @ np.swapaxes(U, 1, 2)) < 0
+    Vt[reflection, m - 1, :] *= -1
+    R = np.swapaxes(Vt, 1, 2) @ np.swapaxes(U, 1, 2)
+    t = centroid_B - np.einsum('nij,nj->ni', R, centroid_A)
+    T = np.tile(np.identity(m + 1), (A.shape[0], 1, 1))
+    T[:, :m, :m] = R
+    T[:, :m, m] = t
+    return T
+
+
+def get_transform_batch(A, B):
+    """
+    Batched equivalent of get_transform.
+    :param A: reference cloud of shape (68, 3) or stack of shape (N, 68, 3)
+    :param B: stack of clouds of shape (N, 68, 3)
+    :return: homogeneous transforms of shape (N, 4, 4)
+    """
+    B = np.asarray(B)
+    assert B.ndim == 3 and np.shape(A)[-2:] == B.shape[-2:]
+    return best_fit_transform_batch(A, B)
+
+
+def get_transform(A, B):
+    assert A.shape == B.shape
+    return get_transform_batch(A, B[np.newaxis])[0]
+
+
+def umeyama_batch(P, Q):
+    """
+    Batched similarity transforms such that P[n].dot(scale[n] * rot[n]) + trans[n] fits Q[n].
+    :param P: array of shape (N, 68, 3)
+    :param Q: array of shape (N, 68, 3) or (68, 3), broadcast against P
+    :return: scale (N,), rot (N, 3, 3) and trans (N, 3)
+    """
+    P, Q = np.broadcast_arrays(np.asarray(P, dtype=np.float64), np.asarray(Q, dtype=np.float64))
+    assert P.ndim == 3
+    n = P.shape[1]
+    mean_P = P.mean(axis=1)
+    mean_Q = Q.mean(axis=1)
+    C = np.swapaxes(P - mean_P[:, np.newaxis], 1, 2) @ (Q - mean_Q[:, np.newaxis]) / n
+    V, S, W = np.linalg.svd(C)
+    d = (np.linalg.det(V) * np.linalg.det(W)) < 0.0
+    S[d, -1] = -S[d, -1]
+    V[d, :, -1] = -V[d, :, -1]
+    rot = V @ W
+    var_P = np.var(P, axis=1).sum(axis=-1)
+    scale = np.sum(S, axis=-1) / var_P
+    trans = mean_Q - np.einsum('ni,nij->nj', mean_P, scale[:, np.newaxis, np.newaxis] * rot)
+    return scale, rot, trans
+
+
+def umeyama(P, Q):
+    assert P.shape == Q.shape
+    scale, rot, trans = umeyama_batch(P[np.newaxis], Q[np.newaxis])
+    return scale[0], rot[0], trans[0]
+
+
+def normalize_position_batch(clouds, reference=None):
+    """
+    Rotate every cloud to the standard alignment, then center and scale it in the unit cube.
+    :param clouds: array of shape (N, 68, 3)
+    :param reference: reference cloud of shape (68, 3), the cached standard model if None
+    :return: transforms (N, 4, 4), means (N, 3), maxs (N,) and normalized clouds (N, 68, 3)
+    """
+    clouds = np.asarray(clouds, dtype=np.float64)
+    assert clouds.ndim == 3
+    if reference is None:
+        reference = get_std_model()
+    trans = get_transform_batch(reference, clouds)
+    x = (_homogeneous(clouds) @ trans)[..., :3]
+    _mean = np.mean(x, axis=1)
+    _x = x - _mean[:, np.newaxis]
+    _max = _x.max(axis=(1, 2))
+    x = (_x / (2 * _max[:, np.newaxis, np.newaxis])) + .5
+    return trans, _mean, _max, x
+
+
+def normalize_position(input, reference=None):
+    assert input.ndim == 2
+    trans, _mean, _max, x = normalize_position_batch(input[np.newaxis], reference)
+    return [trans[0], _mean[0], _max[0]], x[0]
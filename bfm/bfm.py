@@ -6,7 +6,10 @@ import sys
 
 sys.path.append('../../3DDFA')
 
+import os
+import shutil
 import os.path as osp
+from functools import cached_property
 import numpy as np
 from utils.io import _load
 
@@ -19,22 +22,99 @@ def _to_ctype(arr):
     return arr
 
 
+def _bfm_tri(bfm_fp, bfm):
+    if osp.split(bfm_fp)[-1] == 'bfm_noneck_v3.pkl':
+        tri = _load(make_abs_path('../configs/tri.pkl'))  # this tri/face is re-built for bfm_noneck_v3
+    else:
+        tri = bfm.get('tri')
+    return _to_ctype(tri.T).astype(np.int32)
+
+
+def asset_dir(bfm_fp):
+    # configs/bfm_noneck_v3.pkl -> configs/bfm_noneck_v3/
+    return osp.splitext(bfm_fp)[0]
+
+
+def compile_bfm(bfm_fp):
+    """
+    Write the BFM of bfm_fp as one .npy per array: the keypoint (sparse) bases, the dense bases and the topology, so
+    that BFMModel memory-maps them and only reads the dense parts when they are used.
+    """
+    bfm = _load(bfm_fp)
+    keypoints = bfm.get('keypoints').astype(np.int64)
+    u = bfm.get('u').astype(np.float32)
+    w_shp = bfm.get('w_shp').astype(np.float32)
+    w_exp = bfm.get('w_exp').astype(np.float32)
+    arrays = {
+        'keypoints': keypoints,
+        'u_base': u[keypoints].reshape(-1, 1), 'w_shp_base': w_shp[keypoints], 'w_exp_base': w_exp[keypoints],
+        'u': u, 'w_shp': w_shp, 'w_exp': w_exp,
+        'tri': _bfm_tri(bfm_fp, bfm),
+    }
+
+    # written aside then moved, concurrent processes never read a partial asset
+    wfd = asset_dir(bfm_fp)
+    tmp_fd = f'{wfd}.{os.getpid()}.tmp'
+    os.makedirs(tmp_fd, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(osp.join(tmp_fd, f'{name}.npy'), arr)
+    # the previous asset is moved aside, not deleted, files already opened or mapped from it stay readable
+    old_fd = f'{wfd}.{os.getpid()}.old'
+    try:
+        os.rename(wfd, old_fd)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp_fd, wfd)
+    except OSError:
+        # compiled by another process in the meantime
+        shutil.rmtree(tmp_fd, ignore_errors=True)
+    shutil.rmtree(old_fd, ignore_errors=True)
+    print(f'Compile {bfm_fp} to {wfd} done.')
+
+
 class BFMModel(object):
+    """
+    BFM bases, read from the compiled asset of bfm_fp (see compile_bfm), which is built on first use. The keypoint
+    bases are loaded at once, the dense bases and the triangles are memory-mapped when first accessed.
+    """
+
     def __init__(self, bfm_fp, shape_dim=40, exp_dim=10):
-        bfm = _load(bfm_fp)
-        self.u = bfm.get('u').astype(np.float32)  # fix bug
-        self.w_shp = bfm.get('w_shp').astype(np.float32)[..., :shape_dim]
-        self.w_exp = bfm.get('w_exp').astype(np.float32)[..., :exp_dim]
-        if osp.split(bfm_fp)[-1] == 'bfm_noneck_v3.pkl':
-            self.tri = _load(make_abs_path('../configs/tri.pkl'))  # this tri/face is re-built for bfm_noneck_v3
-        else:
-            self.tri = bfm.get('tri')
-
-        self.tri = _to_ctype(self.tri.T).astype(np.int32)
-        self.keypoints = bfm.get('keypoints').astype(np.long)  # fix bug
-        w = np.concatenate((self.w_shp, self.w_exp), axis=1)
-        self.w_norm = np.linalg.norm(w, axis=0)
+        self.bfm_fp = bfm_fp
+        self.shape_dim = shape_dim
+        self.exp_dim = exp_dim
+        self.asset_dir = asset_dir(bfm_fp)
+        # the asset can be shipped without the pickle, it is only compared to the pickle when there is one
+        if not osp.exists(osp.join(self.asset_dir, 'tri.npy')) or \
+                (osp.exists(bfm_fp) and osp.getmtime(self.asset_dir) < osp.getmtime(bfm_fp)):
+            compile_bfm(bfm_fp)
+
+        self.keypoints = self._load('keypoints')
+        self.u_base = self._load('u_base')
+        self.w_shp_base = np.ascontiguousarray(self._load('w_shp_base')[..., :shape_dim])
+        self.w_exp_base = np.ascontiguousarray(self._load('w_exp_base')[..., :exp_dim])
+
+    def _load(self, name, mmap_mode=None):
+        return np.load(osp.join(self.asset_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    @cached_property
+    def u(self):
+        return self._load('u', mmap_mode='r')
 
-        self.u_base = self.u[self.keypoints].reshape(-1, 1)
-        self.w_shp_base = self.w_shp[self.keypoints]
-        self.w_exp_base = self.w_exp[self.keypoints]
+    @cached_property
+    def w_shp(self):
+        return self._load('w_shp', mmap_mode='r')[..., :self.shape_dim]
+
+    @cached_property
+    def w_exp(self):
+        return self._load('w_exp', mmap_mode='r')[..., :self.exp_dim]
+
+    @cached_property
+    def tri(self):
+        # copy-on-write, the renderers take writable buffers
+        return self._load('tri', mmap_mode='c')
+
+    @cached_property
+    def w_norm(self):
+        w = np.concatenate((self.w_shp, self.w_exp), axis=1)
+        return np.linalg.norm(w, axis=0)
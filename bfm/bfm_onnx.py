@@ -12,6 +12,7 @@ import torch
 import torch.nn as nn
 
 from utils.io import _load, _numpy_to_cuda, _numpy_to_tensor
+from bfm.bfm import BFMModel
 
 make_abs_path = lambda fn: osp.join(osp.dirname(osp.realpath(__file__)), fn)
 
@@ -40,13 +41,13 @@ class BFMModel_ONNX(nn.Module):
 
         _to_tensor = _numpy_to_tensor
 
-        # load bfm
-        bfm = _load(bfm_fp)
+        # load bfm from its compiled asset, the pickle is only read to compile a missing asset, see compile_bfm
+        bfm = BFMModel(bfm_fp, shape_dim=shape_dim, exp_dim=exp_dim)
 
-        u = _to_tensor(bfm.get('u').astype(np.float32))
+        u = _to_tensor(np.array(bfm.u, dtype=np.float32))
         self.u = u.view(-1, 3).transpose(1, 0)
-        w_shp = _to_tensor(bfm.get('w_shp').astype(np.float32)[..., :shape_dim])
-        w_exp = _to_tensor(bfm.get('w_exp').astype(np.float32)[..., :exp_dim])
+        w_shp = _to_tensor(np.array(bfm.w_shp, dtype=np.float32))
+        w_exp = _to_tensor(np.array(bfm.w_exp, dtype=np.float32))
         w = torch.cat((w_shp, w_exp), dim=1)
         self.w = w.view(-1, 3, w.shape[-1]).contiguous().permute(1, 0, 2)
 
@@ -70,14 +71,58 @@ class BFMModel_ONNX(nn.Module):
         return pts3d
 
 
-def convert_bfm_to_onnx(bfm_onnx_fp, shape_dim=40, exp_dim=10):
+class BFMModel_ONNX_Batch(BFMModel_ONNX):
+    """BFM decoder of N faces at once, every input having a leading batch dimension"""
+
+    def __init__(self, bfm_fp, shape_dim=40, exp_dim=10):
+        super(BFMModel_ONNX_Batch, self).__init__(bfm_fp, shape_dim=shape_dim, exp_dim=exp_dim)
+        # (3V, K), one matmul decodes all the faces
+        self.w_flat = self.w.reshape(-1, self.w.shape[-1])
+
+    def forward(self, *inps):
+        R, offset, alpha_shp, alpha_exp = inps  # (N, 3, 3), (N, 3, 1), (N, shape_dim, 1), (N, exp_dim, 1)
+        alpha = torch.cat((alpha_shp, alpha_exp), dim=1).squeeze(-1)
+        vertex = self.u + (alpha @ self.w_flat.t()).view(alpha.shape[0], 3, -1)
+        pts3d = R @ vertex + offset
+        return pts3d
+
+
+def batch_onnx_fp(bfm_onnx_fp):
+    # path of the export of BFMModel_ONNX_Batch
+    return osp.splitext(bfm_onnx_fp)[0] + '_batch.onnx'
+
+
+def convert_bfm_to_onnx(bfm_onnx_fp, shape_dim=40, exp_dim=10, batch=False):
+    """
+    :param batch: export BFMModel_ONNX_Batch, whose inputs have a dynamic leading batch dimension
+    """
     # print(shape_dim, exp_dim)
-    bfm_fp = bfm_onnx_fp.replace('.onnx', '.pkl')
-    bfm_decoder = BFMModel_ONNX(bfm_fp=bfm_fp, shape_dim=shape_dim, exp_dim=exp_dim)
+    stem = osp.splitext(bfm_onnx_fp)[0]
+    if batch and stem.endswith('_batch'):
+        stem = stem[:-len('_batch')]
+    # the compiled asset of BFMModel is next to the pickle, which may not be shipped
+    bfm_fp = stem + '.pkl'
+    model = BFMModel_ONNX_Batch if batch else BFMModel_ONNX
+    bfm_decoder = model(bfm_fp=bfm_fp, shape_dim=shape_dim, exp_dim=exp_dim)
     bfm_decoder.eval()
 
     # dummy_input = torch.randn(12 + shape_dim + exp_dim)
-    dummy_input = torch.randn(3, 3), torch.randn(3, 1), torch.randn(shape_dim, 1), torch.randn(exp_dim, 1)
+    if batch:
+        dummy_input = torch.randn(2, 3, 3), torch.randn(2, 3, 1), torch.randn(2, shape_dim, 1), \
+                      torch.randn(2, exp_dim, 1)
+        dynamic_axes = {
+            'R': [0],
+            'offset': [0],
+            'alpha_shp': [0],
+            'alpha_exp': [0],
+            'output': [0],
+        }
+    else:
+        dummy_input = torch.randn(3, 3), torch.randn(3, 1), torch.randn(shape_dim, 1), torch.randn(exp_dim, 1)
+        dynamic_axes = {
+            'alpha_shp': [0],
+            'alpha_exp': [0],
+        }
     R, offset, alpha_shp, alpha_exp = dummy_input
     torch.onnx.export(
         bfm_decoder,
@@ -85,10 +130,7 @@ def convert_bfm_to_onnx(bfm_onnx_fp, shape_dim=40, exp_dim=10):
         bfm_onnx_fp,
         input_names=['R', 'offset', 'alpha_shp', 'alpha_exp'],
         output_names=['output'],
-        dynamic_axes={
-            'alpha_shp': [0],
-            'alpha_exp': [0],
-        },
+        dynamic_axes=dynamic_axes,
         do_constant_folding=True
     )
     print(f'Convert {bfm_fp} to {bfm_onnx_fp} done.')
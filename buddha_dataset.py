@@ -1,10 +1,16 @@
 import os
 import cv2
 import json
-import pickle
+import threading
 import numpy as np
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from collections import OrderedDict
+from collections.abc import Sequence
+from alignment import get_transform, get_transform_batch
+from image_store import ImageStore, write_shard, write_index, artifact_sources, read_manifest, write_manifest, \
+    sources_changed
 
 
 def ldk_on_im(ldk, trans, mean, max, inv=False):
@@ -16,54 +22,73 @@ def ldk_on_im(ldk, trans, mean, max, inv=False):
     return (tmp[:3].T * max) + mean
 
 
-def get_transform(A, B):
-    def best_fit_transform(A, B):
-        assert A.shape == B.shape
-        m = A.shape[1]
-        centroid_A = np.mean(A, axis=0)
-        centroid_B = np.mean(B, axis=0)
-        AA = A - centroid_A
-        BB = B - centroid_B
-        H = np.dot(AA.T, BB)
-        U, S, Vt = np.linalg.svd(H)
-        R = np.dot(Vt.T, U.T)
-        if np.linalg.det(R) < 0:
-            Vt[m - 1, :] *= -1
-            R = np.dot(Vt.T, U.T)
-        t = centroid_B.T - np.dot(R, centroid_A.T)
-        T = np.identity(m + 1)
-        T[:m, :m] = R
-        T[:m, m] = t
-        return T
-
-    assert A.shape == B.shape
-    m = A.shape[1]
-    src = np.ones((m + 1, A.shape[0]))
-    dst = np.ones((m + 1, B.shape[0]))
-    src[:m, :] = np.copy(A.T)
-    dst[:m, :] = np.copy(B.T)
-    T = best_fit_transform(src[:m, :].T, dst[:m, :].T)
-    src = np.dot(T, src)
-    T = best_fit_transform(A, src[:m, :].T)
-    return T
+def crop_data(data, bbox):
+    int_bbox = bbox.astype(np.int32)
+    rect_xy, width, height = int_bbox[:2], int_bbox[2] - int_bbox[0], int_bbox[3] - int_bbox[1]
+    return data[rect_xy[1]:rect_xy[1] + height, rect_xy[0]:rect_xy[0] + width, :]
 
 
-def crop_pict(data, bbox, projection):
+def crop_gt(bbox, projection):
     int_bbox = bbox.astype(np.int32)
-    rect_xy, width, height = int_bbox[:2], int_bbox[2] - int_bbox[0], int_bbox[3] - int_bbox[1]
-    cropped_data = data[rect_xy[1]:rect_xy[1] + height, rect_xy[0]:rect_xy[0] + width, :]
     tmp = projection[:, :2] - int_bbox[:2]
     cropped_gt = np.zeros([68, 3])
     cropped_gt[:, :2] = tmp
     cropped_gt[:, 2] = projection[:, 2]
-    return cropped_data, cropped_gt
+    return cropped_gt
+
+
+def crop_pict(data, bbox, projection):
+    return crop_data(data, bbox), crop_gt(bbox, projection)
+
+
+class ImageCache:
+    """Process-wide LRU cache of decoded pictures, bounded in bytes"""
+
+    def __init__(self, max_mb=1024):
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resize(self, max_mb):
+        with self.lock:
+            self.max_bytes = int(max_mb * 2 ** 20)
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        # the most recent entry is kept even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, value = self.entries.popitem(last=False)
+            self.nbytes -= value.nbytes
+
+    def get(self, key, loader):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = loader()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.nbytes += value.nbytes
+                self._evict()
+        return value
+
+
+IMAGE_CACHE = ImageCache()
 
 
 class Artifact:
     def __init__(self, json_file, ds_path):
         json_data = json.load(json_file)
         self.id = json_data["artifact_id"]
-        self.gt = np.asarray(json_data["avg_model"]) + np.asarray(json_data["hand_updates"])
+        self.avg_model, self.hand_updates = np.asarray(json_data["avg_model"]), np.asarray(json_data["hand_updates"])
+        self.gt = self.avg_model + self.hand_updates
         picture_ids = []
         self.pictures = []
         self.list_transform = []
@@ -71,13 +96,32 @@ class Artifact:
         for file in tmp:
             if os.path.exists(os.path.join(ds_path, self.id, file)):
                 picture_ids.append(file)
-        keys = [f for f in json_data['norm_preds_dict'].keys()]
-        for file, key in zip(picture_ids, keys):
+        keys = [f for f in json_data['norm_preds_dict'].keys()][:len(picture_ids)]
+        if len(keys) == 0:
+            return
+        # align all the views of the artifact at once
+        avg_model = np.asarray(json_data['avg_model'])
+        preds = np.asarray([json_data['norm_preds_dict'][key][0] for key in keys])
+        transformations = get_transform_batch(avg_model, preds)
+        for file, key, transformation in zip(picture_ids, keys, transformations):
             path2img = os.path.join(ds_path, self.id, file)
-            img_obj = Image(path2img, key, json_data)
+            img_obj = Image(path2img, key, json_data, transformation)
             self.pictures.append(img_obj)
+        cropped_transformations = get_transform_batch(avg_model, [img.cropped_gt for img in self.pictures])
+        for img_obj, cropped_transformation in zip(self.pictures, cropped_transformations):
+            img_obj.set_cropped_transformation(cropped_transformation)
             self.list_transform.append(img_obj.cropped_transformation)
 
+    @classmethod
+    def from_store(cls, store, art_index):
+        art = cls.__new__(cls)
+        art.id = str(store.index['art_id'][art_index])
+        art.avg_model, art.hand_updates = store.get('art_avg_model', art_index), store.get('art_hand_updates', art_index)
+        art.gt = art.avg_model + art.hand_updates
+        art.pictures = [Image.from_store(store, art_index, img_index) for img_index in store.image_range(art_index)]
+        art.list_transform = [img.cropped_transformation for img in art.pictures]
+        return art
+
     def print_gt(self):
         if len(self.pictures) > 0:
             size = int(np.sqrt(len(self.pictures))) + 1
@@ -92,85 +136,257 @@ class Artifact:
 
 
 class Image:
-    def __init__(self, path2img, file_key, artifact_data):
+    def __init__(self, path2img, file_key, artifact_data, transformation=None):
         self.id = path2img.split("/")[-1]
-        self.data = cv2.cvtColor(cv2.imread(path2img), cv2.COLOR_BGR2RGB)
+        # pixels are decoded on first access, geometry and annotations are computed right away
+        self.path = path2img
+        self._data = None
         pred, self.mean, self.max, self.bbox = artifact_data['norm_preds_dict'][file_key]
         pred, self.mean, self.bbox = np.asarray(pred), np.asarray(self.mean), np.asarray(self.bbox)
-        self.transformation = get_transform(np.asarray(artifact_data['avg_model']), pred)
+        standalone = transformation is None
+        if standalone:
+            transformation = get_transform(np.asarray(artifact_data['avg_model']), pred)
+        self.transformation = transformation
         self.pred = (pred * self.max) + self.mean
         self.precomputed_gt = ldk_on_im(
             np.asarray(artifact_data['avg_model']) + np.asarray(artifact_data['hand_updates']), self.transformation,
             self.mean, self.max, True)
-        self.cropped_data, self.cropped_gt = crop_pict(self.data, self.bbox, self.precomputed_gt)
+        self.cropped_gt = crop_gt(self.bbox, self.precomputed_gt)
         self.transformation = [self.transformation, self.mean, self.max]
-        self.cropped_transformation = get_transform(np.asarray(artifact_data['avg_model']), self.cropped_gt)
-        self.cropped_transformation = [self.cropped_transformation, np.mean(self.cropped_gt, axis=0), self.cropped_gt.max()]
+        # when built by an Artifact, the cropped transformation is fitted for all the views at once
+        self.cropped_transformation = None
+        if standalone:
+            self.set_cropped_transformation(get_transform(np.asarray(artifact_data['avg_model']), self.cropped_gt))
+
+    @classmethod
+    def from_store(cls, store, art_index, img_index):
+        img = cls.__new__(cls)
+        img.id = str(store.index['img_id'][img_index])
+        img.path = None
+        # already lazy, pages of the memory-mapped store are only read when accessed
+        img._data = store.image_data(art_index, img_index)
+        img.bbox, img.mean, img.max = store.get('img_bbox', img_index), store.get('img_mean', img_index), \
+            float(store.index['img_max'][img_index])
+        img.transformation = [store.get('img_transformation', img_index), img.mean, img.max]
+        img.pred = store.get('img_pred', img_index)
+        img.precomputed_gt = store.get('img_precomputed_gt', img_index)
+        img.cropped_gt = store.get('img_cropped_gt', img_index)
+        img.cropped_transformation = [store.get('img_cropped_transformation', img_index),
+                                      store.get('img_cropped_mean', img_index),
+                                      float(store.index['img_cropped_max'][img_index])]
+        return img
+
+    def _decode(self):
+        return cv2.cvtColor(cv2.imread(self.path), cv2.COLOR_BGR2RGB)
+
+    @property
+    def data(self):
+        if self._data is not None:
+            return self._data
+        return IMAGE_CACHE.get(self.path, self._decode)
+
+    @property
+    def cropped_data(self):
+        return crop_data(self.data, self.bbox)
+
+    def set_cropped_transformation(self, cropped_transformation):
+        self.cropped_transformation = [cropped_transformation, np.mean(self.cropped_gt, axis=0), self.cropped_gt.max()]
 
     def get_im_and_cloud(self):
         return self.cropped_data, self.cropped_gt[:, :2]
 
 
+def _build_shard(args):
+    # build one artifact and write its pixels to its own shard, a failure only loses this artifact
+    ds_path, id, shard_path = args
+    try:
+        with open(os.path.join(ds_path, id + '.json')) as json_file:
+            art = Artifact(json_file, ds_path)
+        return id, write_shard(art, shard_path), None
+    except Exception as e:
+        return id, None, repr(e)
+    finally:
+        # the pictures of a built artifact are never read again by the build worker
+        IMAGE_CACHE.clear()
+
+
+def build_store(ds_path, tmp_folder, workers=None, incremental=True):
+    """
+    Build the image store of all the annotated artifacts of ds_path in tmp_folder, one process per artifact.
+    With incremental, only the artifacts whose sources changed since the manifest was written are rebuilt, the
+    shards of the others are kept and their index entries copied.
+    """
+    shards_folder = os.path.join(tmp_folder, 'shards')
+    index_folder = os.path.join(tmp_folder, 'index')
+    os.makedirs(shards_folder, exist_ok=True)
+    artifact_json = [name for name in os.listdir(ds_path) if os.path.isfile(os.path.join(ds_path, name))]
+    artifact_folder = [name for name in os.listdir(ds_path) if os.path.isdir(os.path.join(ds_path, name))]
+    annotated_id = [name.split('.')[0] for name in artifact_json]
+    print("INFO:", len(annotated_id), "annotated artifacts detected out of", len(artifact_folder), "artifacts")
+    manifest = read_manifest(tmp_folder) if incremental and os.path.exists(index_folder) else None
+    previous = {} if manifest is None else manifest['artifacts']
+    sources = {id: artifact_sources(ds_path, id, previous.get(id, {}).get('sources')) for id in annotated_id}
+    store = ImageStore(tmp_folder) if manifest is not None else None
+    stored = {} if store is None else {id: art_index for art_index, id in enumerate(store.ids())}
+    kept = [id for id in annotated_id if id in previous and previous[id]['sources'] == sources[id]
+            and (id in stored or previous[id]['failed'] is not None)]
+    to_build = [id for id in annotated_id if id not in kept]
+    removed = [id for id in previous if id not in sources]
+    print("INFO:", len(kept), "artifacts unchanged,", len(to_build), "to build,", len(removed), "removed")
+    if manifest is not None and len(to_build) == 0 and len(removed) == 0:
+        return
+    results = {}
+    if len(to_build) > 0:
+        tasks = [(ds_path, id, os.path.join(shards_folder, id + '.bin')) for id in to_build]
+        with Pool(workers) as pool:
+            for id, record, error in pool.imap_unordered(_build_shard, tasks, chunksize=1):
+                results[id] = (record, error)
+    records, failed, artifacts = [], {}, {}
+    for id in annotated_id:
+        if id in results:
+            record, error = results[id]
+        elif id in stored:
+            record, error = store.record(stored[id]), None
+        else:
+            record, error = None, previous[id]['failed']
+        if error is not None:
+            if id in results:
+                print("WARNING: could not build artifact", id, ":", error)
+            failed[id] = error
+        else:
+            records.append(record)
+        artifacts[id] = {'sources': sources[id], 'nb_pictures': 0 if record is None else len(record['img_id']),
+                         'failed': error}
+    print("INFO: Writing", len(records), "artifacts to", tmp_folder)
+    write_index(index_folder, records, failed)
+    write_manifest(tmp_folder, artifacts)
+    for id in removed + list(failed.keys()):
+        shard_path = os.path.join(shards_folder, id + '.bin')
+        if os.path.exists(shard_path):
+            os.remove(shard_path)
+
+
+class StoredArtifacts(Sequence):
+    """Artifacts of an ImageStore, built on access"""
+
+    def __init__(self, store, selection):
+        self.store = store
+        self.selection = selection
+
+    def __len__(self):
+        return len(self.selection)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return StoredArtifacts(self.store, self.selection[index])
+        return Artifact.from_store(self.store, int(self.selection[index]))
+
+
+def _artifact_data(art):
+    return [art.id, [[img.id, img.cropped_data, img.data] for img in art.pictures]]
+
+
+def _artifact_label(art):
+    return [art.id, art.gt, art.list_transform]
+
+
+class SplitView(Sequence):
+    """Items of a subset of the artifacts, only the indexes are stored and the artifacts are built on access"""
+
+    def __init__(self, artifacts, indexes, item=_artifact_data):
+        self.artifacts = artifacts
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+        self.item = item
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SplitView(self.artifacts, self.indexes[index], self.item)
+        return self.item(self.artifacts[int(self.indexes[index])])
+
+
+def split_views(artifacts, indexes):
+    """
+    :return: the (data, labels) views of the artifacts at indexes
+    """
+    return SplitView(artifacts, indexes, _artifact_data), SplitView(artifacts, indexes, _artifact_label)
+
+
+def fold_indexes(nb_art, folds=5, seed=0):
+    # folds of the indexes of the loaded artifacts, the remainder is in no fold
+    permutation = np.random.RandomState(seed).permutation(nb_art)
+    fold_size = nb_art // folds
+    return [permutation[fold_size * id_fold:fold_size * (id_fold + 1)] for id_fold in range(folds)]
+
+
 class BuddhaDataset:
     def __init__(self, config):
         self.config = config
+        IMAGE_CACHE.resize(config.image_cache_mb)
         self.tmp_folder = 'dataset_tmp/'
         if not os.path.exists(self.tmp_folder):
             os.mkdir(self.tmp_folder)
-        self.pickle_ds_name = os.path.join(self.tmp_folder, 'ds.pkl')
+        # pixels in one raw blob per artifact, geometry and annotations in a memory-mapped index
+        self.index_folder = os.path.join(self.tmp_folder, 'index')
+        self.store = None
         self.artifacts = []
 
     def load(self):
-        if not os.path.exists(self.pickle_ds_name) or self.config.reset_ds:
+        # synchronized with ds_path, the store is only rebuilt if a source changed since the last build
+        if self.config.reset_ds or not os.path.exists(self.index_folder) or \
+                sources_changed(self.config.ds_path, read_manifest(self.tmp_folder)):
             self.write_ds(self.config.ds_path)
-        with open(self.pickle_ds_name, 'rb') as pkl_file:
-            self.artifacts = pickle.load(pkl_file)
-
-    def get_datasets(self):
-        data = []
-        label = []
-        for i, art in enumerate(self.artifacts):
-            label.append([art.id, art.gt, art.list_transform])
-            list_data = []
-            for img in art.pictures:
-                list_data.append([img.id, img.cropped_data, img.data])
-            data.append([art.id, list_data])
-        label = np.asarray(label)
-        indexes = list(range(len(label)))
-        ids_test = np.random.choice(len(indexes), size=int(len(label) * self.config.split_test_eval[0]), replace=False)
-        ids_test = -np.sort(-ids_test)
-        for id in ids_test:
-            del indexes[id]
-        ids_eval = np.random.choice(len(indexes), size=int(len(label) * self.config.split_test_eval[1]), replace=False)
-        ids_eval = -np.sort(-ids_eval)
-        for id in ids_eval:
-            del indexes[id]
-        test_ds = [[data[id] for id in ids_test], [label[id] for id in ids_test]]
-        eval_ds = [[data[id] for id in ids_eval], [label[id] for id in ids_eval]]
-        train_ds = [[data[id] for id in indexes], [label[id] for id in indexes]]
-        return np.asarray(train_ds), np.asarray(test_ds), np.asarray(eval_ds)
+        self.store = ImageStore(self.tmp_folder)
+        if self.config.remove_singleton:
+            selection = np.flatnonzero(self.store.nb_pictures() > 1)
+        else:
+            selection = np.arange(len(self.store))
+        self.artifacts = StoredArtifacts(self.store, selection)
+
+    def get_datasets(self, seed=None):
+        """
+        Random train/test/eval split of the artifacts, following config.split_test_eval.
+        :param seed: seed of the split, config.split_seed if None
+        :return: train, test and eval splits, each one a (data, labels) pair of lazy views over the artifacts
+        """
+        seed = self.config.split_seed if seed is None else seed
+        nb_art = len(self.artifacts)
+        permutation = np.random.RandomState(seed).permutation(nb_art)
+        nb_test = int(nb_art * self.config.split_test_eval[0])
+        nb_eval = int(nb_art * self.config.split_test_eval[1])
+        ids_test = permutation[:nb_test]
+        ids_eval = permutation[nb_test:nb_test + nb_eval]
+        ids_train = permutation[nb_test + nb_eval:]
+        return tuple(split_views(self.artifacts, np.sort(ids)) for ids in (ids_train, ids_test, ids_eval))
+
+    def get_folds(self, folds=5, seed=None):
+        """
+        K-fold splits of the loaded artifacts, the same for a same seed and the same store.
+        :return: one (train, test) pair per fold, test being the fold and train all the other artifacts
+        """
+        seed = self.config.split_seed if seed is None else seed
+        splits = []
+        all_ids = np.arange(len(self.artifacts))
+        for ids_fold in fold_indexes(len(self.artifacts), folds, seed):
+            ids_train = np.setdiff1d(all_ids, ids_fold)
+            splits.append((split_views(self.artifacts, ids_train), split_views(self.artifacts, np.sort(ids_fold))))
+        return splits
 
     def write_ds(self, ds_path):
-        print("INFO: Generating the dataset_old")
-        if os.path.exists(self.pickle_ds_name):
-            os.remove(self.pickle_ds_name)
-        artifact_json = [name for name in os.listdir(ds_path) if os.path.isfile(os.path.join(ds_path, name))]
-        artifact_folder = [name for name in os.listdir(ds_path) if os.path.isdir(os.path.join(ds_path, name))]
-        annotated_id = [name.split('.')[0] for name in artifact_json]
-        print("INFO:", len(annotated_id), "annotated artifacts detected out of", len(artifact_folder), "artifacts")
-        not_annotated = [name for name in artifact_folder if name not in annotated_id]
-        for id in annotated_id:
-            with open(os.path.join(ds_path, id + '.json')) as json_file:
-                art = Artifact(json_file, ds_path)
-                if self.config.remove_singleton:
-                    if len(art.pictures) > 1:
-                        self.artifacts.append(art)
-                else:
-                    self.artifacts.append(art)
-        if self.config.remove_singleton:
-            print("INFO: Writing", len(self.artifacts), "artifacts to", self.pickle_ds_name)
-        with open(self.pickle_ds_name, 'wb') as pkl_file:
-            pickle.dump(self.artifacts, pkl_file)
+        print("INFO: Updating the image store in", self.tmp_folder)
+        build_store(ds_path, self.tmp_folder, self.config.build_workers, incremental=not self.config.reset_ds)
+
+    def manifest(self):
+        """
+        Metadata of the artifacts (sources, number of pictures, build errors), without opening the store.
+        """
+        manifest = read_manifest(self.tmp_folder)
+        if manifest is None:
+            self.write_ds(self.config.ds_path)
+            manifest = read_manifest(self.tmp_folder)
+        return manifest['artifacts']
 
 
 class Config:
@@ -180,14 +396,33 @@ class Config:
             self.remove_singleton = conf_dict["remove_singleton"]
             self.ds_path = conf_dict["ds_path"]
             self.split_test_eval = conf_dict["split_test_eval"]
+            self.split_seed = conf_dict.get("split_seed", 0)
             self.expand_crop_region = conf_dict["expand_crop_region"]
             self.save_intermediate = conf_dict["save_intermediate"]
             self.save_predict = conf_dict["save_predict"]
             self.save_eval = conf_dict["save_eval"]
             self.save_net_error = conf_dict["save_net_error"]
             self.path_products = conf_dict["path_products"]
+            # 'png' renders the products, 'raw' dumps their arrays as compressed .npz
+            self.diagnostics_mode = conf_dict.get("diagnostics_mode", "png")
+            self.diagnostics_queue = conf_dict.get("diagnostics_queue", 32)
             self.reset_ds = conf_dict["reset_ds"]
+            # processes building the dataset cache, all the cores if None
+            self.build_workers = conf_dict.get("build_workers", None)
+            # memory budget of the decoded pictures kept in the process
+            self.image_cache_mb = conf_dict.get("image_cache_mb", 1024)
             self.train, self.test, self.eval = conf_dict["train"], conf_dict["test"], conf_dict["eval"]
+            # evaluation processes and onnxruntime threads of each of them
+            self.nb_workers = conf_dict.get("nb_workers", 1)
+            self.threads_per_worker = conf_dict.get("threads_per_worker", 4)
+            # onnxruntime sessions: inter-op threads, 'sequential' or 'parallel' execution, graph optimization level,
+            # and folder of the saved optimized graphs, see utils/onnx_session.py
+            self.ort_inter_op_threads = conf_dict.get("ort_inter_op_threads", None)
+            self.ort_execution_mode = conf_dict.get("ort_execution_mode", "sequential")
+            self.ort_optimization_level = conf_dict.get("ort_optimization_level", "all")
+            self.ort_optimized_dir = conf_dict.get("ort_optimized_dir", None)
+            # INT8 model written by quantize.py, 'dynamic' or 'static', FP32 if None
+            self.ort_quantization = conf_dict.get("ort_quantization", None)
             base = 'logs/pipeline'
             i = 1
             while os.path.exists(self.path_products):
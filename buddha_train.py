@@ -33,8 +33,7 @@ class CNN:
         self.RATIO = .75
         cfg = yaml.load(open('configs/mb1_120x120.yml'), Loader=yaml.SafeLoader)
         os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-        os.environ['OMP_NUM_THREADS'] = '4'
-        self.tddfa = TDDFA_ONNX(**cfg)
+        self.tddfa = TDDFA_ONNX(num_threads=4, **cfg)
         data, labels = [], []
         for art_key in ds.keys():
             vect, label = self.preprocess(ds[art_key], ds[art_key]['machine_gt'] + ds[art_key]['human_gt'])
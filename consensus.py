@@ -0,0 +1,75 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class Consensus:
+    """Attention-weighted consensus of the normalized views of one artifact, updated view by view"""
+
+    def __init__(self, id_art=None, nb_points=68):
+        self.id_art = id_art
+        self.nb_points = nb_points
+        # picture name -> (normalized cloud (68, 3), attention (68, 1), [trans, mean, max])
+        self.views = OrderedDict()
+        self.weighted_sum = np.zeros((nb_points, 3))
+        self.weights = np.zeros((nb_points, 1))
+
+    def __len__(self):
+        return len(self.views)
+
+    def __contains__(self, id_img):
+        return id_img in self.views
+
+    def add_view(self, id_img, x, attention, transform=None):
+        x, attention = np.asarray(x, dtype=np.float64), np.asarray(attention, dtype=np.float64)
+        assert x.shape == (self.nb_points, 3) and attention.shape == (self.nb_points, 1)
+        if id_img in self.views:
+            self.remove_view(id_img)
+        self.views[id_img] = (x, attention, transform)
+        self.weighted_sum += x * attention
+        self.weights += attention
+
+    def remove_view(self, id_img):
+        x, attention, _ = self.views.pop(id_img)
+        if len(self.views) == 0:
+            # reset instead of subtracting to avoid accumulating rounding errors
+            self.weighted_sum = np.zeros_like(self.weighted_sum)
+            self.weights = np.zeros_like(self.weights)
+        else:
+            self.weighted_sum -= x * attention
+            self.weights -= attention
+
+    def get(self):
+        assert len(self.views) > 0, "empty consensus"
+        return self.weighted_sum / self.weights
+
+    def get_transform(self, id_img):
+        return self.views[id_img][2]
+
+    def ids(self):
+        return list(self.views.keys())
+
+    def save(self, path):
+        ids = self.ids()
+        transforms = [self.views[id_img][2] for id_img in ids]
+        has_transform = len(ids) > 0 and all(transform is not None for transform in transforms)
+        arrays = {
+            'id_art': np.asarray('' if self.id_art is None else self.id_art),
+            'ids': np.asarray(ids, dtype=str),
+            'clouds': np.asarray([self.views[id_img][0] for id_img in ids]).reshape((-1, self.nb_points, 3)),
+            'attentions': np.asarray([self.views[id_img][1] for id_img in ids]).reshape((-1, self.nb_points, 1))}
+        if has_transform:
+            arrays['trans'] = np.asarray([transform[0] for transform in transforms])
+            arrays['means'] = np.asarray([transform[1] for transform in transforms])
+            arrays['maxs'] = np.asarray([transform[2] for transform in transforms])
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            id_art = str(data['id_art']) or None
+            consensus = cls(id_art, data['clouds'].shape[1])
+            transforms = zip(data['trans'], data['means'], data['maxs']) if 'trans' in data else None
+            for i, id_img in enumerate(data['ids']):
+                transform = list(next(transforms)) if transforms is not None else None
+                consensus.add_view(str(id_img), data['clouds'][i], data['attentions'][i], transform)
+        return consensus
@@ -5,94 +5,14 @@ import time
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
-from multiprocessing import Pool
 from mpl_toolkits.mplot3d import Axes3D
 
-from buddha_dataset import get_transform
-
-
-def umeyama(P, Q):
-    assert P.shape == Q.shape
-    n, dim = P.shape
-
-    centeredP = P - P.mean(axis=0)
-    centeredQ = Q - Q.mean(axis=0)
-
-    C = np.dot(np.transpose(centeredP), centeredQ) / n
-
-    V, S, W = np.linalg.svd(C)
-    d = (np.linalg.det(V) * np.linalg.det(W)) < 0.0
-
-    if d:
-        S[-1] = -S[-1]
-        V[:, -1] = -V[:, -1]
-
-    Rot = np.dot(V, W)
-
-    varP = np.var(P, axis=0).sum()
-    scale = 1 / varP * np.sum(S)  # scale factor
-
-    trans = Q.mean(axis=0) - P.mean(axis=0).dot(scale * Rot)
-
-    return scale, Rot, trans
+from visibility import visibility
+from alignment import get_std_model, umeyama_batch
 
 
 def get_visible_landmarks(ldks):
-    triangles = [[0, 1, 36], [1, 48, 36], [1, 2, 48], [2, 3, 48], [3, 4, 48], [4, 60, 48], [4, 5, 60], [5, 59, 60],
-                 [5, 6, 59], [6, 58, 59], [6, 7, 58], [7, 57, 58], [7, 8, 57], [8, 9, 57], [9, 56, 57], [9, 10, 56],
-                 [10, 55, 56], [10, 11, 55], [11, 64, 55], [11, 12, 64], [12, 64, 54], [12, 13, 54], [13, 14, 54],
-                 [14, 15, 54], [15, 45, 54], [15, 16, 45], [16, 26, 45], [26, 25, 45], [25, 44, 45], [25, 24, 44],
-                 [24, 43, 44], [23, 43, 24], [23, 42, 43], [22, 42, 23], [21, 22, 23], [20, 21, 23], [20, 39, 21],
-                 [20, 38, 39], [19, 38, 20], [19, 37, 38], [18, 37, 19], [18, 36, 37], [17, 36, 18], [0, 36, 17],
-                 [36, 41, 37], [36, 41, 40], [40, 38, 37], [38, 40, 39], [42, 47, 43], [43, 47, 44], [44, 47, 46],
-                 [44, 46, 45], [21, 39, 27], [27, 39, 28], [28, 39, 29], [29, 39, 31], [39, 40, 31], [40, 41, 31],
-                 [31, 41, 36], [31, 36, 48], [21, 27, 22], [22, 27, 42], [27, 28, 42], [28, 29, 42], [29, 35, 42],
-                 [35, 47, 42], [35, 46, 47], [35, 45, 46], [35, 54, 45], [29, 31, 30], [30, 31, 32], [30, 32, 33],
-                 [30, 33, 34], [30, 34, 35], [29, 30, 35], [31, 48, 49], [31, 49, 50], [31, 50, 32], [32, 50, 33],
-                 [33, 50, 51], [33, 51, 52], [33, 52, 34], [34, 52, 35], [35, 52, 53], [35, 53, 54], [48, 60, 49],
-                 [49, 61, 50], [50, 61, 51], [51, 61, 62], [51, 62, 63], [51, 63, 52], [52, 63, 53], [53, 64, 54],
-                 [49, 60, 59], [49, 59, 61], [49, 67, 61], [61, 67, 62], [62, 67, 66], [62, 66, 65], [62, 65, 63],
-                 [55, 63, 65], [53, 65, 55], [53, 55, 64], [58, 67, 59], [58, 66, 67], [57, 66, 58], [56, 66, 57],
-                 [56, 65, 66], [55, 65, 56]]
-    triangles = [ldks[triangle] for triangle in np.asarray(triangles)]
-    is_visible_args = [[ldk, triangles] for ldk in ldks]
-    with Pool() as pool:
-        visibility = pool.map(is_visible, is_visible_args)
-    return visibility
-
-
-def is_visible(is_visible_args):
-    point, triangles = is_visible_args
-    triangles_with_point, triangles_without_point = [], []
-    for tmp in triangles:
-        if point in tmp:
-            triangles_with_point.append(tmp)
-        else:
-            triangles_without_point.append(tmp)
-    # find one obscuring triangle in the mesh
-    for triangle in triangles_without_point:
-        # get orthogonal projection of point on the triangle plane
-        plane_norm = np.cross(triangle[1] - triangle[0], triangle[2] - triangle[0])
-        ndotu = plane_norm.dot(np.array([0, 0, 1]))
-        w = point - triangle[0]
-        pt_on_tri = w + (-plane_norm.dot(w) / ndotu) * np.array([0, 0, 1]) + triangle[0]
-        if point[2] > pt_on_tri[2]:
-            continue
-        # find if the projected point is within the triangle perimeter
-        area = np.linalg.norm(np.cross(triangle[1] - triangle[0], triangle[2] - triangle[0]))
-        area_0 = np.linalg.norm(np.cross(triangle[1] - pt_on_tri, triangle[2] - pt_on_tri))
-        area_1 = np.linalg.norm(np.cross(triangle[2] - pt_on_tri, triangle[0] - pt_on_tri))
-        area_2 = np.linalg.norm(np.cross(triangle[0] - pt_on_tri, triangle[1] - pt_on_tri))
-        area_diff = np.abs(area - np.sum([area_0, area_1, area_2]))
-        # if the sum of areas of the small triangles is different from the original area, with depth approx.
-        if area_diff < 1e-3:
-            return False
-    # find at least one non-back-facing triangle
-    for triangle in triangles_with_point:
-        norm = np.cross(triangle[1] - triangle[0], triangle[2] - triangle[0])
-        if np.arccos(norm[-1] / np.linalg.norm(norm)) > np.pi / 2:
-            return True
-    return False
+    return visibility(np.asarray(ldks)).tolist()
 
 
 def print_cloud_pt(art):
@@ -193,9 +113,10 @@ def load_preprocessed(path, test_fold, nb_augment=5):
 def process_3d_pred(artifact, covariance=None, raw_art=None):
     # artifact{'art_id': str, 'art_gt': np.array, 'imgs': list[image]}
     # image{'img_id': str, 'img_gt': np.array, 'img_ldk': np.array}
-    with open("./std_model.json") as f:
-        data = json.load(f)
-        std_model = np.asarray(data["std_model"])
+    std_model = get_std_model()
+    # align all the views of the artifact at once
+    if len(artifact['imgs']) > 0:
+        scales, rots, translations = umeyama_batch([image['img_ldk'] for image in artifact['imgs']], std_model)
     for image_index in range(len(artifact['imgs'])):
         image = artifact['imgs'][image_index]
         ldk = np.asarray(image['img_ldk'])
@@ -207,7 +128,7 @@ def process_3d_pred(artifact, covariance=None, raw_art=None):
         # _max = _x.max()
         # old_x = (_x / (2 * _max)) + .5
         # old_trans = [trans.tolist(), _mean.tolist(), _max]
-        transformation = umeyama(ldk, std_model)
+        transformation = scales[image_index], rots[image_index], translations[image_index]
         x = ldk.dot(transformation[0] * transformation[1]) + transformation[2]
         # fig = plt.figure()
         # ax = fig.add_subplot(111, projection='3d')
@@ -27,13 +27,12 @@ def main(args):
     if args.onnx:
         import os
         os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-        os.environ['OMP_NUM_THREADS'] = '4'
 
         from FaceBoxes.FaceBoxes_ONNX import FaceBoxes_ONNX
         from TDDFA_ONNX import TDDFA_ONNX
 
-        face_boxes = FaceBoxes_ONNX()
-        tddfa = TDDFA_ONNX(**cfg)
+        face_boxes = FaceBoxes_ONNX(num_threads=args.threads)
+        tddfa = TDDFA_ONNX(num_threads=args.threads, **cfg)
     else:
         gpu_mode = args.mode == 'gpu'
         tddfa = TDDFA(gpu_mode=gpu_mode, **cfg)
@@ -93,6 +92,7 @@ if __name__ == '__main__':
                         choices=['2d_sparse', '2d_dense', '3d', 'depth', 'pncc', 'uv_tex', 'pose', 'ply', 'obj'])
     parser.add_argument('--show_flag', type=str2bool, default='true', help='whether to show the visualization result')
     parser.add_argument('--onnx', action='store_true', default=False)
+    parser.add_argument('--threads', type=int, default=4, help='intra-op threads of the onnxruntime sessions')
 
     args = parser.parse_args()
     main(args)
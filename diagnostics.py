@@ -0,0 +1,156 @@
+import os
+import queue
+import numpy as np
+import multiprocessing as mp
+
+# kinds of products and the folder they are written to, relative to the products path
+FOLDERS = {'landmarks': '0_SingleViewAlign', 'attention': '1_Attention', 'normalized': '2_NormalizedPos',
+           'preprocess': '3_PreprocessConsensus', 'consensus': 'Prediction', 'eval_3d': 'Eval',
+           'eval_per_face': 'Eval', 'eval_errors': 'Eval', 'report': ''}
+CATEGORIES = ['all', 'jaw_line', 'mouth', 'nose', 'right_eye', 'right_eyebrow', 'left_eye', 'left_eyebrow']
+
+
+def _categorize(errors):
+    return [errors, errors[:17], errors[48:], errors[27:36], errors[36:42], errors[17:22], errors[42:48], errors[22:27]]
+
+
+def _figure(figures, key, **kwargs):
+    # one figure per key, cleared and reused across products instead of leaking a new one per call
+    import matplotlib.pyplot as plt
+    if key not in figures:
+        figures[key] = plt.figure(**kwargs)
+    else:
+        figures[key].clf()
+    return figures[key]
+
+
+def _alpha_colors(attention):
+    colors = np.zeros((len(attention), 4))
+    colors[:, 2] = 1
+    colors[:, 3] = np.clip(np.asarray(attention).reshape(-1), 0, 1)
+    return colors
+
+
+def _render_landmarks(figures, path, name, image, x):
+    fig = _figure(figures, 'landmarks')
+    ax = fig.add_subplot(111)
+    ax.imshow(image)
+    ax.scatter(x[:, 0], x[:, 1], c="red", s=5)
+    fig.savefig(os.path.join(path, name))
+
+
+def _render_cloud(figures, path, name, x, attention=None):
+    fig = _figure(figures, 'cloud')
+    ax = fig.add_subplot(111, projection='3d')
+    ax.scatter(x[:, 0], x[:, 1], x[:, 2], c='b' if attention is None else _alpha_colors(attention))
+    fig.savefig(os.path.join(path, name))
+
+
+def _render_eval_3d(figures, path, name, x, gt):
+    fig = _figure(figures, 'cloud')
+    ax = fig.add_subplot(111, projection='3d')
+    ax.scatter(x[:, 0], x[:, 1], x[:, 2], c='c')
+    ax.scatter(gt[:, 0], gt[:, 1], gt[:, 2], c='red')
+    fig.savefig(os.path.join(path, name + "_3D_cyan_pred_VS_red_gt"))
+
+
+def _render_eval_per_face(figures, path, name, preds, gts, **images):
+    nb_img = len(preds)
+    size = int(np.sqrt(nb_img)) + 1
+    nb_line = size - 1 if (nb_img <= size * size - size) else size
+    fig = _figure(figures, 'grid', figsize=(25, 25))
+    axs = fig.subplots(nb_line, size, squeeze=False)
+    for id in range(nb_img):
+        ax = axs[id // size, id % size]
+        ax.imshow(images['image_' + str(id)])
+        ax.scatter(preds[id][:, 0], preds[id][:, 1], c="c", s=10)
+        ax.scatter(gts[id][:, 0], gts[id][:, 1], c="r", s=10)
+    fig.savefig(os.path.join(path, name + "_2D_cyan_pred_VS_red_gt"))
+
+
+def _render_eval_errors(figures, path, name, errors):
+    fig = _figure(figures, 'errors')
+    ax = fig.add_subplot(111)
+    ax.bar(CATEGORIES, [np.sum(error) for error in _categorize(errors)])
+    fig.savefig(os.path.join(path, name + "_error_per_category"))
+    fig.clf()
+    ax = fig.add_subplot(111)
+    ax.boxplot(_categorize(errors))
+    ax.set_xticks(range(1, len(CATEGORIES) + 1))
+    ax.set_xticklabels(CATEGORIES)
+    fig.savefig(os.path.join(path, name + "_error_dispersion"))
+
+
+def _render_report(figures, path, name, full, image, pred, gt):
+    import matplotlib.pyplot as plt
+    plt.imsave(os.path.join(path, "full.png"), full)
+    for cloud, file_name in ((pred, "pred"), (gt, "gt")):
+        fig = _figure(figures, 'report')
+        ax = fig.add_subplot(111)
+        ax.imshow(image)
+        ax.scatter(cloud[:, 0], cloud[:, 1], c="r", s=15)
+        fig.savefig(os.path.join(path, file_name))
+
+
+RENDERERS = {'landmarks': _render_landmarks, 'attention': _render_cloud, 'normalized': _render_cloud,
+             'preprocess': _render_cloud, 'consensus': _render_cloud, 'eval_3d': _render_eval_3d,
+             'eval_per_face': _render_eval_per_face, 'eval_errors': _render_eval_errors, 'report': _render_report}
+
+
+def _worker(products_queue, path_products, mode):
+    if mode == 'png':
+        import matplotlib
+        matplotlib.use('Agg')
+    figures = {}
+    while True:
+        item = products_queue.get()
+        if item is None:
+            break
+        kind, folder, name, arrays = item
+        try:
+            path = os.path.join(path_products, FOLDERS[kind] if folder is None else folder)
+            os.makedirs(path, exist_ok=True)
+            if mode == 'raw':
+                np.savez_compressed(os.path.join(path, name + '_' + kind + '.npz'), **arrays)
+            else:
+                RENDERERS[kind](figures, path, name, **arrays)
+        except Exception as e:
+            print("WARNING: could not write", kind, "product", name, ":", e)
+
+
+class DiagnosticsWriter:
+    """Writes the pipeline products from a separate process, fed by a bounded queue"""
+
+    def __init__(self, path_products, mode='png', max_queue=32):
+        if mode not in ('png', 'raw'):
+            raise ValueError(f'Unknown diagnostics mode {mode}')
+        self.path_products = path_products
+        self.mode = mode
+        # spawn rather than fork, the parent holds ONNX sessions and their thread pools
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=max_queue)
+        self.process = ctx.Process(target=_worker, args=(self.queue, path_products, mode), daemon=True)
+        self.process.start()
+
+    def submit(self, kind, name, folder=None, **arrays):
+        """
+        Queue a product, blocking while the queue is full so that memory stays bounded.
+        :param kind: one of FOLDERS keys
+        :param name: file name, without extension
+        :param folder: overrides the default folder of the kind
+        :param arrays: arrays needed to render the product, or saved as is in raw mode
+        """
+        assert kind in RENDERERS, kind
+        item = (kind, folder, name, {key: np.asarray(val) for key, val in arrays.items()})
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self.process.is_alive():
+                    raise RuntimeError("diagnostics worker died")
+
+    def close(self):
+        if self.process.is_alive():
+            self.queue.put(None)
+            self.process.join()
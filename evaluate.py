@@ -40,8 +40,7 @@ def evaluate_buddha():
     ds = load_ds('data')
     cfg = yaml.load(open('configs/mb1_120x120.yml'), Loader=yaml.SafeLoader)
     os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-    os.environ['OMP_NUM_THREADS'] = '4'
-    tddfa = TDDFA_ONNX(**cfg)
+    tddfa = TDDFA_ONNX(num_threads=4, **cfg)
     error_ds = []
     for artifact_id in ds:
         errors_artifact = []
@@ -66,9 +65,8 @@ def evaluate_Blender():
     ds = load_model_ds('BlenderFiles/model_frames')
     cfg = yaml.load(open('configs/mb1_120x120.yml'), Loader=yaml.SafeLoader)
     os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-    os.environ['OMP_NUM_THREADS'] = '4'
-    tddfa = TDDFA_ONNX(**cfg)
-    face_boxes = FaceBoxes_ONNX()
+    tddfa = TDDFA_ONNX(num_threads=4, **cfg)
+    face_boxes = FaceBoxes_ONNX(num_threads=4)
     for artifact_id in ds:
         for img, id in zip(ds[artifact_id]['img'], ds[artifact_id]['ids']):
             wfp = f'examples/results/' + artifact_id + '_' + str(id) + '_2d_sparse.jpg'
@@ -0,0 +1,72 @@
+"""
+Disk cache of the frozen backbone outputs of HeteroFramework, one small .npy file per picture in
+<folder>/<key[:2]>/<key>.npy rather than one memory-mapped array: the ranks of a distributed training fill the same
+folder without any lock or coordination, each entry being written to a temporary file then renamed in place, and a
+crash never leaves a partial or inconsistent cache behind.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+def content_hash(image, bbox):
+    # pixels, shape and box of a picture, the same picture under another name hits the same entry
+    sha1 = hashlib.sha1()
+    image = np.ascontiguousarray(image)
+    sha1.update(str(image.shape).encode())
+    sha1.update(image.data)
+    sha1.update(np.asarray(bbox, dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+def file_checksum(paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FeatureCache:
+    """
+    Outputs of a frozen backbone per picture: 62-d parameters and roi box, see the module docstring for the layout. A
+    cache must only be used with the checkpoint it was filled with, see file_checksum.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        # entries already read or written by this process
+        self.entries = {}
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return key in self.entries or os.path.exists(self._path(key))
+
+    def get(self, key):
+        """
+        :return: the parameters and roi box of key, or None if it is not cached
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            try:
+                row = np.load(self._path(key))
+            except (FileNotFoundError, ValueError):
+                return None
+            entry = self.entries[key] = (row[:-4].astype(np.float32), row[-4:])
+        return entry
+
+    def put(self, key, params, box):
+        row = np.concatenate((np.asarray(params, dtype=np.float64).ravel(), np.asarray(box, dtype=np.float64).ravel()))
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # another process writing the same entry writes the same values, the last rename wins
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, row)
+        os.replace(tmp_path, path)
+        self.entries[key] = (row[:-4].astype(np.float32), row[-4:])
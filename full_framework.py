@@ -1,12 +1,16 @@
 from buddha_dataset import BuddhaDataset, Config, Artifact, Image
-from torchvision.transforms import Compose
+from torch.utils.data import Dataset, DataLoader
+from image_store import ImageStore
 from models.mobilenet_v1 import mobilenet
 from matplotlib.patches import Rectangle
 from torch_geometric import nn as g_nn
+from graph_net import Loss3D, Loss2D, Loss_fn
+from feature_cache import FeatureCache, content_hash, file_checksum
 import matplotlib.pyplot as plt
 from bfm import BFMModel
 import os.path as osp
 from torch import nn
+from functools import lru_cache
 import numpy as np
 import os.path
 import pickle
@@ -17,32 +21,84 @@ import cv2
 make_abs_path = lambda fn: osp.join(osp.dirname(osp.realpath(__file__)), fn)
 
 
-def get_dataset(split=0.8):
-    inputs_name = 'numpy_dataset.pkl'
-    if inputs_name not in os.listdir('.'):
-        art_ds = BuddhaDataset(Config('conf.json'))
-        art_ds.load()
-        art_ds = art_ds.artifacts
-        inputs = []
-        for art in art_ds:
-            artifact = [[], [], []]
-            for img in art.pictures:
-                artifact[0].append(img.data)
-                artifact[1].append(img.bbox)
-                artifact[2].append(img.precomputed_gt)
-            inputs.append(artifact)
-        with open(inputs_name, 'wb') as f:
-            pickle.dump(inputs, f)
-    else:
-        with open(inputs_name, 'rb') as f:
-            inputs = pickle.load(f)
-    nb_art = len(inputs)
+class ArtifactDataset(Dataset):
+    """
+    Artifacts of the image store, read from disk when accessed. With with_crops, the 120x120 crops of all the views of
+    an artifact are prepared by the loader workers, so that data preparation overlaps with the model. Without, only
+    the views missing from the feature cache are cropped, see images.
+    """
+
+    def __init__(self, store_folder, selection, keys, with_crops=True, with_images=False):
+        """
+        :param keys: feature cache keys of all the pictures of the store, see ImageStore.image_keys
+        """
+        self.store_folder = store_folder
+        self.selection = np.asarray(selection)
+        self.keys = keys
+        self.with_crops = with_crops
+        self.with_images = with_images
+        # opened in each worker, memory maps are not shared across processes
+        self.store = None
+
+    def __len__(self):
+        return len(self.selection)
+
+    def _store(self):
+        if self.store is None:
+            self.store = ImageStore(self.store_folder)
+        return self.store
+
+    def images(self, item):
+        """
+        :return: the pictures of an item, memory-mapped in this process, pixels are only read when accessed
+        """
+        store = self._store()
+        return [store.image_data(item['art_index'], img_index) for img_index in store.image_range(item['art_index'])]
+
+    def __getitem__(self, index):
+        store = self._store()
+        art_index = int(self.selection[index])
+        images = store.image_range(art_index)
+        bboxes = np.array(store.index['img_bbox'][images.start:images.stop])
+        item = {'id': str(store.index['art_id'][art_index]), 'art_index': art_index,
+                'bboxes': torch.from_numpy(bboxes),
+                'gts': torch.from_numpy(np.array(store.index['img_precomputed_gt'][images.start:images.stop])),
+                'keys': self.keys[images.start:images.stop]}
+        if self.with_crops or self.with_images:
+            pictures = self.images(item)
+            if self.with_crops:
+                item['crops'] = torch.from_numpy(prepare_crops(pictures, bboxes)[0])
+            if self.with_images:
+                item['images'] = [np.array(image) for image in pictures]
+        return item
+
+
+def collate_artifacts(items):
+    # artifacts have different numbers of views, a batch is the list of its artifacts
+    return items
+
+
+def get_dataset(split=0.8, with_crops=True, with_images=False):
+    art_ds = BuddhaDataset(Config('conf.json'))
+    art_ds.load()
+    selection = np.asarray(art_ds.artifacts.selection)
     np.random.seed(0)
-    np.random.shuffle(inputs)
-    nb_train = int(nb_art * split)
-    train_inputs = inputs[:nb_train]
-    test_inputs = inputs[nb_train:]
-    return train_inputs, test_inputs
+    np.random.shuffle(selection)
+    nb_train = int(len(selection) * split)
+    # computed once from the index and the manifest, no pixel is read
+    keys = art_ds.store.image_keys(art_ds.manifest())
+    train_ds = ArtifactDataset(art_ds.tmp_folder, selection[:nb_train], keys, with_crops, with_images)
+    test_ds = ArtifactDataset(art_ds.tmp_folder, selection[nb_train:], keys, with_crops, with_images)
+    return train_ds, test_ds
+
+
+def get_loader(dataset, batch_size=1, shuffle=False, workers=4, pin_memory=False, sampler=None):
+    """
+    :return: a DataLoader prefetching batches of artifacts in workers processes
+    """
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                      num_workers=workers, collate_fn=collate_artifacts, pin_memory=pin_memory,
+                      persistent_workers=workers > 0, prefetch_factor=2 if workers > 0 else None)
 
 
 def crop_img(img, roi_box):
@@ -109,24 +165,15 @@ def parse_roi_box_from_bbox(bbox):
     return roi_box
 
 
-class ToTensorGjz(object):
-    def __call__(self, pic):
-        if isinstance(pic, np.ndarray):
-            img = torch.from_numpy(pic.transpose((2, 0, 1)))
-            return img.float()
-
-    def __repr__(self):
-        return self.__class__.__name__ + '()'
-
-
-class NormalizeGjz(object):
-    def __init__(self, mean, std):
-        self.mean = mean
-        self.std = std
-
-    def __call__(self, tensor):
-        tensor.sub_(self.mean).div_(self.std)
-        return tensor
+def prepare_crops(images, bboxes):
+    """
+    :return: the normalized 120x120 crops of the views, of shape (V, 3, 120, 120), and their roi boxes
+    """
+    list_bbox = [parse_roi_box_from_bbox(bbox) for bbox in bboxes]
+    crops = np.stack([cv2.resize(crop_img(image, roi_box), dsize=(120, 120), interpolation=cv2.INTER_LINEAR)
+                      for image, roi_box in zip(images, list_bbox)])
+    crops = (crops.transpose((0, 3, 1, 2)).astype(np.float32) - 127.5) / 128
+    return crops, list_bbox
 
 
 def reshape_fortran(x, shape):
@@ -152,34 +199,24 @@ def similar_transform(pts3d, roi_box, size):
 
 
 def edges_for_n_images(n):
+    """
+    Heterogeneous edges of an artifact with n images (plus the consensus node): the shape and expression nodes are
+    fully connected among themselves, every other relation links each node to its counterpart only.
+    :return: edge type -> array of shape (2, E)
+    """
     nb_nodes = n + 1
-    Sr = np.zeros([nb_nodes, nb_nodes])
-    Ss = np.ones([nb_nodes, nb_nodes])
-    Se = np.zeros([nb_nodes, nb_nodes])
-    Er = np.zeros([nb_nodes, nb_nodes])
-    Es = np.zeros([nb_nodes, nb_nodes])
-    Ee = np.ones([nb_nodes, nb_nodes])
-    for i in range(nb_nodes):
-        Sr[i, i] = 1
-        Se[i, i] = 1
-        Er[i, i] = 1
-        Es[i, i] = 1
-    edges_Sr = np.array(np.where(Sr == 1))
-    edges_Ss = np.array(np.where(Ss == 1))
-    edges_Se = np.array(np.where(Se == 1))
-    edges_Er = np.array(np.where(Er == 1))
-    edges_Es = np.array(np.where(Es == 1))
-    edges_Ee = np.array(np.where(Ee == 1))
-    edges_Sr = torch.as_tensor(edges_Sr, dtype=torch.long).cuda()
-    edges_Ss = torch.as_tensor(edges_Ss, dtype=torch.long).cuda()
-    edges_Se = torch.as_tensor(edges_Se, dtype=torch.long).cuda()
-    edges_Er = torch.as_tensor(edges_Er, dtype=torch.long).cuda()
-    edges_Es = torch.as_tensor(edges_Es, dtype=torch.long).cuda()
-    edges_Ee = torch.as_tensor(edges_Ee, dtype=torch.long).cuda()
-
-    dict_edges = {('S', 'Sr', 'R'): edges_Sr, ('S', 'Ss', 'S'): edges_Ss, ('S', 'Se', 'E'): edges_Se,
-                      ('E', 'Er', 'R'): edges_Er, ('E', 'Es', 'S'): edges_Es, ('E', 'Ee', 'E'): edges_Ee}
-    return dict_edges
+    nodes = np.arange(nb_nodes)
+    self_loops = np.stack((nodes, nodes))
+    complete = np.stack((np.repeat(nodes, nb_nodes), np.tile(nodes, nb_nodes)))
+    return {('S', 'Sr', 'R'): self_loops, ('S', 'Ss', 'S'): complete, ('S', 'Se', 'E'): self_loops,
+            ('E', 'Er', 'R'): self_loops, ('E', 'Es', 'S'): self_loops, ('E', 'Ee', 'E'): complete}
+
+
+@lru_cache(maxsize=None)
+def edge_index_dict_for(n, device):
+    # one template per view count and device, shared by every forward, must not be modified in place
+    return {key: torch.as_tensor(edges, dtype=torch.long, device=device)
+            for key, edges in edges_for_n_images(n).items()}
 
 
 def load_model(model, checkpoint_fp):
@@ -197,67 +234,21 @@ def load_model(model, checkpoint_fp):
     return model
 
 
-class Loss3D(nn.Module):
-    def __call__(self, points_x, points_y):
-        loss = 0
-        points_y = points_y[:68]
-        for x, y, in zip(points_x, points_y):
-            loss += torch.sqrt((y[0] - x[0]) ** 2 + (y[1] - x[1]) ** 2 + (y[2] - x[2]) ** 2)
-        return loss
-
-
-class Loss2D(nn.Module):
-    def __call__(self, points_x, points_y):
-        loss = 0
-        points_y = points_y[68:]
-        for id_view in range(len(points_y)//68):
-            pt_y = points_y[id_view*68:(id_view+1)*68]
-            scale, rotation, translation = pt_y[0, 2], pt_y[0, 3:12].reshape((3, 3)), pt_y[0, 12:]
-            pt_y = pt_y[:, :2]
-            x_proj = (points_x - translation)
-            tmp = torch.linalg.inv(scale * rotation)
-            x_proj = torch.matmul(x_proj, tmp)
-            x_proj = x_proj[:, :2]
-            loss_view = 0
-            count_visible = 0
-            for x, y, in zip(x_proj, pt_y):
-                if y[0] >= 0 or y[1] >= 0:
-                    count_visible += 1
-                    loss_view += torch.sqrt((y[0] - x[0]) ** 2 + (y[1] - x[1]) ** 2)
-            loss += loss_view / count_visible
-        loss = loss / (len(points_y)//68)
-        return loss / (len(points_y)//68)
-
-
-class Loss_fn(nn.Module):
-    def __init__(self, enable_2d, weight_2d=0.5):
-        super().__init__()
-        self.loss3D = Loss3D()
-        self.loss2D = Loss2D()
-        self.enable_2d = enable_2d
-        self.weight_3d = 1 - weight_2d
-        self.weight_2d = weight_2d
-
-    def __call__(self, x, y):
-        if self.enable_2d:
-            return self.weight_3d*self.loss3D(x, y) + self.weight_2d*self.loss2D(x, y)
-        else:
-            return self.loss3D(x, y)
-
-
 class HeteroFramework(nn.Module):
     def __init__(self, num_graph_steps, train_tddfa=False, train_graph=True, cuda=True):
         super().__init__()
         torch.set_grad_enabled(True)
         self.train_tddfa = train_tddfa
         self.train_graph = train_graph
+        self.checkpoint_fp = 'weights/mb1_120x120.pth'
+        self.param_mean_std_fp = make_abs_path('configs/param_mean_std_62d_120x120.pkl')
         self.tddfa = mobilenet(num_classes=62, widen_factor=1, size=120, mode='small')
-        self.tddfa = load_model(self.tddfa, 'weights/mb1_120x120.pth')
+        self.tddfa = load_model(self.tddfa, self.checkpoint_fp)
         self.tddfa.eval()
-        self.transform = Compose([ToTensorGjz(), NormalizeGjz(mean=127.5, std=128)])
-        r = pickle.load(open(make_abs_path('configs/param_mean_std_62d_120x120.pkl'), 'rb'))
-        self.param_mean = torch.from_numpy(r.get('mean')).cuda()
-        self.param_std = torch.from_numpy(r.get('std')).cuda()
+        r = pickle.load(open(self.param_mean_std_fp, 'rb'))
+        # constants follow the module with .to(device), they are not part of the checkpoints
+        self.register_buffer('param_mean', torch.from_numpy(r.get('mean')), persistent=False)
+        self.register_buffer('param_std', torch.from_numpy(r.get('std')), persistent=False)
 
         self.graph = torch.nn.ModuleList()
         self.dummy_graph = False
@@ -273,16 +264,18 @@ class HeteroFramework(nn.Module):
             self.graph.append(conv)
 
         bfm = BFMModel(bfm_fp=make_abs_path('configs/bfm_noneck_v3.pkl'), shape_dim=40, exp_dim=10)
-        self.u_base = torch.from_numpy(bfm.u_base).cuda()
-        self.w_shp_base = torch.from_numpy(bfm.w_shp_base).cuda()
-        self.w_exp_base = torch.from_numpy(bfm.w_exp_base).cuda()
+        self.register_buffer('u_base', torch.from_numpy(bfm.u_base), persistent=False)
+        self.register_buffer('w_shp_base', torch.from_numpy(bfm.w_shp_base), persistent=False)
+        self.register_buffer('w_exp_base', torch.from_numpy(bfm.w_exp_base), persistent=False)
+
+        # outputs of the frozen backbone, see enable_feature_cache
+        self.feature_cache = None
 
         if cuda:
             self.to_cuda()
 
     def to_cuda(self):
-        self.tddfa.cuda()
-        self.graph.cuda()
+        self.cuda()
 
     def convert_pred(self, base, lin_trans, bboxes):
         images_pts = None
@@ -299,22 +292,75 @@ class HeteroFramework(nn.Module):
         poits_3d = reverse_similar_transform(images_pts.T, bboxes, 120)
 
 
-    def forward(self, images, bboxes):
-        vects = {'R':torch.zeros((1, 12)).cuda(), 'S':torch.zeros((1, 40)).cuda(), 'E':torch.zeros((1, 10)).cuda()}
-        list_bbox = []
-        for image, bbox in zip(images, bboxes):
-            roi_box = parse_roi_box_from_bbox(bbox)
-            list_bbox.append(roi_box)
-            img = crop_img(image, roi_box)
-            img = cv2.resize(img, dsize=(120, 120), interpolation=cv2.INTER_LINEAR)
-            inp = self.transform(img).unsqueeze(0).cuda()
-            param = self.tddfa(inp)
-            param = param.squeeze() * self.param_std + self.param_mean
-            vects['R'] = torch.cat((vects['R'], param[:12].unsqueeze(0)), dim=0)
-            vects['S'] = torch.cat((vects['S'], param[12:52].unsqueeze(0)), dim=0)
-            vects['E'] = torch.cat((vects['E'], param[52:].unsqueeze(0)), dim=0)
-
-        edge_index_dict = edges_for_n_images(len(images))
+    def train(self, mode=True):
+        super().train(mode)
+        # a frozen backbone keeps its batch norm statistics
+        if not self.train_tddfa:
+            self.tddfa.eval()
+        return self
+
+    def preprocess(self, images, bboxes):
+        """
+        :return: the normalized 120x120 crops of all the views, of shape (V, 3, 120, 120), and their roi boxes
+        """
+        crops, list_bbox = prepare_crops(images, bboxes)
+        return torch.from_numpy(crops).to(self.param_mean.device), list_bbox
+
+    def enable_feature_cache(self, folder):
+        """
+        Read the outputs of the frozen backbone from a cache instead of running it, the cache of a checkpoint being
+        in its own sub-folder. All the processes of a training can share the folder.
+        """
+        checksum = file_checksum([self.checkpoint_fp, self.param_mean_std_fp])
+        self.feature_cache = FeatureCache(os.path.join(folder, checksum))
+
+    def run_backbone(self, inp):
+        """
+        :return: the de-normalized 62-d parameters of all the views, of shape (V, 62)
+        """
+        # one backbone pass for all the views
+        with torch.set_grad_enabled(self.train_tddfa and torch.is_grad_enabled()):
+            return self.tddfa(inp.to(self.param_mean.device)) * self.param_std + self.param_mean
+
+    def backbone_params(self, nb_views, prepare, keys=None):
+        """
+        :param prepare: returns the crops and roi boxes of the views at the given indexes
+        :param keys: feature cache keys of the views, the feature cache is only used if given
+        :return: the parameters of all the views and their roi boxes
+        """
+        if keys is None or self.feature_cache is None or self.train_tddfa:
+            inp, list_bbox = prepare(list(range(nb_views)))
+            return self.run_backbone(inp), list_bbox
+        cached = [self.feature_cache.get(key) for key in keys]
+        missing = [id for id, entry in enumerate(cached) if entry is None]
+        if len(missing) > 0:
+            inp, list_bbox = prepare(missing)
+            param = self.run_backbone(inp)
+            for id, param_img, roi_box in zip(missing, param.detach().cpu().numpy(), list_bbox):
+                self.feature_cache.put(keys[id], param_img, roi_box)
+                cached[id] = (param_img, np.asarray(roi_box))
+        param = torch.from_numpy(np.stack([entry[0] for entry in cached])).to(self.param_mean.device)
+        return param, [entry[1].tolist() for entry in cached]
+
+    def forward(self, images, bboxes, crops=None, keys=None):
+        """
+        :param crops: crops prepared by ArtifactDataset, else the views missing from the feature cache are prepared
+        from images
+        :param keys: feature cache keys of the views, content hashes of images if None and the feature cache is enabled
+        """
+        if crops is not None:
+            roi_boxes = [parse_roi_box_from_bbox(bbox) for bbox in bboxes]
+            prepare = lambda ids: (crops[ids], [roi_boxes[id] for id in ids])
+        else:
+            prepare = lambda ids: self.preprocess([images[id] for id in ids], [bboxes[id] for id in ids])
+            if keys is None and self.feature_cache is not None:
+                keys = [content_hash(image, bbox) for image, bbox in zip(images, bboxes)]
+        param, list_bbox = self.backbone_params(len(bboxes), prepare, keys)
+        zeros = torch.zeros((1, param.shape[1]), dtype=param.dtype, device=param.device)
+        param = torch.cat((zeros, param), dim=0)
+        vects = {'R': param[:, :12], 'S': param[:, 12:52], 'E': param[:, 52:]}
+
+        edge_index_dict = edge_index_dict_for(len(bboxes), vects['R'].device)
         vects_R_save = vects['R']
         for conv in self.graph:
             vects = conv(vects, edge_index_dict)
@@ -326,12 +372,15 @@ class HeteroFramework(nn.Module):
 
 
 if __name__ == '__main__':
-    train_ds, test_ds = get_dataset()
+    train_ds, test_ds = get_dataset(with_images=True)
     framework = HeteroFramework(num_graph_steps=3)
-    for images, bboxes, gts in test_ds[:1]:
-        base, lin_trans, new_bboxes = framework(images, bboxes)
+    for art in get_loader(test_ds, workers=0):
+        art = art[0]
+        images, bboxes, gts = art['images'], art['bboxes'].numpy(), art['gts'].numpy()
+        base, lin_trans, new_bboxes = framework(images, bboxes, art['crops'], art['keys'])
         images_points = framework.convert_pred(base, lin_trans, new_bboxes)
         for img, bbox, pts in zip(images, new_bboxes, images_points):
             points_on_image(img, bbox, pts)
         for img, bbox, pts in zip(images, bboxes, gts):
-            points_on_image(img, bbox, torch.from_numpy(pts).cuda())
+            points_on_image(img, bbox, torch.from_numpy(pts))
+        break
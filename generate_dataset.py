@@ -9,7 +9,8 @@ import matplotlib.pyplot as plt
 import copy
 import yaml
 from TDDFA import TDDFA
-from buddha_dataset import BuddhaDataset, Artifact, Image, Config, crop_pict, get_transform
+from buddha_dataset import BuddhaDataset, Artifact, Image, Config, crop_pict
+from alignment import normalize_position_batch
 from mpl_toolkits.mplot3d import Axes3D
 import face_alignment
 from skimage import io
@@ -107,20 +108,6 @@ def process_art(fold_id, art, augment=True):
     return art_gts
 
 
-def normalize_position(input):
-    with open("./std_model.json") as f:
-        data = json.load(f)
-        std_model = np.asarray(data["std_model"])
-    trans = get_transform(std_model, input)
-    tmp = np.asarray(input.T.tolist() + [list([1] * 68)])
-    x = (tmp.T @ trans).T[:3].T
-    _mean = np.mean(x, axis=0)
-    _x = x - _mean
-    _max = _x.max()
-    x = (_x / (2 * _max)) + .5
-    return [trans, _mean, _max], x
-
-
 def make_cropped_and_3d_gt(dataset_name, nb_aug=5):
     with open('/'.join([dataset_name, 'folds_info.json'])) as file:
         folds = json.load(file)
@@ -129,13 +116,13 @@ def make_cropped_and_3d_gt(dataset_name, nb_aug=5):
     ds = BuddhaDataset(Config('conf.json'))
     ds.load()
     ds = ds.artifacts
+    # normalize the ground truth of the whole dataset in one call
+    _, _, _, gts3d = normalize_position_batch([art.gt for art in ds])
 
     for fold_id in fold_ids:
         fold_json = {}
-        for art in ds:
+        for art, gt3d in zip(ds, gts3d):
             if art.id in folds[fold_id]:
-                gt3d = art.gt
-                _, gt3d = normalize_position(gt3d)
                 tmp_art = copy.deepcopy(art)
                 tmp_art.id = art.id + '_aug0'
                 img_gt2d = process_art(fold_id, tmp_art, augment=False)
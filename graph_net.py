@@ -1,105 +1,212 @@
 import torch
 import pickle
 import numpy as np
+from functools import lru_cache
 from torch import nn
 import matplotlib.pyplot as plt
 from torch_geometric.data import Data
 from mpl_toolkits.mplot3d import Axes3D
 from torch_geometric import nn as g_nn
 from torch_geometric.loader import DataLoader
+from torch.utils.data import Sampler
+
+
+def _graph_layout(points_y, batch=None):
+    """
+    Graph of every row of points_y and position of the row within its graph, the first 68 rows of a graph being
+    the consensus and the following ones its views.
+    :param batch: graph index of every row, as in torch_geometric batches, a single graph if None
+    """
+    if batch is None:
+        batch = torch.zeros(len(points_y), dtype=torch.long, device=points_y.device)
+    counts = torch.bincount(batch)
+    starts = torch.cumsum(counts, 0) - counts
+    position = torch.arange(len(points_y), device=points_y.device) - starts[batch]
+    return batch, position, len(counts)
+
+
+def _reduce(losses, reduction):
+    return losses.mean() if reduction == 'mean' else losses.sum() if reduction == 'sum' else losses
 
 
 class Loss3D(nn.Module):
-    def __call__(self, points_x, points_y):
-        loss = 0
-        points_y = points_y[:68]
-        for x, y, in zip(points_x, points_y):
-            loss += torch.sqrt((y[0] - x[0]) ** 2 + (y[1] - x[1]) ** 2 + (y[2] - x[2]) ** 2)
-        return loss
+    def __init__(self, nodes_per_view=68, reduction='mean'):
+        super().__init__()
+        self.nodes_per_view = nodes_per_view
+        self.reduction = reduction
+
+    def __call__(self, points_x, points_y, batch=None):
+        """
+        Sum of the distances between the predicted and ground truth consensus points, per graph.
+        :param points_x: predictions of shape (B * 68, 3) or (B, 68, 3)
+        :param points_y: targets of the B graphs, consensus rows first in each graph
+        """
+        batch, position, nb_graphs = _graph_layout(points_y, batch)
+        points_y = points_y[position < self.nodes_per_view, :3].reshape((nb_graphs, self.nodes_per_view, 3))
+        points_x = points_x[..., :3].reshape((nb_graphs, self.nodes_per_view, 3))
+        losses = torch.sqrt(((points_y - points_x) ** 2).sum(dim=-1)).sum(dim=-1)
+        return _reduce(losses, self.reduction)
 
 
 class Loss2D(nn.Module):
-    def __call__(self, points_x, points_y):
-        loss = 0
-        points_y = points_y[68:]
-        for id_view in range(len(points_y)//68):
-            pt_y = points_y[id_view*68:(id_view+1)*68]
-            scale, rotation, translation = pt_y[0, 2], pt_y[0, 3:12].reshape((3, 3)), pt_y[0, 12:]
-            pt_y = pt_y[:, :2]
-            x_proj = (points_x - translation)
-            tmp = torch.linalg.inv(scale * rotation)
-            x_proj = torch.matmul(x_proj, tmp)
-            x_proj = x_proj[:, :2]
-            loss_view = 0
-            count_visible = 0
-            for x, y, in zip(x_proj, pt_y):
-                if y[0] >= 0 or y[1] >= 0:
-                    count_visible += 1
-                    loss_view += torch.sqrt((y[0] - x[0]) ** 2 + (y[1] - x[1]) ** 2)
-            loss += loss_view / count_visible
-        loss = loss / (len(points_y)//68)
-        return loss / (len(points_y)//68)
+    def __init__(self, nodes_per_view=68, reduction='mean'):
+        super().__init__()
+        self.nodes_per_view = nodes_per_view
+        self.reduction = reduction
+
+    def __call__(self, points_x, points_y, batch=None):
+        """
+        Mean distance between the reprojection of the predicted points in every view and the visible annotations.
+        The views of all the graphs are reprojected at once.
+        :param points_x: predictions of shape (B * 68, 3) or (B, 68, 3)
+        :param points_y: targets of the B graphs, consensus rows first in each graph
+        """
+        n = self.nodes_per_view
+        batch, position, nb_graphs = _graph_layout(points_y, batch)
+        is_view = position >= n
+        points_y = points_y[is_view].reshape((-1, n, points_y.shape[-1]))
+        view_graph = batch[is_view][::n]
+        nb_views = torch.bincount(view_graph, minlength=nb_graphs).to(points_y.dtype)
+        scale, rotation, translation = points_y[:, 0, 2], points_y[:, 0, 3:12].reshape((-1, 3, 3)), points_y[:, 0, 12:]
+        pt_y = points_y[..., :2]
+        points_x = points_x[..., :3].reshape((nb_graphs, n, 3))[view_graph]
+        x_proj = torch.matmul(points_x - translation[:, None], torch.linalg.inv(scale[:, None, None] * rotation))
+        x_proj = x_proj[..., :2]
+        visible = (pt_y[..., 0] >= 0) | (pt_y[..., 1] >= 0)
+        squared = ((pt_y - x_proj) ** 2).sum(dim=-1)
+        # hidden points are kept out of the sqrt, its gradient is not defined at 0
+        distances = torch.where(visible, torch.sqrt(torch.where(visible, squared, torch.ones_like(squared))),
+                                torch.zeros_like(squared))
+        loss_views = distances.sum(dim=-1) / visible.sum(dim=-1)
+        losses = torch.zeros(nb_graphs, dtype=loss_views.dtype, device=loss_views.device)
+        losses = losses.index_add(0, view_graph, loss_views)
+        # normalized twice by the number of views, as the per view implementation did
+        losses = losses / nb_views / nb_views
+        return _reduce(losses, self.reduction)
 
 
 class Loss_fn(nn.Module):
-    def __init__(self, enable_2d, weight_2d=0.5):
+    def __init__(self, enable_2d, weight_2d=0.5, reduction='mean'):
         super().__init__()
-        self.loss3D = Loss3D()
-        self.loss2D = Loss2D()
+        self.loss3D = Loss3D(reduction=reduction)
+        self.loss2D = Loss2D(reduction=reduction)
         self.enable_2d = enable_2d
         self.weight_3d = 1 - weight_2d
         self.weight_2d = weight_2d
 
-    def __call__(self, x, y):
+    def __call__(self, x, y, batch=None):
         if self.enable_2d:
-            return self.weight_3d*self.loss3D(x, y) + self.weight_2d*self.loss2D(x, y)
+            return self.weight_3d*self.loss3D(x, y, batch) + self.weight_2d*self.loss2D(x, y, batch)
         else:
-            return self.loss3D(x, y)
+            return self.loss3D(x, y, batch)
+
+
+# landmark groups of a view, only the points of a same group are connected within a view
+GROUPS = [np.arange(0, 17), np.arange(48, 68), np.arange(27, 36), np.arange(36, 42), np.arange(17, 22),
+          np.arange(42, 48), np.arange(22, 27)]
+
+
+def _group_mask(groups=GROUPS, nodes_per_view=68):
+    group_of = np.zeros(nodes_per_view, dtype=np.int64)
+    for id_group, group in enumerate(groups):
+        group_of[group] = id_group
+    return group_of[:, np.newaxis] == group_of[np.newaxis, :]
+
+
+GROUP_MASK = _group_mask()
+
+
+def build_edges(nb_views, group_mask=GROUP_MASK):
+    """
+    Edges of an artifact graph: points of a same group within a view, and homologue points across views.
+    :param nb_views: number of views, the consensus included
+    :return: array of shape (2, E), sorted by source then target node
+    """
+    nodes_per_view = len(group_mask)
+    views = np.arange(nb_views) * nodes_per_view
+    intra_src, intra_dst = np.nonzero(group_mask)
+    intra_src = (views[:, np.newaxis] + intra_src).reshape(-1)
+    intra_dst = (views[:, np.newaxis] + intra_dst).reshape(-1)
+    # pairs of distinct views, for every point
+    view_a, view_b = np.nonzero(~np.eye(nb_views, dtype=bool))
+    points = np.arange(nodes_per_view)
+    cross_src = (views[view_a][:, np.newaxis] + points).reshape(-1)
+    cross_dst = (views[view_b][:, np.newaxis] + points).reshape(-1)
+    src = np.concatenate((intra_src, cross_src))
+    dst = np.concatenate((intra_dst, cross_dst))
+    order = np.lexsort((dst, src))
+    # the self-loop of the first node, sorted first, is not part of the graphs the models were trained on
+    return np.stack((src[order], dst[order]))[:, 1:]
+
+
+@lru_cache(maxsize=None)
+def edge_index(nb_views):
+    # shared by all the graphs with the same number of views, must not be modified in place
+    return torch.as_tensor(build_edges(nb_views), dtype=torch.long)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of graphs with similar numbers of views: the graphs are sorted by view count, randomly within a same
+    count, cut in batches, and the batches are shuffled. With several replicas, each one gets the same number of
+    batches.
+    """
+
+    def __init__(self, view_counts, batch_size, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.view_counts = np.asarray(view_counts)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        nb_batches = (len(self.view_counts) + self.batch_size - 1) // self.batch_size
+        return (nb_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        tie_break = rng.permutation(len(self.view_counts)) if self.shuffle else np.arange(len(self.view_counts))
+        order = np.lexsort((tie_break, self.view_counts))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[id] for id in rng.permutation(len(batches))]
+        # repeat the first batches so that every replica gets as many
+        batches += batches[:len(self) * self.num_replicas - len(batches)]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
 
+def batch_loader(graphs, batch_size=1, shuffle=False, seed=0, num_replicas=1, rank=0):
+    """
+    :return: a DataLoader of batches of graphs, bucketed by number of views
+    """
+    view_counts = [graph.num_nodes // 68 for graph in graphs]
+    sampler = BucketBatchSampler(view_counts, batch_size, shuffle, seed, num_replicas, rank)
+    return DataLoader(graphs, batch_sampler=sampler)
 
-def convert_ds(ds):
-    def same_group(i, j):
-        groups = [np.arange(0, 17), np.arange(48, 68), np.arange(27, 36), np.arange(36, 42), np.arange(17, 22), np.arange(42, 48), np.arange(22, 27)]
-        for group in groups:
-            if i in group:
-                return j in group
 
+def convert_ds(ds, batch_size=1, shuffle=False):
     full_ds = []
     for art_index, artifact in enumerate(ds):
-        print('artifact', art_index, 'out of', len(ds))
-        edges = [[], []]
-        x, y = [], []
         nb_imgs = len(artifact['imgs'])
-        nb_nodes = 68*(nb_imgs + 1)
-        adj_mat = np.zeros([nb_nodes, nb_nodes])
-        for i in range(nb_nodes):
-            for j in range(nb_nodes):
-                # connect within view and homologue points in other views
-                adj_mat[i, j] = 1 if i//68 == j//68 or i%68 == j%68 else 0
-                # remove connections with different groups within view
-                if not same_group(i%68, j%68) and i//68 == j//68:
-                    adj_mat[i, j] = 0
-        for lign_index, lign in enumerate(adj_mat):
-            indexes = np.where(lign == 1)
-            edge_start = np.ones((len(indexes[0]))) * lign_index
-            edges = np.asarray([np.append(edges[0], np.squeeze(edge_start)), np.append(edges[1], np.squeeze(indexes))])
-        edges = edges[:, 1:]
-        for ldk_id, pt in enumerate(artifact['art_gt']):
-            x.append([0, 0, 0])
-            y.append(np.concatenate((pt, [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])))
+        # consensus nodes first, then the nodes of every view
+        x = [np.zeros((68, 3))] + [np.asarray(img['img_ldk'], dtype=np.float64) for img in artifact['imgs']]
+        y = [np.concatenate((np.asarray(artifact['art_gt']), np.zeros((68, 12))), axis=1)]
         for img in artifact['imgs']:
             scale, rotation, translation = img['img_rot']
-            transformation = [scale] + rotation.flatten().tolist() + translation.tolist()
-            for ldk_id, pt in enumerate(img['img_ldk']):
-                x.append(pt)
-            for pt in img['img_gt']:
-                y.append(np.concatenate((pt, transformation)))
-        x = torch.as_tensor(x, dtype=torch.float)
-        y = torch.as_tensor(y, dtype=torch.float)
-        edges = torch.as_tensor(edges, dtype=torch.long)
-        art_dataset = Data(x=x, y=y, edge_index=edges)
+            transformation = np.concatenate(([scale], np.asarray(rotation).flatten(), np.asarray(translation)))
+            y.append(np.concatenate((np.asarray(img['img_gt']), np.tile(transformation, (68, 1))), axis=1))
+        x = torch.as_tensor(np.concatenate(x), dtype=torch.float)
+        y = torch.as_tensor(np.concatenate(y), dtype=torch.float)
+        art_dataset = Data(x=x, y=y, edge_index=edge_index(nb_imgs + 1))
         full_ds.append(art_dataset)
-    return DataLoader(full_ds)
+    print('INFO: converted', len(full_ds), 'artifacts')
+    return batch_loader(full_ds, batch_size, shuffle)
 
 
 class Pos_Embed(nn.Module):
@@ -110,10 +217,15 @@ class Pos_Embed(nn.Module):
         self.embedding = nn.Sequential(
             nn.Conv1d(in_channels=1, out_channels=self.pos_embed_dim, kernel_size=(1,), stride=(1,)), nn.Tanh())
 
-    def forward(self, x):
+    def forward(self, x, position=None):
+        """
+        :param position: index of every node within its graph, the node index if None
+        """
         B, _ = x.size()
-        vect = torch.arange(B, dtype=torch.float).reshape((B, 1, 1)).cuda()
-        vect = torch.squeeze(self.embedding(vect))
+        if position is None:
+            position = torch.arange(B, device=x.device)
+        vect = position.to(x.dtype).reshape((B, 1, 1))
+        vect = self.embedding(vect).squeeze(-1)
         x = torch.cat((x, vect), dim=1)
         return x.reshape((B, self.data_dim + self.pos_embed_dim))
 
@@ -132,12 +244,17 @@ class GraphNet(nn.Module):
         self.conv3 = g_nn.SAGEConv(in_channels=self.embed_dim, out_channels=self.data_dim)
 
     def forward(self, art_input):
+        """
+        :param art_input: a graph or a torch_geometric batch of graphs
+        :return: the consensus nodes of every graph, of shape (nb_graphs * 68, 3)
+        """
         x, edge_index = art_input.x, art_input.edge_index
-        x = self.pos_embed(x)
+        _, position, _ = _graph_layout(x, getattr(art_input, 'batch', None))
+        x = self.pos_embed(x, position)
         x = self.conv1(x, edge_index)
         x = self.conv2(x, edge_index)
         x = self.conv3(x, edge_index)
-        return x[:self.nodes_per_view]
+        return x[position < self.nodes_per_view]
 
 
 def create_summary_image(output, y, file_name):
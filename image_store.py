@@ -0,0 +1,234 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+# bump when the content written by write_shard/write_index changes, every artifact is then rebuilt
+STORE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# per artifact fields of the index
+ARTIFACT_FIELDS = ['art_id', 'art_shard', 'art_start', 'art_avg_model', 'art_hand_updates']
+# per image fields of the index
+IMAGE_FIELDS = ['img_id', 'img_offset', 'img_shape', 'img_bbox', 'img_mean', 'img_max', 'img_transformation',
+                'img_cropped_transformation', 'img_cropped_mean', 'img_cropped_max', 'img_pred',
+                'img_precomputed_gt', 'img_cropped_gt']
+
+
+def write_shard(art, shard_path):
+    """
+    Write the pixels of every picture of an artifact one after the other in a raw uint8 blob.
+    :return: the geometry and annotations of the artifact, as stored in the index
+    """
+    offsets, shapes = [], []
+    offset = 0
+    with open(shard_path + '.tmp', 'wb') as f:
+        for img in art.pictures:
+            data = np.ascontiguousarray(img.data, dtype=np.uint8)
+            data.tofile(f)
+            offsets.append(offset)
+            shapes.append(data.shape)
+            offset += data.nbytes
+    os.replace(shard_path + '.tmp', shard_path)
+    pictures = art.pictures
+    return {
+        'art_id': art.id, 'art_shard': os.path.basename(shard_path),
+        'art_avg_model': art.avg_model, 'art_hand_updates': art.hand_updates,
+        'img_id': [img.id for img in pictures],
+        'img_offset': np.asarray(offsets, dtype=np.int64),
+        'img_shape': np.asarray(shapes, dtype=np.int64).reshape((-1, 3)),
+        'img_bbox': np.asarray([img.bbox for img in pictures]).reshape((-1, 4)),
+        'img_mean': np.asarray([img.transformation[1] for img in pictures]).reshape((-1, 3)),
+        'img_max': np.asarray([img.transformation[2] for img in pictures], dtype=np.float64),
+        'img_transformation': np.asarray([img.transformation[0] for img in pictures]).reshape((-1, 4, 4)),
+        'img_cropped_transformation': np.asarray([img.cropped_transformation[0] for img in pictures]).reshape((-1, 4, 4)),
+        'img_cropped_mean': np.asarray([img.cropped_transformation[1] for img in pictures]).reshape((-1, 3)),
+        'img_cropped_max': np.asarray([img.cropped_transformation[2] for img in pictures], dtype=np.float64),
+        'img_pred': np.asarray([img.pred for img in pictures]).reshape((-1, 68, 3)),
+        'img_precomputed_gt': np.asarray([img.precomputed_gt for img in pictures]).reshape((-1, 68, 3)),
+        'img_cropped_gt': np.asarray([img.cropped_gt for img in pictures]).reshape((-1, 68, 3))}
+
+
+def write_index(index_folder, records, failed=None):
+    """
+    Concatenate the artifact records in one .npy file per field. The previous index is replaced at once, after the
+    new one is complete.
+    """
+    fields = {
+        'art_id': np.asarray([record['art_id'] for record in records], dtype=str),
+        'art_shard': np.asarray([record['art_shard'] for record in records], dtype=str),
+        'art_start': np.cumsum([0] + [len(record['img_id']) for record in records]).astype(np.int64),
+        'art_avg_model': np.asarray([record['art_avg_model'] for record in records]).reshape((-1, 68, 3)),
+        'art_hand_updates': np.asarray([record['art_hand_updates'] for record in records]).reshape((-1, 68, 3)),
+        'img_id': np.asarray([img_id for record in records for img_id in record['img_id']], dtype=str)}
+    for field in IMAGE_FIELDS[1:]:
+        arrays = [record[field] for record in records]
+        fields[field] = np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0)
+    tmp_folder = index_folder.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for field, array in fields.items():
+        np.save(os.path.join(tmp_folder, field + '.npy'), array)
+    with open(os.path.join(tmp_folder, 'failed.json'), 'w') as f:
+        json.dump({} if failed is None else failed, f)
+    if os.path.exists(index_folder):
+        shutil.rmtree(index_folder)
+    os.replace(tmp_folder, index_folder)
+
+
+class ImageStore:
+    """Read access to a dataset written by write_shard/write_index, without reading any pixel up front"""
+
+    def __init__(self, folder, index_name='index', shards_name='shards'):
+        self.folder = folder
+        self.index_folder = os.path.join(folder, index_name)
+        self.shards_folder = os.path.join(folder, shards_name)
+        self.index = {field: np.load(os.path.join(self.index_folder, field + '.npy'), mmap_mode='r')
+                      for field in ARTIFACT_FIELDS + IMAGE_FIELDS}
+        with open(os.path.join(self.index_folder, 'failed.json')) as f:
+            self.failed = json.load(f)
+        self._blobs = {}
+
+    def __len__(self):
+        return len(self.index['art_id'])
+
+    def ids(self):
+        return [str(id) for id in self.index['art_id']]
+
+    def nb_pictures(self):
+        return np.diff(self.index['art_start'])
+
+    def image_range(self, art_index):
+        return range(int(self.index['art_start'][art_index]), int(self.index['art_start'][art_index + 1]))
+
+    def _blob(self, art_index):
+        if art_index not in self._blobs:
+            path = os.path.join(self.shards_folder, str(self.index['art_shard'][art_index]))
+            self._blobs[art_index] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._blobs[art_index]
+
+    def image_data(self, art_index, img_index):
+        # read-only view on the memory-mapped blob, pixels are only read when accessed
+        shape = tuple(int(dim) for dim in self.index['img_shape'][img_index])
+        offset = int(self.index['img_offset'][img_index])
+        return self._blob(art_index)[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def image_keys(self, artifacts):
+        """
+        Keys of the pictures which change with their content, computed from the index and the manifest without reading
+        any pixel: hash of the source picture, box and store version.
+        :param artifacts: the artifacts of the manifest of the store, see read_manifest
+        :return: one hex string per picture of the store
+        """
+        keys = []
+        for art_index, art_id in enumerate(self.ids()):
+            sources = artifacts[art_id]['sources']
+            for img_index in self.image_range(art_index):
+                img_id = str(self.index['img_id'][img_index])
+                source = sources.get(os.path.join(art_id, img_id), sources[art_id + '.json'])
+                sha1 = hashlib.sha1('{}:{}'.format(STORE_VERSION, source['sha1']).encode())
+                sha1.update(np.asarray(self.index['img_bbox'][img_index], dtype=np.float64).tobytes())
+                keys.append(sha1.hexdigest())
+        return keys
+
+    def get(self, field, index):
+        return np.array(self.index[field][index])
+
+    def record(self, art_index):
+        """
+        :return: the record of an artifact as returned by write_shard, to write it again in a new index
+        """
+        images = self.image_range(art_index)
+        record = {'art_id': str(self.index['art_id'][art_index]), 'art_shard': str(self.index['art_shard'][art_index]),
+                  'art_avg_model': self.get('art_avg_model', art_index),
+                  'art_hand_updates': self.get('art_hand_updates', art_index),
+                  'img_id': [str(id) for id in self.index['img_id'][images.start:images.stop]]}
+        for field in IMAGE_FIELDS[1:]:
+            record[field] = np.array(self.index[field][images.start:images.stop])
+        return record
+
+
+def _sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_signature(path, previous=None):
+    """
+    Size, modification time and hash of a file. The hash of previous is reused if size and mtime did not change.
+    """
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if previous is not None and previous['size'] == signature['size'] and previous['mtime'] == signature['mtime']:
+        signature['sha1'] = previous['sha1']
+    else:
+        signature['sha1'] = _sha1(path)
+    return signature
+
+
+def artifact_sources(ds_path, id, previous=None):
+    """
+    Signatures of the files an artifact is built from: its json and the pictures of its folder.
+    :param previous: the sources of the artifact in the previous manifest, or None
+    """
+    previous = {} if previous is None else previous
+    files = [id + '.json']
+    folder = os.path.join(ds_path, id)
+    if os.path.isdir(folder):
+        files += [os.path.join(id, name) for name in sorted(os.listdir(folder))]
+    return {file: file_signature(os.path.join(ds_path, file), previous.get(file)) for file in files}
+
+
+def sources_changed(ds_path, manifest):
+    """
+    Whether the annotated artifacts of ds_path differ from the ones of manifest, judged from the sizes and
+    modification times of their files, nothing is hashed.
+    """
+    if manifest is None:
+        return True
+    previous = manifest['artifacts']
+    annotated_id = {name.split('.')[0] for name in os.listdir(ds_path) if os.path.isfile(os.path.join(ds_path, name))}
+    if annotated_id != set(previous):
+        return True
+    for id in annotated_id:
+        files = [id + '.json']
+        folder = os.path.join(ds_path, id)
+        if os.path.isdir(folder):
+            files += [os.path.join(id, name) for name in os.listdir(folder)]
+        sources = previous[id]['sources']
+        if set(files) != set(sources):
+            return True
+        for file in files:
+            stat = os.stat(os.path.join(ds_path, file))
+            if stat.st_size != sources[file]['size'] or stat.st_mtime_ns != sources[file]['mtime']:
+                return True
+    return False
+
+
+def read_manifest(folder):
+    """
+    :return: the manifest of the store in folder, or None if there is none or it was written by another version
+    """
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != STORE_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(folder, artifacts):
+    """
+    :param artifacts: id -> {'sources': signatures, 'nb_pictures': int, 'failed': error or None}
+    """
+    path = os.path.join(folder, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': STORE_VERSION, 'artifacts': artifacts}, f)
+    os.replace(path + '.tmp', path)
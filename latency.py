@@ -26,13 +26,15 @@ def main(args):
     if args.onnx:
         import os
         os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-        os.environ['OMP_NUM_THREADS'] = '4'
 
         from FaceBoxes.FaceBoxes_ONNX import FaceBoxes_ONNX
         from TDDFA_ONNX import TDDFA_ONNX
 
-        face_boxes = FaceBoxes_ONNX()
-        tddfa = TDDFA_ONNX(**cfg)
+        sess_kvs = {'num_threads': args.threads, 'inter_op_num_threads': args.inter_op_threads,
+                    'execution_mode': args.execution_mode, 'graph_optimization_level': args.opt_level,
+                    'optimized_dir': args.optimized_dir}
+        face_boxes = FaceBoxes_ONNX(**sess_kvs)
+        tddfa = TDDFA_ONNX(**sess_kvs, **cfg)
     else:
         tddfa = TDDFA(**cfg)
         face_boxes = FaceBoxes()
@@ -74,15 +76,40 @@ def main(args):
           f"3DMM regression: {_t['reg'].average_time * 1000:.2f}ms, "
           f"{mode} reconstruction: {_t['recon'].average_time * 1000:.2f}ms")
 
+    if args.onnx and args.dense_flag and args.decoder_faces > 0:
+        bench_bfm_decoder(tddfa, TDDFA_ONNX(bfm_batch=False, **sess_kvs, **cfg), param_lst, roi_box_lst, args)
+
+
+def bench_bfm_decoder(tddfa_batch, tddfa_per_face, param_lst, roi_box_lst, args):
+    # dense reconstruction of decoder_faces faces, in one run of the batch decoder or one run per face
+    param_lst = [param_lst[i % len(param_lst)] for i in range(args.decoder_faces)]
+    roi_box_lst = [roi_box_lst[i % len(roi_box_lst)] for i in range(args.decoder_faces)]
+    _t = {'batch': Timer(), 'per_face': Timer()}
+    for name, tddfa in (('batch', tddfa_batch), ('per_face', tddfa_per_face)):
+        tddfa.recon_vers(param_lst, roi_box_lst, dense_flag=True)  # warmup
+        for _ in range(args.repeated):
+            _t[name].tic()
+            tddfa.recon_vers(param_lst, roi_box_lst, dense_flag=True)
+            _t[name].toc()
+    print(f"Dense reconstruction of {args.decoder_faces} faces: batch decoder "
+          f"{_t['batch'].average_time * 1000:.2f}ms, per-face decoder {_t['per_face'].average_time * 1000:.2f}ms")
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The latency testing of still image of 3DDFA')
     parser.add_argument('-c', '--config', type=str, default='configs/mb1_120x120.yml')
     parser.add_argument('-f', '--img_fp', type=str, default='examples/inputs/JianzhuGuo.jpg')
     parser.add_argument('--onnx', action='store_true', default=False)
+    parser.add_argument('--threads', type=int, default=4, help='intra-op threads of the onnxruntime sessions')
+    parser.add_argument('--inter_op_threads', type=int, default=None)
+    parser.add_argument('--execution_mode', type=str, default='sequential', help='sequential or parallel')
+    parser.add_argument('--opt_level', type=str, default='all', help='disable, basic, extended or all')
+    parser.add_argument('--optimized_dir', type=str, default=None, help='folder of the saved optimized graphs')
     parser.add_argument('--warmup', type=str2bool, default='true')
     parser.add_argument('--dense_flag', type=str2bool, default='true')
     parser.add_argument('--repeated', type=int, default=32)
+    parser.add_argument('--decoder_faces', type=int, default=8,
+                        help='faces of the batch against per-face BFM decoder benchmark, with --onnx and dense_flag')
 
     args = parser.parse_args()
     main(args)
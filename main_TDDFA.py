@@ -1,543 +1,72 @@
 #!/usr/bin/env python3
-""" ImageNet Training Script
-This is intended to be a lean and easily modifiable ImageNet training script that reproduces ImageNet
-training results with some of the latest networks and training techniques. It favours canonical PyTorch
-and standard Python style over trying to be able to 'do it all.' That said, it offers quite a few speed
-and training result improvements over the usual PyTorch example scripts. Repurpose as you see fit.
-This script was started from an early version of the PyTorch ImageNet example
-(https://github.com/pytorch/examples/tree/master/imagenet)
-NVIDIA CUDA specific speedups adopted from NVIDIA Apex examples
-(https://github.com/NVIDIA/apex/tree/master/examples/imagenet)
-Hacked together by / Copyright 2020 Ross Wightman (https://github.com/rwightman)
+""" TDDFA fine-tuning script
+Fine-tunes the TDDFA backbone on the pictures of BuddhaDataset, with the shared engine of train_engine.py.
 """
-import argparse
-import time
-import yaml
 import os
-import pickle
-import logging
-from collections import OrderedDict
-from contextlib import suppress
-from datetime import datetime
+import yaml
 
+import numpy as np
 import torch
-import torch.nn as nn
-import torchvision.utils
-from torch.utils.tensorboard import SummaryWriter
-from torch.nn.parallel import DistributedDataParallel as NativeDDP
 
 from to_train_TDDFA import TDDFA
-from torch.utils.data import DataLoader, TensorDataset
-import cv2
-import numpy as np
-from generate_dataset import BuddhaDataset, Config, Artifact, Image
-
-from timm.data import create_dataset, create_loader, resolve_data_config
-from timm.models import create_model, safe_model_name, resume_checkpoint, load_checkpoint, \
-    convert_splitbn_model, model_parameters, layers
-from timm.utils import *
-from timm.loss import *
-from timm.optim import create_optimizer_v2, optimizer_kwargs
-from timm.scheduler import create_scheduler
-from timm.utils import ApexScaler, NativeScaler
-
-try:
-    from apex import amp
-    from apex.parallel import DistributedDataParallel as ApexDDP
-    from apex.parallel import convert_syncbn_model
-
-    has_apex = True
-except ImportError:
-    has_apex = False
-
-has_native_amp = False
-try:
-    if getattr(torch.cuda.amp, 'autocast') is not None:
-        has_native_amp = True
-except AttributeError:
-    pass
-
-try:
-    import wandb
-
-    has_wandb = True
-except ImportError:
-    has_wandb = False
-
-torch.backends.cudnn.benchmark = True
-_logger = logging.getLogger('train')
-
-# The first arg parser parses out only the --config argument, this argument is used to
-# load a yaml file containing key-values that override the defaults for the main parser below
-config_parser = parser = argparse.ArgumentParser(description='Training Config', add_help=False)
-parser.add_argument('-c', '--config', default='', type=str, metavar='FILE',
-                    help='YAML config file specifying default arguments')
-
-parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
-
-# Dataset / Model parameters
-parser.add_argument('--train-split', metavar='NAME', default='train',
-                    help='dataset train split (default: train)')
-parser.add_argument('--val-split', metavar='NAME', default='validation',
-                    help='dataset validation split (default: validation)')
-parser.add_argument('--model', default='mb1_120x120', type=str, metavar='MODEL',
-                    help='Name of model to train (default: "mb1_120x120"')
-parser.add_argument('--gp', default=None, type=str, metavar='POOL',
-                    help='Global pool type, one of (fast, avg, max, avgmax, avgmaxc). Model default if None.')
-parser.add_argument('-b', '--batch-size', type=int, default=128, metavar='N',
-                    help='input batch size for training (default: 128)')
-
-# Optimizer parameters
-parser.add_argument('--opt', default='adam', type=str, metavar='OPTIMIZER',
-                    help='Optimizer (default: "adam"')
-parser.add_argument('--opt-eps', default=None, type=float, metavar='EPSILON',
-                    help='Optimizer Epsilon (default: None, use opt default)')
-parser.add_argument('--opt-betas', default=(0.9, 0.999), type=float, nargs='+', metavar='BETA',
-                    help='Optimizer Betas (default: None, use opt default)')
-parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
-                    help='Optimizer momentum (default: 0.9)')
-parser.add_argument('--weight-decay', type=float, default=2e-5,
-                    help='weight decay (default: 2e-5)')
-parser.add_argument('--clip-grad', type=float, default=1.0, metavar='NORM',
-                    help='Clip gradient norm (default: None, no clipping)')
-parser.add_argument('--clip-mode', type=str, default='norm',
-                    help='Gradient clipping mode. One of ("norm", "value", "agc")')
-
-# Learning rate schedule parameters
-parser.add_argument('--sched', default='cosine', type=str, metavar='SCHEDULER',
-                    help='LR scheduler (default: "step"')
-parser.add_argument('--lr', type=float, default=0.0001, metavar='LR',
-                    help='learning rate (default: 0.05)')
-parser.add_argument('--lr-noise', type=float, nargs='+', default=None, metavar='pct, pct',
-                    help='learning rate noise on/off epoch percentages')
-parser.add_argument('--lr-noise-pct', type=float, default=0.67, metavar='PERCENT',
-                    help='learning rate noise limit percent (default: 0.67)')
-parser.add_argument('--lr-noise-std', type=float, default=1.0, metavar='STDDEV',
-                    help='learning rate noise std-dev (default: 1.0)')
-parser.add_argument('--lr-cycle-mul', type=float, default=1.0, metavar='MULT',
-                    help='learning rate cycle len multiplier (default: 1.0)')
-parser.add_argument('--lr-cycle-decay', type=float, default=0.5, metavar='MULT',
-                    help='amount to decay each learning rate cycle (default: 0.5)')
-parser.add_argument('--lr-cycle-limit', type=int, default=1, metavar='N',
-                    help='learning rate cycle limit, cycles enabled if > 1')
-parser.add_argument('--lr-k-decay', type=float, default=1.0,
-                    help='learning rate k-decay for cosine/poly (default: 1.0)')
-parser.add_argument('--warmup-lr', type=float, default=0.0001, metavar='LR',
-                    help='warmup learning rate (default: 0.0001)')
-parser.add_argument('--min-lr', type=float, default=1e-6, metavar='LR',
-                    help='lower lr bound for cyclic schedulers that hit 0 (1e-5)')
-parser.add_argument('--epochs', type=int, default=100, metavar='N',
-                    help='number of epochs to train (default: 100)')
-parser.add_argument('--epoch-repeats', type=float, default=0., metavar='N',
-                    help='epoch repeat multiplier (number of times to repeat dataset epoch per train epoch).')
-parser.add_argument('--start-epoch', default=None, type=int, metavar='N',
-                    help='manual epoch number (useful on restarts)')
-parser.add_argument('--decay-epochs', type=float, default=0, metavar='N',
-                    help='epoch interval to decay LR')
-parser.add_argument('--warmup-epochs', type=int, default=0, metavar='N',
-                    help='epochs to warmup LR, if scheduler supports')
-parser.add_argument('--cooldown-epochs', type=int, default=0, metavar='N',
-                    help='epochs to cooldown LR at min_lr, after cyclic schedule ends')
-parser.add_argument('--patience-epochs', type=int, default=0, metavar='N',
-                    help='patience epochs for Plateau LR scheduler (default: 10')
-parser.add_argument('--decay-rate', '--dr', type=float, default=0.03, metavar='RATE',
-                    help='LR decay rate (default: 0.1)')
-
-# Augmentation & regularization parameters
-parser.add_argument('--reprob', type=float, default=0., metavar='PCT',
-                    help='Random erase prob (default: 0.)')
-parser.add_argument('--remode', type=str, default='pixel',
-                    help='Random erase mode (default: "pixel")')
-parser.add_argument('--recount', type=int, default=1,
-                    help='Random erase count (default: 1)')
-parser.add_argument('--resplit', action='store_true', default=False,
-                    help='Do not random erase first (clean) augmentation split')
-parser.add_argument('--smoothing', type=float, default=0.1,
-                    help='Label smoothing (default: 0.1)')
-parser.add_argument('--train-interpolation', type=str, default='bicubic',
-                    help='Training interpolation (random, bilinear, bicubic default: "random")')
-parser.add_argument('--drop', type=float, default=0.1, metavar='PCT',
-                    help='Dropout rate (default: 0.)')
-parser.add_argument('--drop-connect', type=float, default=None, metavar='PCT',
-                    help='Drop connect rate, DEPRECATED, use drop-path (default: None)')
-parser.add_argument('--drop-path', type=float, default=None, metavar='PCT',
-                    help='Drop path rate (default: None)')
-parser.add_argument('--drop-block', type=float, default=None, metavar='PCT',
-                    help='Drop block rate (default: None)')
-
-# Batch norm parameters (only works with gen_efficientnet based models currently)
-parser.add_argument('--bn-tf', action='store_true', default=False,
-                    help='Use Tensorflow BatchNorm defaults for models that support it (default: False)')
-parser.add_argument('--bn-momentum', type=float, default=None,
-                    help='BatchNorm momentum override (if not None)')
-parser.add_argument('--bn-eps', type=float, default=None,
-                    help='BatchNorm epsilon override (if not None)')
-parser.add_argument('--sync-bn', action='store_true',
-                    help='Enable NVIDIA Apex or Torch synchronized BatchNorm.')
-parser.add_argument('--dist-bn', type=str, default='reduce',
-                    help='Distribute BatchNorm stats between nodes after each epoch ("broadcast", "reduce", or "")')
-parser.add_argument('--split-bn', action='store_true',
-                    help='Enable separate BN layers per augmentation split.')
-
-# Misc
-parser.add_argument('--seed', type=int, default=42, metavar='S',
-                    help='random seed (default: 42)')
-parser.add_argument('--log-interval', type=int, default=1000, metavar='N',
-                    help='how many batches to wait before logging training status')
-parser.add_argument('--recovery-interval', type=int, default=0, metavar='N',
-                    help='how many batches to wait before writing recovery checkpoint')
-parser.add_argument('--checkpoint-hist', type=int, default=3, metavar='N',
-                    help='number of checkpoints to keep (default: 10)')
-parser.add_argument('-j', '--workers', type=int, default=6, metavar='N',
-                    help='how many training processes to use (default: 4)')
-parser.add_argument('--save-images', action='store_true', default=False,
-                    help='save images of input bathes every log interval for debugging')
-parser.add_argument('--amp', action='store_true', default=False,
-                    help='use NVIDIA Apex AMP or Native AMP for mixed precision training')
-parser.add_argument('--native-amp', action='store_true', default=False,
-                    help='Use Native Torch AMP mixed precision')
-parser.add_argument('--channels-last', action='store_true', default=False,
-                    help='Use channels_last memory layout')
-parser.add_argument('--pin-mem', action='store_true', default=False,
-                    help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
-parser.add_argument('--no-prefetcher', action='store_true', default=False,
-                    help='disable fast prefetcher')
-parser.add_argument('--output', default='', type=str, metavar='PATH',
-                    help='path to output folder (default: none, current dir)')
-parser.add_argument('--experiment', default='', type=str, metavar='NAME',
-                    help='name of train experiment, name of sub-folder for output')
-parser.add_argument('--eval-metric', default='loss', type=str, metavar='EVAL_METRIC',
-                    help='Best metric (default: "loss"')
-parser.add_argument('--tta', type=int, default=0, metavar='N',
-                    help='Test/inference time augmentation (oversampling) factor. 0=None (default: 0)')
-parser.add_argument("--local_rank", default=0, type=int)
-parser.add_argument('--use-multi-epochs-loader', action='store_true', default=False,
-                    help='use the multi-epochs-loader to save time at the beginning of every epoch')
-parser.add_argument('--torchscript', dest='torchscript', action='store_true',
-                    help='convert model torchscript for inference')
-parser.add_argument('--log-wandb', action='store_true', default=False,
-                    help='log training and validation metrics to wandb')
-
-
-def _parse_args():
-    # Do we have a config file to parse?
-    args_config, remaining = config_parser.parse_known_args()
-    if args_config.config:
-        with open(args_config.config, 'r') as f:
-            cfg = yaml.safe_load(f)
-            parser.set_defaults(**cfg)
-
-    # The main arg parser parses the rest of the args, the usual
-    # defaults will have been overridden if config file specified.
-    args = parser.parse_args(remaining)
-
-    # Cache the args as a text string to save them in the output dir later
-    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
-    return args, args_text
+from buddha_dataset import BuddhaDataset, Config
+import train_engine
+
+config_parser, parser = train_engine.get_parser(
+    'TDDFA Training', model='mb1_120x120', batch_size=128, lr=0.0001, epochs=100, decay_epochs=0, warmup_epochs=0,
+    patience_epochs=0, log_interval=1000, checkpoint_hist=3, threads=4)
+
+
+class VertexLoss(torch.nn.Module):
+    def __call__(self, pred, label):
+        distance = torch.norm(pred - label, dim=1)
+        return torch.mean(distance)
+
+
+class TDDFATask(train_engine.Task):
+    def __init__(self):
+        self.tddfa = None
+
+    def build_model(self, args):
+        cfg = yaml.load(open('configs/mb1_120x120.yml'), Loader=yaml.SafeLoader)
+        cfg['gpu_mode'] = args.device.type == 'cuda'
+        cfg['gpu_id'] = args.device.index or 0
+        cfg['device'] = args.device
+        os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+        self.tddfa = TDDFA(**cfg)
+        return self.tddfa.model
+
+    def attach(self, model):
+        self.tddfa.model = model
+
+    def build_loaders(self, args):
+        art_ds = BuddhaDataset(Config('conf.json'))
+        art_ds.load()
+        inputs, bboxs, targets = [], [], []
+        for art in art_ds.artifacts:
+            for img in art.pictures:
+                inputs.append(img.data)
+                bboxs.append(np.asarray(img.bbox))
+                targets.append(np.asarray(img.precomputed_gt))
+        split = int(len(inputs) * 0.8)
+        loader_train = [(x, bbox, y) for x, bbox, y in zip(inputs[:split], bboxs[:split], targets[:split])]
+        loader_eval = [(x, bbox, y) for x, bbox, y in zip(inputs[split:], bboxs[split:], targets[split:])]
+        return train_engine.shard(loader_train, args), train_engine.shard(loader_eval, args)
+
+    def build_loss(self, args):
+        return VertexLoss()
+
+    def step(self, model, batch, loss_fn, device):
+        input, bbox, target = batch
+        target = torch.from_numpy(target).to(device)
+        param, roi_box, _ = self.tddfa(input, bbox)
+        output = self.tddfa.recon_vers(param, roi_box)
+        return loss_fn(output, target), 1, output
 
 
 def main():
-    setup_default_logging()
-    args, args_text = _parse_args()
-
-    if args.log_wandb:
-        if has_wandb:
-            wandb.init(project=args.experiment, config=args)
-        else:
-            _logger.warning("You've requested to log metrics to wandb but package not found. "
-                            "Metrics not being logged to wandb, try `pip install wandb`")
-
-    args.prefetcher = not args.no_prefetcher
-    args.distributed = False
-    if 'WORLD_SIZE' in os.environ:
-        args.distributed = int(os.environ['WORLD_SIZE']) > 1
-    args.device = 'cuda:0'
-    args.world_size = 1
-    args.rank = 0  # global rank
-    if args.distributed:
-        args.device = 'cuda:%d' % args.local_rank
-        torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend='nccl', init_method='env://')
-        args.world_size = torch.distributed.get_world_size()
-        args.rank = torch.distributed.get_rank()
-        _logger.info('Training in distributed mode with multiple processes, 1 GPU per process. Process %d, total %d.'
-                     % (args.rank, args.world_size))
-    else:
-        _logger.info('Training with a single process on 1 GPUs.')
-    assert args.rank >= 0
-
-    # resolve AMP arguments based on PyTorch / Apex availability
-    use_amp = None
-    if args.amp:
-        # `--amp` chooses native amp before apex (APEX ver not actively maintained)
-        if has_native_amp:
-            args.native_amp = True
-
-    if args.native_amp and has_native_amp:
-        use_amp = 'native'
-    elif args.native_amp:
-        _logger.warning("Neither APEX or native Torch AMP is available, using float32. "
-                        "Install NVIDA apex or upgrade to PyTorch 1.6")
-
-    random_seed(args.seed, args.rank)
-
-    cfg = yaml.load(open('configs/mb1_120x120.yml'), Loader=yaml.SafeLoader)
-    cfg['gpu_mode'] = True
-    cfg['gpu_id'] = 0
-    os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
-    os.environ['OMP_NUM_THREADS'] = '4'
-    model = TDDFA(**cfg)
-
-    if args.local_rank == 0:
-        _logger.info(
-            f'Model {safe_model_name(args.model)} created, param count:{sum([m.numel() for m in model.model.parameters()])}')
-
-    data_config = resolve_data_config(vars(args), model=model.model, verbose=args.local_rank == 0)
-
-    model.model.cuda()
-
-    optimizer = create_optimizer_v2(model.model, **optimizer_kwargs(cfg=args))
-
-    # setup automatic mixed-precision (AMP) loss scaling and op casting
-    amp_autocast = suppress  # do nothing
-    loss_scaler = None
-    if use_amp == 'native':
-        amp_autocast = torch.cuda.amp.autocast
-        loss_scaler = NativeScaler()
-        if args.local_rank == 0:
-            _logger.info('Using native Torch AMP. Training in mixed precision.')
-    else:
-        if args.local_rank == 0:
-            _logger.info('AMP not enabled. Training in float32.')
-
-    # setup distributed training
-    if args.distributed:
-        if args.local_rank == 0:
-            _logger.info("Using native Torch DistributedDataParallel.")
-        model.model = NativeDDP(model.model, device_ids=[args.local_rank])  # can use device str in Torch >= 1.1
-        # NOTE: EMA model does not need to be wrapped by DDP
-
-    # setup learning rate schedule and starting epoch
-    lr_scheduler, num_epochs = create_scheduler(args, optimizer)
-    start_epoch = 0
-
-    if args.local_rank == 0:
-        _logger.info('Scheduled epochs: {}'.format(num_epochs))
-
-    # create the train and eval datasets
-    art_ds = BuddhaDataset(Config('conf.json'))
-    art_ds.load()
-    art_ds = art_ds.artifacts
-    inputs, bboxs, targets = [], [], []
-    for art in art_ds:
-        for img in art.pictures:
-            inputs.append(np.asarray(img.data))
-            # inputs.append(cv2.resize(img.cropped_data, dsize=(120, 120), interpolation=cv2.INTER_LINEAR))
-            bboxs.append(np.asarray(img.bbox))
-            targets.append(np.asarray(img.precomputed_gt))
-    inputs, bboxs, targets = np.asarray(inputs), np.asarray(bboxs), np.asarray(targets)
-    s = np.arange(0, len(inputs), 1)
-    split = int(len(inputs) * 0.8)
-    inputs, bboxs, targets = inputs[s], bboxs[s], targets[s]
-    loader_train = [(x, bbox, y) for x, bbox, y in zip(inputs[:split], bboxs[:split], targets[:split])]
-    loader_eval = [(x, bbox, y) for x, bbox, y in zip(inputs[split:], bboxs[split:], targets[split:])]
-    # dataset_train = TensorDataset(torch.from_numpy(inputs[:split]), torch.from_numpy(targets[:split]))
-    # loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True, pin_memory=True)
-    # dataset_eval = TensorDataset(torch.from_numpy(inputs[split:]), torch.from_numpy(targets[split:]))
-    # loader_eval = DataLoader(dataset_eval, batch_size=args.batch_size, shuffle=True, pin_memory=True)
-
-    class Loss(torch.nn.Module):
-        def __call__(self, pred, label):
-            distance = torch.norm(pred - label, dim=1)
-            return torch.mean(distance)
-
-    train_loss_fn = Loss().cuda()
-    validate_loss_fn = Loss().cuda()
-
-    # setup checkpoint saver and eval metric tracking
-    eval_metric = args.eval_metric
-    best_metric = None
-    best_epoch = None
-    saver = None
-    output_dir = None
-    if args.rank == 0:
-        if args.experiment:
-            exp_name = args.experiment
-        else:
-            exp_name = '-'.join([datetime.now().strftime("%m-%d_%H:%M"), safe_model_name(args.model)])
-        output_dir = get_outdir(args.output if args.output else './output/train', exp_name)
-        decreasing = True if eval_metric == 'loss' else False
-        saver = CheckpointSaver(model=model.model, optimizer=optimizer, args=args, model_ema=None, amp_scaler=loss_scaler,
-            checkpoint_dir=output_dir, recovery_dir=output_dir, decreasing=decreasing, max_history=args.checkpoint_hist)
-        with open(os.path.join(output_dir, 'args.yaml'), 'w') as f:
-            f.write(args_text)
-
-    writer = SummaryWriter(log_dir=output_dir)
-
-    try:
-        for epoch in range(start_epoch, num_epochs):
-            if args.distributed and hasattr(loader_train.sampler, 'set_epoch'):
-                loader_train.sampler.set_epoch(epoch)
-
-            train_metrics = train_one_epoch(
-                epoch, model, loader_train, optimizer, train_loss_fn, args,
-                lr_scheduler=lr_scheduler, saver=saver, output_dir=output_dir,
-                amp_autocast=amp_autocast, loss_scaler=loss_scaler, writer=writer)
-
-            if args.distributed and args.dist_bn in ('broadcast', 'reduce'):
-                if args.local_rank == 0:
-                    _logger.info("Distributing BatchNorm running means and vars")
-                distribute_bn(model, args.world_size, args.dist_bn == 'reduce')
-
-            eval_metrics = validate(epoch, model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast, writer=writer)
-
-            if lr_scheduler is not None:
-                # step LR for next epoch
-                lr_scheduler.step(epoch + 1, eval_metrics[eval_metric])
-
-            if output_dir is not None:
-                update_summary(
-                    epoch, train_metrics, eval_metrics, os.path.join(output_dir, 'summary.csv'),
-                    write_header=best_metric is None, log_wandb=args.log_wandb and has_wandb)
-
-            if saver is not None:
-                # save proper checkpoint with eval metric
-                save_metric = eval_metrics[eval_metric]
-                best_metric, best_epoch = saver.save_checkpoint(epoch, metric=save_metric)
-
-    except KeyboardInterrupt:
-        pass
-    if best_metric is not None:
-        _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
-
-
-def train_one_epoch(epoch, model, loader, optimizer, loss_fn, args,
-                    lr_scheduler=None, saver=None, output_dir=None, amp_autocast=suppress,
-                    loss_scaler=None, writer=None):
-
-    second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-    batch_time_m = AverageMeter()
-    data_time_m = AverageMeter()
-    losses_m = AverageMeter()
-
-    model.model.train()
-
-    end = time.time()
-    last_idx = len(loader) - 1
-    num_updates = epoch * len(loader)
-    for batch_idx, (input, bbox, target) in enumerate(loader):
-        last_batch = batch_idx == last_idx
-        data_time_m.update(time.time() - end)
-        # input = input.cuda()
-        target = torch.from_numpy(target).cuda()
-
-        with amp_autocast():
-            param, roi_box = model(input, bbox)
-            output = model.recon_vers(param, roi_box)
-            loss = loss_fn(output, target)
-
-        if not args.distributed:
-            losses_m.update(loss.item(), len(input))
-
-        optimizer.zero_grad()
-        if loss_scaler is not None:
-            loss_scaler(
-                loss, optimizer,
-                clip_grad=args.clip_grad, clip_mode=args.clip_mode,
-                parameters=model_parameters(model.model, exclude_head='agc' in args.clip_mode),
-                create_graph=second_order)
-        else:
-            loss.backward(create_graph=second_order)
-            if args.clip_grad is not None:
-                dispatch_clip_grad(
-                    model_parameters(model.model, exclude_head='agc' in args.clip_mode),
-                    value=args.clip_grad, mode=args.clip_mode)
-            optimizer.step()
-
-        torch.cuda.synchronize()
-        num_updates += 1
-        batch_time_m.update(time.time() - end)
-        if last_batch or batch_idx % args.log_interval == 0:
-            lrl = [param_group['lr'] for param_group in optimizer.param_groups]
-            lr = sum(lrl) / len(lrl)
-
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-                losses_m.update(reduced_loss.item(), input.size(0))
-
-            if args.local_rank == 0:
-                _logger.info(
-                    'Train: {} [{:>4d}/{} ({:>3.0f}%)]  '
-                    'Loss: {loss.avg:#.3g}  '
-                    'LR: {lr:.3e}'.format(epoch, batch_idx, len(loader), 100. * batch_idx / last_idx, loss=losses_m, lr=lr))
-
-                if args.save_images and output_dir:
-                    pass
-        if saver is not None and args.recovery_interval and (
-                last_batch or (batch_idx + 1) % args.recovery_interval == 0):
-            saver.save_recovery(epoch, batch_idx=batch_idx)
-
-        if lr_scheduler is not None:
-            lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
-
-        if writer is not None:
-            writer.add_scalar('Loss/train', losses_m.avg, epoch)
-
-        end = time.time()
-        # end for
-
-    if hasattr(optimizer, 'sync_lookahead'):
-        optimizer.sync_lookahead()
-
-    return OrderedDict([('loss', losses_m.avg)])
-
-
-def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='', writer=None):
-    batch_time_m = AverageMeter()
-    losses_m = AverageMeter()
-
-    model.model.eval()
-
-    end = time.time()
-    last_idx = len(loader) - 1
-    with torch.no_grad():
-        for batch_idx, (input, bbox, target) in enumerate(loader):
-            last_batch = batch_idx == last_idx
-            # input = input.to('cuda:0')
-            target = torch.from_numpy(target).cuda()
-
-            with amp_autocast():
-                param, roi_box = model(input, bbox)
-                output = model.recon_vers(param, roi_box)
-            if isinstance(output, (tuple, list)):
-                output = output
-
-            loss = loss_fn(output, target)
-
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-
-            else:
-                reduced_loss = loss.data
-
-            torch.cuda.synchronize()
-
-            losses_m.update(loss.item(), len(input))
-
-            batch_time_m.update(time.time() - end)
-            end = time.time()
-            if args.local_rank == 0 and (last_batch or batch_idx % args.log_interval == 0):
-                log_name = 'Test' + log_suffix
-                _logger.info(
-                    '{0}: [{1:>4d}/{2}]  '
-                    'Loss: {loss.avg:>6.4f}  '.format(log_name, batch_idx, last_idx, loss=losses_m))
-
-    metrics = OrderedDict([('loss', losses_m.avg)])
-
-    if writer is not None:
-        writer.add_scalar('Loss/test', losses_m.avg, epoch)
-
-    return metrics
+    args, args_text = train_engine.parse_args(config_parser, parser)
+    train_engine.run(TDDFATask(), args, args_text)
 
 
 if __name__ == '__main__':
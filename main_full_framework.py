@@ -1,474 +1,79 @@
 #!/usr/bin/env python3
-""" ImageNet Training Script
-This is intended to be a lean and easily modifiable ImageNet training script that reproduces ImageNet
-training results with some of the latest networks and training techniques. It favours canonical PyTorch
-and standard Python style over trying to be able to 'do it all.' That said, it offers quite a few speed
-and training result improvements over the usual PyTorch example scripts. Repurpose as you see fit.
-This script was started from an early version of the PyTorch ImageNet example
-(https://github.com/pytorch/examples/tree/master/imagenet)
-NVIDIA CUDA specific speedups adopted from NVIDIA Apex examples
-(https://github.com/NVIDIA/apex/tree/master/examples/imagenet)
-Hacked together by / Copyright 2020 Ross Wightman (https://github.com/rwightman)
+""" HeteroFramework training script
+Trains the graph of full_framework.HeteroFramework on the artifacts of BuddhaDataset, with the shared engine of
+train_engine.py.
 """
-import argparse
-import time
-
-import numpy as np
-import yaml
-import os
-import pickle
-import logging
-from collections import OrderedDict
-from contextlib import suppress
-from datetime import datetime
-
 import torch
-import torch.nn as nn
-import torchvision.utils
-from torch.utils.tensorboard import SummaryWriter
-from torch.nn.parallel import DistributedDataParallel as NativeDDP
+from torch.utils.data.distributed import DistributedSampler
+from timm.utils import unwrap_model
 
 import full_framework
+import train_engine
 
-from timm.data import create_dataset, create_loader, resolve_data_config
-from timm.models import create_model, safe_model_name, resume_checkpoint, load_checkpoint, \
-    convert_splitbn_model, model_parameters, layers
-from timm.utils import *
-from timm.loss import *
-from timm.optim import create_optimizer_v2, optimizer_kwargs
-from timm.scheduler import create_scheduler
-from timm.utils import ApexScaler, NativeScaler
-
-try:
-    from apex import amp
-    from apex.parallel import DistributedDataParallel as ApexDDP
-    from apex.parallel import convert_syncbn_model
-
-    has_apex = True
-except ImportError:
-    has_apex = False
-
-has_native_amp = False
-try:
-    if getattr(torch.cuda.amp, 'autocast') is not None:
-        has_native_amp = True
-except AttributeError:
-    pass
-
-try:
-    import wandb
-
-    has_wandb = True
-except ImportError:
-    has_wandb = False
-
-torch.backends.cudnn.benchmark = True
-_logger = logging.getLogger('train')
-
-# The first arg parser parses out only the --config argument, this argument is used to
-# load a yaml file containing key-values that override the defaults for the main parser below
-config_parser = parser = argparse.ArgumentParser(description='Training Config', add_help=False)
-parser.add_argument('-c', '--config', default='', type=str, metavar='FILE',
-                    help='YAML config file specifying default arguments')
-
-parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
-
-# Dataset / Model parameters
-parser.add_argument('--model', default='full', type=str, metavar='MODEL',
-                    help='Name of model to train (default: "vit_tiny_patch16_224"')
-parser.add_argument('--resume', default='', type=str, metavar='PATH',
-                    help='Resume full model and optimizer state from checkpoint (default: none)')
-parser.add_argument('--mean', type=float, nargs='+', default=None, metavar='MEAN',
-                    help='Override mean pixel value of dataset')
-parser.add_argument('--std', type=float, nargs='+', default=None, metavar='STD',
-                    help='Override std deviation of of dataset')
-parser.add_argument('--interpolation', default='', type=str, metavar='NAME',
-                    help='Image resize interpolation type (overrides model)')
-
-# Optimizer parameters
-parser.add_argument('--opt', default='adam', type=str, metavar='OPTIMIZER',
-                    help='Optimizer (default: "adam"')
-parser.add_argument('--opt-eps', default=None, type=float, metavar='EPSILON',
-                    help='Optimizer Epsilon (default: None, use opt default)')
-parser.add_argument('--opt-betas', default=(0.9, 0.999), type=float, nargs='+', metavar='BETA',
-                    help='Optimizer Betas (default: None, use opt default)')
-parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
-                    help='Optimizer momentum (default: 0.9)')
-parser.add_argument('--weight-decay', type=float, default=2e-5,
-                    help='weight decay (default: 2e-5)')
-parser.add_argument('--clip-grad', type=float, default=1.0, metavar='NORM',
-                    help='Clip gradient norm (default: None, no clipping)')
-parser.add_argument('--clip-mode', type=str, default='norm',
-                    help='Gradient clipping mode. One of ("norm", "value", "agc")')
-
-# Learning rate schedule parameters
-parser.add_argument('--sched', default='cosine', type=str, metavar='SCHEDULER',
-                    help='LR scheduler (default: "step"')
-parser.add_argument('--lr', type=float, default=0.003, metavar='LR',
-                    help='learning rate (default: 0.05)')
-parser.add_argument('--lr-noise', type=float, nargs='+', default=None, metavar='pct, pct',
-                    help='learning rate noise on/off epoch percentages')
-parser.add_argument('--lr-noise-pct', type=float, default=0.67, metavar='PERCENT',
-                    help='learning rate noise limit percent (default: 0.67)')
-parser.add_argument('--lr-noise-std', type=float, default=1.0, metavar='STDDEV',
-                    help='learning rate noise std-dev (default: 1.0)')
-parser.add_argument('--lr-cycle-mul', type=float, default=1.0, metavar='MULT',
-                    help='learning rate cycle len multiplier (default: 1.0)')
-parser.add_argument('--lr-cycle-decay', type=float, default=0.5, metavar='MULT',
-                    help='amount to decay each learning rate cycle (default: 0.5)')
-parser.add_argument('--lr-cycle-limit', type=int, default=1, metavar='N',
-                    help='learning rate cycle limit, cycles enabled if > 1')
-parser.add_argument('--lr-k-decay', type=float, default=1.0,
-                    help='learning rate k-decay for cosine/poly (default: 1.0)')
-parser.add_argument('--min-lr', type=float, default=1e-6, metavar='LR',
-                    help='lower lr bound for cyclic schedulers that hit 0 (1e-5)')
-parser.add_argument('--epochs', type=int, default=20, metavar='N',
-                    help='number of epochs to train (default: 20)')
-parser.add_argument('--start-epoch', default=None, type=int, metavar='N',
-                    help='manual epoch number (useful on restarts)')
-parser.add_argument('--decay-epochs', type=float, default=2, metavar='N',
-                    help='epoch interval to decay LR')
-parser.add_argument('--decay-rate', '--dr', type=float, default=0.03, metavar='RATE',
-                    help='LR decay rate (default: 0.1)')
-
-# Augmentation & regularization parameters
+config_parser, parser = train_engine.get_parser('HeteroFramework Training', model='full', recovery_interval=120,
+                                                checkpoint_hist=3)
 parser.add_argument('--loss2d', action='store_true', default=False,
                     help='Enable reprojection 2D loss.')
-parser.add_argument('--drop', type=float, default=0.0, metavar='PCT',
-                    help='Dropout rate (default: 0.)')
-parser.add_argument('--drop-connect', type=float, default=None, metavar='PCT',
-                    help='Drop connect rate, DEPRECATED, use drop-path (default: None)')
-parser.add_argument('--drop-path', type=float, default=None, metavar='PCT',
-                    help='Drop path rate (default: None)')
-parser.add_argument('--drop-block', type=float, default=None, metavar='PCT',
-                    help='Drop block rate (default: None)')
-
-# Misc
-parser.add_argument('--seed', type=int, default=42, metavar='S',
-                    help='random seed (default: 42)')
-parser.add_argument('--log-interval', type=int, default=2942, metavar='N',
-                    help='how many batches to wait before logging training status')
-parser.add_argument('--checkpoint-hist', type=int, default=10, metavar='N',
-                    help='number of checkpoints to keep (default: 10)')
-parser.add_argument('-j', '--workers', type=int, default=6, metavar='N',
-                    help='how many training processes to use (default: 4)')
-parser.add_argument('--save-images', action='store_true', default=False,
-                    help='save images of input bathes every log interval for debugging')
-parser.add_argument('--amp', action='store_true', default=False,
-                    help='use NVIDIA Apex AMP or Native AMP for mixed precision training')
-parser.add_argument('--native-amp', action='store_true', default=False,
-                    help='Use Native Torch AMP mixed precision')
-parser.add_argument('--pin-mem', action='store_true', default=False,
-                    help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
-parser.add_argument('--eval-metric', default='loss', type=str, metavar='EVAL_METRIC',
-                    help='Best metric (default: "loss"')
-parser.add_argument("--local_rank", default=0, type=int)
-parser.add_argument('--use-multi-epochs-loader', action='store_true', default=False,
-                    help='use the multi-epochs-loader to save time at the beginning of every epoch')
-parser.add_argument('--torchscript', dest='torchscript', action='store_true',
-                    help='convert model torchscript for inference')
-parser.add_argument('--log-wandb', action='store_true', default=False,
-                    help='log training and validation metrics to wandb')
-
-
-def _parse_args():
-    # Do we have a config file to parse?
-    args_config, remaining = config_parser.parse_known_args()
-    if args_config.config:
-        with open(args_config.config, 'r') as f:
-            cfg = yaml.safe_load(f)
-            parser.set_defaults(**cfg)
-
-    # The main arg parser parses the rest of the args, the usual
-    # defaults will have been overridden if config file specified.
-    args = parser.parse_args(remaining)
-
-    # Cache the args as a text string to save them in the output dir later
-    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
-    return args, args_text
+parser.add_argument('--feature-cache', default='./output/feature_cache', type=str, metavar='PATH',
+                    help='cache of the frozen backbone outputs, disabled if empty (default: ./output/feature_cache)')
+
+
+class FullFrameworkTask(train_engine.Task):
+    def experiment_name(self, args):
+        return '-'.join([super().experiment_name(args), "mixed_loss" if args.loss2d else "3d_loss"])
+
+    def build_model(self, args):
+        model = full_framework.HeteroFramework(num_graph_steps=3, cuda=False)
+        if args.feature_cache:
+            # one folder shared by all the processes, each one adds the entries of the artifacts it is given
+            model.enable_feature_cache(args.feature_cache)
+        return model
+
+    def build_loaders(self, args):
+        # without feature cache, the workers prepare the crops while the model runs, with it only the views missing
+        # from the cache are cropped, from the pictures of the store opened by this dataset
+        train_ds, eval_ds = full_framework.get_dataset(with_crops=not args.feature_cache,
+                                                       with_images=args.save_images)
+        self.dataset = train_ds
+        samplers = [None, None]
+        if args.distributed:
+            samplers = [DistributedSampler(train_ds, shuffle=True, seed=args.seed),
+                        DistributedSampler(eval_ds, shuffle=False)]
+        loader_train = full_framework.get_loader(train_ds, args.batch_size, shuffle=True,
+                                                 workers=args.workers, pin_memory=args.pin_mem, sampler=samplers[0])
+        loader_eval = full_framework.get_loader(eval_ds, args.validation_batch_size or args.batch_size,
+                                                workers=args.workers, pin_memory=args.pin_mem, sampler=samplers[1])
+        return loader_train, loader_eval
+
+    def build_loss(self, args):
+        return full_framework.Loss_fn(enable_2d=args.loss2d)
+
+    def build_optimizer(self, model, args):
+        # only the graph is trained, the backbone stays frozen
+        return torch.optim.Adam(unwrap_model(model).graph.parameters(), lr=args.lr)
+
+    def build_scheduler(self, optimizer, args):
+        return None, args.epochs
+
+    def step(self, model, batch, loss_fn, device):
+        losses, outputs = [], []
+        for art in batch:
+            bboxes = art['bboxes'].numpy()
+            images = art['images'] if 'images' in art else self.dataset.images(art)
+            output, lin_trans, new_bboxes = model(images, bboxes, art.get('crops'), art['keys'])
+            images_points = unwrap_model(model).convert_pred(output, lin_trans, new_bboxes)
+            losses.append(loss_fn(images_points[0], art['gts'][0].to(device)))
+            outputs.append((images_points, new_bboxes))
+        return torch.stack(losses).mean(), sum(len(art['keys']) for art in batch), outputs
+
+    def save_images(self, output, batch, file_name):
+        images_points, new_bboxes = output[0]
+        full_framework.points_on_image(batch[0]['images'][0], new_bboxes[0], images_points[0], dir=file_name)
 
 
 def main():
-    setup_default_logging()
-    args, args_text = _parse_args()
-
-    if args.log_wandb:
-        if has_wandb:
-            wandb.init(project=args.experiment, config=args)
-        else:
-            _logger.warning("You've requested to log metrics to wandb but package not found. "
-                            "Metrics not being logged to wandb, try `pip install wandb`")
-
-    args.distributed = False
-    if 'WORLD_SIZE' in os.environ:
-        args.distributed = int(os.environ['WORLD_SIZE']) > 1
-    args.device = 'cuda:0'
-    args.world_size = 1
-    args.rank = 0  # global rank
-    if args.distributed:
-        args.device = 'cuda:%d' % args.local_rank
-        torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend='nccl', init_method='env://')
-        args.world_size = torch.distributed.get_world_size()
-        args.rank = torch.distributed.get_rank()
-        _logger.info('Training in distributed mode with multiple processes, 1 GPU per process. Process %d, total %d.'
-                     % (args.rank, args.world_size))
-    else:
-        _logger.info('Training with a single process on 1 GPUs.')
-    assert args.rank >= 0
-
-    # resolve AMP arguments based on PyTorch / Apex availability
-    use_amp = None
-    if args.amp:
-        # `--amp` chooses native amp before apex (APEX ver not actively maintained)
-        if has_native_amp:
-            args.native_amp = True
-    if args.native_amp and has_native_amp:
-        use_amp = 'native'
-    elif args.native_amp:
-        _logger.warning("Native Torch AMP is not available, using float32. "
-                        "Upgrade to PyTorch 1.6")
-
-    random_seed(args.seed, args.rank)
-
-    model = full_framework.HeteroFramework(num_graph_steps=3)
-
-    if args.local_rank == 0:
-        _logger.info(
-            f'Model {safe_model_name(args.model)} created')
-
-    # setup synchronized BatchNorm for distributed training
-    if args.distributed and args.sync_bn:
-        assert not args.split_bn
-        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-        if args.local_rank == 0:
-            _logger.info(
-                'Converted model to use Synchronized BatchNorm. WARNING: You may have issues if using '
-                'zero initialized BN layers (enabled by default for ResNets) while sync-bn enabled.')
-
-    if args.torchscript:
-        assert not use_amp == 'apex', 'Cannot use APEX AMP with torchscripted model'
-        assert not args.sync_bn, 'Cannot use SyncBatchNorm with torchscripted model'
-        model = torch.jit.script(model)
-
-    optimizer = torch.optim.Adam(model.graph.parameters(), lr=args.lr)
-
-    # setup automatic mixed-precision (AMP) loss scaling and op casting
-    amp_autocast = suppress  # do nothing
-    loss_scaler = None
-    if use_amp == 'native':
-        amp_autocast = torch.cuda.amp.autocast
-        loss_scaler = NativeScaler()
-        if args.local_rank == 0:
-            _logger.info('Using native Torch AMP. Training in mixed precision.')
-    else:
-        if args.local_rank == 0:
-            _logger.info('AMP not enabled. Training in float32.')
-
-    # optionally resume from a checkpoint
-    resume_epoch = None
-    if args.resume:
-        resume_epoch = resume_checkpoint(
-            model, args.resume,
-            optimizer=None if args.no_resume_opt else optimizer,
-            loss_scaler=None if args.no_resume_opt else loss_scaler,
-            log_info=args.local_rank == 0)
-
-    # setup distributed training
-    if args.distributed:
-        if args.local_rank == 0:
-            _logger.info("Using native Torch DistributedDataParallel.")
-        model = NativeDDP(model, device_ids=[args.local_rank])  # can use device str in Torch >= 1.1
-        # NOTE: EMA model does not need to be wrapped by DDP
-
-    # setup learning rate schedule and starting epoch
-    num_epochs = args.epochs
-    start_epoch = 0
-    if args.start_epoch is not None:
-        # a specified start_epoch will always override the resume epoch
-        start_epoch = args.start_epoch
-    elif resume_epoch is not None:
-        start_epoch = resume_epoch
-
-    if args.local_rank == 0:
-        _logger.info('Scheduled epochs: {}'.format(num_epochs))
-
-    # create the train and eval datasets
-    loader_train, loader_eval = full_framework.get_dataset()
-
-    train_loss_fn = full_framework.Loss_fn(enable_2d=args.loss2d).cuda()
-    validate_loss_fn = full_framework.Loss_fn(enable_2d=args.loss2d).cuda()
-
-    # setup checkpoint saver and eval metric tracking
-    eval_metric = args.eval_metric
-    best_metric = None
-    best_epoch = None
-    saver = None
-    output_dir = None
-    if args.rank == 0:
-        exp_name = '-'.join([datetime.now().strftime("%m-%d_%H:%M"), safe_model_name(args.model), "mixed_loss" if args.loss2d else "3d_loss"])
-        output_dir = get_outdir('./output/train', exp_name)
-        decreasing = True if eval_metric == 'loss' else False
-        saver = CheckpointSaver(model=model, optimizer=optimizer, args=args, model_ema=None, amp_scaler=loss_scaler,
-            checkpoint_dir=output_dir, recovery_dir=output_dir, decreasing=decreasing, max_history=3)
-        with open(os.path.join(output_dir, 'args.yaml'), 'w') as f:
-            f.write(args_text)
-
-    writer = SummaryWriter(log_dir=output_dir)
-
-    try:
-        for epoch in range(start_epoch, num_epochs):
-            if args.distributed and hasattr(loader_train.sampler, 'set_epoch'):
-                loader_train.sampler.set_epoch(epoch)
-
-            train_metrics = train_one_epoch(
-                epoch, model, loader_train, optimizer, train_loss_fn, args, saver=saver, output_dir=output_dir,
-                amp_autocast=amp_autocast, loss_scaler=loss_scaler, writer=writer)
-
-            if args.distributed and args.dist_bn in ('broadcast', 'reduce'):
-                if args.local_rank == 0:
-                    _logger.info("Distributing BatchNorm running means and vars")
-                distribute_bn(model, args.world_size, args.dist_bn == 'reduce')
-
-            eval_metrics = validate(epoch, model, loader_eval, validate_loss_fn, args, amp_autocast=amp_autocast, writer=writer)
-
-            if output_dir is not None:
-                update_summary(
-                    epoch, train_metrics, eval_metrics, os.path.join(output_dir, 'summary.csv'),
-                    write_header=best_metric is None, log_wandb=args.log_wandb and has_wandb)
-
-            if saver is not None:
-                # save proper checkpoint with eval metric
-                save_metric = eval_metrics[eval_metric]
-                best_metric, best_epoch = saver.save_checkpoint(epoch, metric=save_metric)
-
-    except KeyboardInterrupt:
-        pass
-    if best_metric is not None:
-        _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
-
-
-def train_one_epoch(epoch, model, loader, optimizer, loss_fn, args,
-                    lr_scheduler=None, saver=None, output_dir=None, amp_autocast=suppress,
-                    loss_scaler=None, writer=None):
-    batch_time_m = AverageMeter()
-    data_time_m = AverageMeter()
-    losses_m = AverageMeter()
-
-    model.train()
-
-    end = time.time()
-    last_idx = len(loader) - 1
-    num_updates = epoch * len(loader)
-    for batch_idx, art in enumerate(loader):
-        last_batch = batch_idx == last_idx
-        data_time_m.update(time.time() - end)
-        images, bboxes, gts = art
-
-        with amp_autocast():
-            output, lin_trans, new_bboxes = model(images, bboxes)
-
-            images_points = model.convert_pred(output, lin_trans, new_bboxes)
-            loss = loss_fn(images_points[0], torch.from_numpy(np.asarray(gts[0])).cuda())
-
-        if not args.distributed:
-            losses_m.update(loss.item(), len(images))
-
-        optimizer.zero_grad()
-        if loss_scaler is not None:
-            loss_scaler(
-                loss, optimizer,
-                clip_grad=args.clip_grad, clip_mode=args.clip_mode,
-                parameters=model_parameters(model, exclude_head='agc' in args.clip_mode))
-        else:
-            loss.backward()
-            if args.clip_grad is not None:
-                dispatch_clip_grad(
-                    model_parameters(model, exclude_head='agc' in args.clip_mode),
-                    value=args.clip_grad, mode=args.clip_mode)
-            optimizer.step()
-
-        torch.cuda.synchronize()
-        num_updates += 1
-        batch_time_m.update(time.time() - end)
-        if last_batch or batch_idx % args.log_interval == 0:
-            lrl = [param_group['lr'] for param_group in optimizer.param_groups]
-            lr = sum(lrl) / len(lrl)
-
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-                losses_m.update(reduced_loss.item(), len(images))
-
-            if args.local_rank == 0:
-                _logger.info(
-                    'Train: {} [{:>4d}/{} ({:>3.0f}%)]  '
-                    'Loss: {loss.avg:#.3g}  '
-                    'LR: {lr:.3e}'.format(epoch, batch_idx, len(loader), 100. * batch_idx / last_idx, loss=losses_m, lr=lr))
-
-                if args.save_images and output_dir:
-                    full_framework.points_on_image(output, gts, dir=os.path.join(output_dir, 'train-epoch-{}-batch-{}.jpg'.format(epoch, batch_idx)))
-
-        if saver is not None and (last_batch or (batch_idx + 1) % 120 == 0):
-            saver.save_recovery(epoch, batch_idx=batch_idx)
-
-        if lr_scheduler is not None:
-            lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
-
-        if writer is not None:
-            writer.add_scalar('Loss/train', losses_m.avg, epoch)
-
-        end = time.time()
-        # end for
-
-    if hasattr(optimizer, 'sync_lookahead'):
-        optimizer.sync_lookahead()
-
-    return OrderedDict([('loss', losses_m.avg)])
-
-
-def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress, log_suffix='', writer=None):
-    batch_time_m = AverageMeter()
-    losses_m = AverageMeter()
-
-    model.eval()
-
-    end = time.time()
-    last_idx = len(loader) - 1
-    with torch.no_grad():
-        for batch_idx, art in enumerate(loader):
-            last_batch = batch_idx == last_idx
-            images, bboxes, gts = art
-
-            with amp_autocast():
-                output, lin_trans, new_bboxes = model(images, bboxes)
-                images_points = model.convert_pred(output, lin_trans, new_bboxes)
-
-            loss = loss_fn(images_points[0], torch.from_numpy(np.asarray(gts[0])).cuda())
-
-            if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-
-            else:
-                reduced_loss = loss.data
-
-            torch.cuda.synchronize()
-
-            losses_m.update(reduced_loss.item(), len(images))
-
-            batch_time_m.update(time.time() - end)
-            end = time.time()
-            if args.local_rank == 0 and last_batch:
-                log_name = 'Test' + log_suffix
-                _logger.info(
-                    '{0}: [{1:>4d}/{2}]  '
-                    'Loss: {loss.avg:>6.4f}  '.format(log_name, batch_idx, last_idx, loss=losses_m))
-
-    metrics = OrderedDict([('loss', losses_m.avg)])
-
-    if writer is not None:
-        writer.add_scalar('Loss/test', losses_m.avg, epoch)
-
-    return metrics
+    args, args_text = train_engine.parse_args(config_parser, parser)
+    train_engine.run(FullFrameworkTask(), args, args_text)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+# coding: utf-8
+
+"""
+INT8 quantization of the TDDFA ONNX model. The dynamic variant quantizes the weights only, the static one also the
+activations, calibrated on pictures of BuddhaDataset. A variant is only written next to the FP32 model if its landmark
+error on other artifacts stays within --max_regression of the FP32 one, TDDFA_ONNX loads it with quantization='dynamic'
+or 'static'.
+"""
+
+import os
+import sys
+import time
+import argparse
+import yaml
+import numpy as np
+from onnxruntime.quantization import (
+    quantize_dynamic, quantize_static, CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType
+)
+
+from TDDFA_ONNX import TDDFA_ONNX
+from buddha_dataset import BuddhaDataset, Config
+from utils.onnx import quantized_onnx_fp
+
+
+class BuddhaCalibrationReader(CalibrationDataReader):
+    """Network inputs of the pictures of the calibration artifacts, by batches"""
+
+    def __init__(self, tddfa, artifacts, batch_size=16):
+        inp_lst = []
+        for art in artifacts:
+            for img in art.pictures:
+                inp_lst.extend(tddfa.preprocess(img.data, [img.bbox])[0])
+        self.batches = iter([np.stack(inp_lst[start:start + batch_size])
+                             for start in range(0, len(inp_lst), batch_size)])
+        print("INFO: Calibrating on", len(inp_lst), "pictures")
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {'input': batch}
+
+
+def landmark_error(tddfa, artifacts):
+    """
+    :return: the mean over the pictures of the summed distances between predicted and ground truth landmarks, and the
+    mean time of the network on a picture in ms, preprocessing excluded
+    """
+    errors, times = [], []
+    for art in artifacts:
+        for img in art.pictures:
+            inp_lst, roi_box_lst = tddfa.preprocess(img.data, [img.bbox])
+            end = time.time()
+            param = tddfa.session.run(None, {'input': np.stack(inp_lst)})[0]
+            times.append(time.time() - end)
+            param_lst = param.reshape(len(inp_lst), -1).astype(np.float32) * tddfa.param_std + tddfa.param_mean
+            pred_3d = tddfa.recon_vers(param_lst, roi_box_lst, dense_flag=False)[0].T
+            errors.append(np.sum(np.linalg.norm(np.asarray(img.precomputed_gt) - pred_3d, axis=1)))
+    # the first run includes the session warmup
+    return np.mean(errors), np.mean(times[1:] if len(times) > 1 else times) * 1000
+
+
+def quantize(mode, onnx_fp, output_fp, calibration_reader=None):
+    if mode == 'dynamic':
+        quantize_dynamic(onnx_fp, output_fp, weight_type=QuantType.QUInt8)
+    elif mode == 'static':
+        quantize_static(onnx_fp, output_fp, calibration_reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+    else:
+        raise ValueError(f'Unknown quantization {mode}')
+
+
+def main(args):
+    cfg = yaml.load(open(args.config), Loader=yaml.SafeLoader)
+    os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+    # the reference is the FP32 model
+    cfg.pop('quantization', None)
+    tddfa = TDDFA_ONNX(num_threads=args.threads, **cfg)
+    onnx_fp = cfg.get('onnx_fp', cfg.get('checkpoint_fp').replace('.pth', '.onnx'))
+
+    # calibration and evaluation on different artifacts
+    ds = BuddhaDataset(Config('conf.json'))
+    ds.load()
+    permutation = np.random.RandomState(args.seed).permutation(len(ds.artifacts))
+    calibration = [ds.artifacts[int(id)] for id in permutation[:args.calib_artifacts]]
+    evaluation = [ds.artifacts[int(id)] for id in permutation[args.calib_artifacts:][:args.eval_artifacts]]
+    if len(evaluation) == 0:
+        print("WARNING: no artifact left to evaluate the quantized models on, lower --calib_artifacts")
+        sys.exit(1)
+
+    error_fp32, time_fp32 = landmark_error(tddfa, evaluation)
+    print(f'FP32: error {error_fp32:.2f}, {time_fp32:.2f}ms per picture')
+
+    refused = False
+    for mode in args.modes:
+        output_fp = quantized_onnx_fp(onnx_fp, mode)
+        tmp_fp = os.path.splitext(output_fp)[0] + '.tmp.onnx'
+        reader = BuddhaCalibrationReader(tddfa, calibration, args.calib_batch) if mode == 'static' else None
+        quantize(mode, onnx_fp, tmp_fp, reader)
+
+        cfg['onnx_fp'] = tmp_fp
+        tddfa_int8 = TDDFA_ONNX(num_threads=args.threads, **cfg)
+        error, elapse = landmark_error(tddfa_int8, evaluation)
+        regression = (error - error_fp32) / error_fp32
+        print(f'INT8 {mode}: error {error:.2f} ({regression * 100:+.1f}%), {elapse:.2f}ms per picture '
+              f'(x{time_fp32 / elapse:.2f})')
+        if regression > args.max_regression:
+            print(f'WARNING: the {mode} INT8 model regresses past {args.max_regression * 100:.1f}%, not written')
+            os.remove(tmp_fp)
+            refused = True
+        else:
+            os.replace(tmp_fp, output_fp)
+            print(f'INFO: Wrote {output_fp}')
+    if refused:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='INT8 quantization of the TDDFA ONNX model with an accuracy check')
+    parser.add_argument('-c', '--config', type=str, default='configs/mb1_120x120.yml')
+    parser.add_argument('--modes', type=str, nargs='+', default=['dynamic', 'static'], choices=['dynamic', 'static'])
+    parser.add_argument('--calib_artifacts', type=int, default=32, help='artifacts calibrating static quantization')
+    parser.add_argument('--calib_batch', type=int, default=16)
+    parser.add_argument('--eval_artifacts', type=int, default=64, help='artifacts of the accuracy check')
+    parser.add_argument('--max_regression', type=float, default=0.05,
+                        help='largest relative increase of the landmark error over the FP32 model')
+    parser.add_argument('--threads', type=int, default=4, help='intra-op threads of the onnxruntime sessions')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    main(args)
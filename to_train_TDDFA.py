@@ -52,16 +52,17 @@ class TDDFA(object):
             shape_dim=kvs.get('shape_dim', 40),
             exp_dim=kvs.get('exp_dim', 10)
         )
-        self.tri = self.bfm.tri
-        self.bfm.u_base = torch.from_numpy(self.bfm.u_base).cuda()
-        self.bfm.w_shp_base = torch.from_numpy(self.bfm.w_shp_base).cuda()
-        self.bfm.w_exp_base = torch.from_numpy(self.bfm.w_exp_base).cuda()
 
         # config
         self.gpu_mode = kvs.get('gpu_mode', False)
         self.gpu_id = kvs.get('gpu_id', 0)
+        self.device = torch.device(kvs.get('device', f'cuda:{self.gpu_id}' if self.gpu_mode else 'cpu'))
         self.size = kvs.get('size', 120)
 
+        self.bfm.u_base = torch.from_numpy(self.bfm.u_base).to(self.device)
+        self.bfm.w_shp_base = torch.from_numpy(self.bfm.w_shp_base).to(self.device)
+        self.bfm.w_exp_base = torch.from_numpy(self.bfm.w_exp_base).to(self.device)
+
         param_mean_std_fp = kvs.get(
             'param_mean_std_fp', make_abs_path(f'configs/param_mean_std_62d_{self.size}x{self.size}.pkl')
         )
@@ -75,9 +76,9 @@ class TDDFA(object):
         )
         model = load_model(model, kvs.get('checkpoint_fp'))
 
-        if self.gpu_mode:
+        if self.device.type == 'cuda':
             cudnn.benchmark = True
-            model = model.cuda(device=self.gpu_id)
+        model = model.to(self.device)
 
         self.model = model
         self.model.eval()  # eval mode, fix BN
@@ -90,11 +91,16 @@ class TDDFA(object):
 
         # params normalization config
         r = _load(param_mean_std_fp)
-        self.param_mean = torch.from_numpy(r.get('mean')).cuda()
-        self.param_std = torch.from_numpy(r.get('std')).cuda()
+        self.param_mean = torch.from_numpy(r.get('mean')).to(self.device)
+        self.param_std = torch.from_numpy(r.get('std')).to(self.device)
 
         # print('param_mean and param_srd', self.param_mean, self.param_std)
 
+    @property
+    def tri(self):
+        # the triangles are only read for rendering
+        return self.bfm.tri
+
     def __call__(self, img_ori, obj, **kvs):
         """The main call of TDDFA, given image and box / landmark, return 3DMM params and roi_box
         :param img_ori: the input image
@@ -116,8 +122,7 @@ class TDDFA(object):
         img = cv2.resize(img, dsize=(self.size, self.size), interpolation=cv2.INTER_LINEAR)
         inp = self.transform(img).unsqueeze(0)
 
-        if self.gpu_mode:
-            inp = inp.cuda(device=self.gpu_id)
+        inp = inp.to(self.device)
 
         if kvs.get('timer_flag', False):
             end = time.time()
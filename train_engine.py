@@ -0,0 +1,541 @@
+""" Training engine shared by main_graph.py, main_TDDFA.py and main_full_framework.py
+The three scripts were started from the timm ImageNet training script. They now only describe their task (model,
+loss and data) with a Task, the engine handles the device, the data parallelism, AMP, the checkpoints and the logs.
+Runs on GPU or CPU, data parallelism uses nccl on GPU and gloo on CPU, e.g. on a CPU-only node:
+    torchrun --nproc_per_node=4 main_graph.py --device cpu --threads 4
+"""
+import argparse
+import time
+import yaml
+import os
+import logging
+from collections import OrderedDict
+from contextlib import suppress
+from datetime import datetime
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel as NativeDDP
+
+from timm.models import safe_model_name, resume_checkpoint, model_parameters
+from timm.utils import AverageMeter, CheckpointSaver, NativeScaler, dispatch_clip_grad, distribute_bn, \
+    get_outdir, random_seed, reduce_tensor, setup_default_logging, update_summary
+from timm.optim import create_optimizer_v2, optimizer_kwargs
+from timm.scheduler import create_scheduler
+
+try:
+    import wandb
+
+    has_wandb = True
+except ImportError:
+    has_wandb = False
+
+_logger = logging.getLogger('train')
+
+
+def get_parser(description, **defaults):
+    """
+    Arguments common to every training script, the script adds its own ones to the returned parser.
+    :param defaults: defaults of the script, overriding the ones of the engine
+    :return: the parser of the --config yaml file and the main parser
+    """
+    # The first arg parser parses out only the --config argument, this argument is used to
+    # load a yaml file containing key-values that override the defaults for the main parser below
+    config_parser = argparse.ArgumentParser(description='Training Config', add_help=False)
+    config_parser.add_argument('-c', '--config', default='', type=str, metavar='FILE',
+                               help='YAML config file specifying default arguments')
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--model', default='model', type=str, metavar='MODEL',
+                        help='Name of the model, used to name the experiment')
+    parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                        help='Resume full model and optimizer state from checkpoint (default: none)')
+    parser.add_argument('--no-resume-opt', action='store_true', default=False,
+                        help='prevent resume of optimizer state when resuming model')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, metavar='N',
+                        help='input batch size for training (default: 1)')
+    parser.add_argument('-vb', '--validation-batch-size', type=int, default=None, metavar='N',
+                        help='validation batch size override (default: None)')
+
+    # Device parameters
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str,
+                        help='cuda or cpu (default: cuda when available)')
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help='torch threads of each process on CPU (default: torch default)')
+
+    # Optimizer parameters
+    parser.add_argument('--opt', default='adam', type=str, metavar='OPTIMIZER',
+                        help='Optimizer (default: "adam"')
+    parser.add_argument('--opt-eps', default=None, type=float, metavar='EPSILON',
+                        help='Optimizer Epsilon (default: None, use opt default)')
+    parser.add_argument('--opt-betas', default=(0.9, 0.999), type=float, nargs='+', metavar='BETA',
+                        help='Optimizer Betas (default: None, use opt default)')
+    parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
+                        help='Optimizer momentum (default: 0.9)')
+    parser.add_argument('--weight-decay', type=float, default=2e-5,
+                        help='weight decay (default: 2e-5)')
+    parser.add_argument('--clip-grad', type=float, default=1.0, metavar='NORM',
+                        help='Clip gradient norm (default: None, no clipping)')
+    parser.add_argument('--clip-mode', type=str, default='norm',
+                        help='Gradient clipping mode. One of ("norm", "value", "agc")')
+
+    # Learning rate schedule parameters
+    parser.add_argument('--sched', default='cosine', type=str, metavar='SCHEDULER',
+                        help='LR scheduler (default: "cosine"')
+    parser.add_argument('--lr', type=float, default=0.003, metavar='LR',
+                        help='learning rate (default: 0.003)')
+    parser.add_argument('--lr-noise', type=float, nargs='+', default=None, metavar='pct, pct',
+                        help='learning rate noise on/off epoch percentages')
+    parser.add_argument('--lr-noise-pct', type=float, default=0.67, metavar='PERCENT',
+                        help='learning rate noise limit percent (default: 0.67)')
+    parser.add_argument('--lr-noise-std', type=float, default=1.0, metavar='STDDEV',
+                        help='learning rate noise std-dev (default: 1.0)')
+    parser.add_argument('--lr-cycle-mul', type=float, default=1.0, metavar='MULT',
+                        help='learning rate cycle len multiplier (default: 1.0)')
+    parser.add_argument('--lr-cycle-decay', type=float, default=0.5, metavar='MULT',
+                        help='amount to decay each learning rate cycle (default: 0.5)')
+    parser.add_argument('--lr-cycle-limit', type=int, default=1, metavar='N',
+                        help='learning rate cycle limit, cycles enabled if > 1')
+    parser.add_argument('--lr-k-decay', type=float, default=1.0,
+                        help='learning rate k-decay for cosine/poly (default: 1.0)')
+    parser.add_argument('--warmup-lr', type=float, default=0.0001, metavar='LR',
+                        help='warmup learning rate (default: 0.0001)')
+    parser.add_argument('--min-lr', type=float, default=1e-6, metavar='LR',
+                        help='lower lr bound for cyclic schedulers that hit 0 (1e-6)')
+    parser.add_argument('--epochs', type=int, default=20, metavar='N',
+                        help='number of epochs to train (default: 20)')
+    parser.add_argument('--epoch-repeats', type=float, default=0., metavar='N',
+                        help='epoch repeat multiplier (number of times to repeat dataset epoch per train epoch).')
+    parser.add_argument('--start-epoch', default=None, type=int, metavar='N',
+                        help='manual epoch number (useful on restarts)')
+    parser.add_argument('--decay-epochs', type=float, default=2, metavar='N',
+                        help='epoch interval to decay LR')
+    parser.add_argument('--warmup-epochs', type=int, default=2, metavar='N',
+                        help='epochs to warmup LR, if scheduler supports')
+    parser.add_argument('--cooldown-epochs', type=int, default=0, metavar='N',
+                        help='epochs to cooldown LR at min_lr, after cyclic schedule ends')
+    parser.add_argument('--patience-epochs', type=int, default=10, metavar='N',
+                        help='patience epochs for Plateau LR scheduler (default: 10')
+    parser.add_argument('--decay-rate', '--dr', type=float, default=0.03, metavar='RATE',
+                        help='LR decay rate (default: 0.03)')
+
+    # Batch norm parameters
+    parser.add_argument('--sync-bn', action='store_true',
+                        help='Enable Torch synchronized BatchNorm.')
+    parser.add_argument('--dist-bn', type=str, default='reduce',
+                        help='Distribute BatchNorm stats between nodes after each epoch ("broadcast", "reduce", or "")')
+
+    # Misc
+    parser.add_argument('--seed', type=int, default=42, metavar='S',
+                        help='random seed (default: 42)')
+    parser.add_argument('--log-interval', type=int, default=2942, metavar='N',
+                        help='how many batches to wait before logging training status')
+    parser.add_argument('--recovery-interval', type=int, default=0, metavar='N',
+                        help='how many batches to wait before writing recovery checkpoint')
+    parser.add_argument('--checkpoint-hist', type=int, default=10, metavar='N',
+                        help='number of checkpoints to keep (default: 10)')
+    parser.add_argument('-j', '--workers', type=int, default=6, metavar='N',
+                        help='how many data loading processes to use (default: 6)')
+    parser.add_argument('--save-images', action='store_true', default=False,
+                        help='save images of input bathes every log interval for debugging')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='use Native AMP for mixed precision training, on GPU only')
+    parser.add_argument('--native-amp', action='store_true', default=False,
+                        help='Use Native Torch AMP mixed precision')
+    parser.add_argument('--pin-mem', action='store_true', default=False,
+                        help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
+    parser.add_argument('--output', default='', type=str, metavar='PATH',
+                        help='path to output folder (default: none, current dir)')
+    parser.add_argument('--experiment', default='', type=str, metavar='NAME',
+                        help='name of train experiment, name of sub-folder for output')
+    parser.add_argument('--eval-metric', default='loss', type=str, metavar='EVAL_METRIC',
+                        help='Best metric (default: "loss"')
+    parser.add_argument("--local_rank", default=0, type=int)
+    parser.add_argument('--torchscript', dest='torchscript', action='store_true',
+                        help='convert model torchscript for inference')
+    parser.add_argument('--log-wandb', action='store_true', default=False,
+                        help='log training and validation metrics to wandb')
+    parser.set_defaults(**defaults)
+    return config_parser, parser
+
+
+def parse_args(config_parser, parser):
+    # Do we have a config file to parse?
+    args_config, remaining = config_parser.parse_known_args()
+    if args_config.config:
+        with open(args_config.config, 'r') as f:
+            cfg = yaml.safe_load(f)
+            parser.set_defaults(**cfg)
+
+    # The main arg parser parses the rest of the args, the usual
+    # defaults will have been overridden if config file specified.
+    args = parser.parse_args(remaining)
+
+    # Cache the args as a text string to save them in the output dir later
+    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
+    return args, args_text
+
+
+def setup_device(args):
+    """
+    Set args.device, args.distributed, args.world_size, args.rank and args.local_rank, and join the process group
+    when launched by torchrun or torch.distributed.launch.
+    """
+    args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    args.world_size = 1
+    args.rank = 0  # global rank
+    use_cuda = args.device.startswith('cuda')
+    if use_cuda:
+        index = args.local_rank if args.distributed else (torch.device(args.device).index or 0)
+        args.device = torch.device('cuda', index)
+        torch.cuda.set_device(args.device)
+        torch.backends.cudnn.benchmark = True
+    else:
+        args.device = torch.device('cpu')
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+    if args.distributed:
+        torch.distributed.init_process_group(backend='nccl' if use_cuda else 'gloo', init_method='env://')
+        args.world_size = torch.distributed.get_world_size()
+        args.rank = torch.distributed.get_rank()
+        _logger.info('Training in distributed mode with multiple processes on %s. Process %d, total %d.'
+                     % (args.device.type, args.rank, args.world_size))
+    else:
+        _logger.info('Training with a single process on %s.' % args.device)
+    assert args.rank >= 0
+
+
+def shard(items, args):
+    """
+    Items of the current process, every process gets the same number of them so that collective calls stay aligned.
+    """
+    if not args.distributed:
+        return items
+    nb_items = len(items) // args.world_size * args.world_size
+    return items[args.rank:nb_items:args.world_size]
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class Task:
+    """What a training script trains: its model, loss and data, and how a batch goes through them"""
+
+    def experiment_name(self, args):
+        return '-'.join([datetime.now().strftime("%m-%d_%H:%M"), safe_model_name(args.model)])
+
+    def build_model(self, args):
+        """
+        :return: the torch module holding the trained parameters, on CPU
+        """
+        raise NotImplementedError
+
+    def attach(self, model):
+        """
+        Called with the model as it is trained, on its device and wrapped in DistributedDataParallel if distributed.
+        """
+        pass
+
+    def build_loaders(self, args):
+        """
+        :return: the train and eval loaders of the current process, see shard
+        """
+        raise NotImplementedError
+
+    def build_loss(self, args):
+        raise NotImplementedError
+
+    def build_optimizer(self, model, args):
+        return create_optimizer_v2(model, **optimizer_kwargs(cfg=args))
+
+    def build_scheduler(self, optimizer, args):
+        """
+        :return: the scheduler, or None, and the number of epochs
+        """
+        return create_scheduler(args, optimizer)
+
+    def step(self, model, batch, loss_fn, device):
+        """
+        :return: the loss of the batch, its size, and the output passed to save_images
+        """
+        raise NotImplementedError
+
+    def save_images(self, output, batch, file_name):
+        pass
+
+
+def run(task, args, args_text):
+    setup_default_logging()
+
+    if args.log_wandb:
+        if has_wandb:
+            wandb.init(project=args.experiment, config=args)
+        else:
+            _logger.warning("You've requested to log metrics to wandb but package not found. "
+                            "Metrics not being logged to wandb, try `pip install wandb`")
+
+    setup_device(args)
+
+    # resolve AMP arguments, native AMP runs on GPU only
+    use_amp = None
+    if args.amp or args.native_amp:
+        if args.device.type == 'cuda':
+            use_amp = 'native'
+        else:
+            _logger.warning("AMP is only supported on GPU, using float32.")
+
+    random_seed(args.seed, args.rank)
+
+    model = task.build_model(args)
+    model.to(args.device)
+
+    if args.local_rank == 0:
+        _logger.info(
+            f'Model {safe_model_name(args.model)} created, param count:{sum([m.numel() for m in model.parameters()])}')
+
+    # setup synchronized BatchNorm for distributed training
+    if args.distributed and args.sync_bn:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        if args.local_rank == 0:
+            _logger.info(
+                'Converted model to use Synchronized BatchNorm. WARNING: You may have issues if using '
+                'zero initialized BN layers (enabled by default for ResNets) while sync-bn enabled.')
+
+    if args.torchscript:
+        assert not args.sync_bn, 'Cannot use SyncBatchNorm with torchscripted model'
+        model = torch.jit.script(model)
+
+    optimizer = task.build_optimizer(model, args)
+
+    # setup automatic mixed-precision (AMP) loss scaling and op casting
+    amp_autocast = suppress  # do nothing
+    loss_scaler = None
+    if use_amp == 'native':
+        amp_autocast = torch.cuda.amp.autocast
+        loss_scaler = NativeScaler()
+        if args.local_rank == 0:
+            _logger.info('Using native Torch AMP. Training in mixed precision.')
+    else:
+        if args.local_rank == 0:
+            _logger.info('AMP not enabled. Training in float32.')
+
+    # optionally resume from a checkpoint
+    resume_epoch = None
+    if args.resume:
+        resume_epoch = resume_checkpoint(
+            model, args.resume,
+            optimizer=None if args.no_resume_opt else optimizer,
+            loss_scaler=None if args.no_resume_opt else loss_scaler,
+            log_info=args.local_rank == 0)
+
+    # setup distributed training
+    if args.distributed:
+        if args.local_rank == 0:
+            _logger.info("Using native Torch DistributedDataParallel.")
+        model = NativeDDP(model, device_ids=[args.local_rank] if args.device.type == 'cuda' else None)
+    task.attach(model)
+
+    # setup learning rate schedule and starting epoch
+    lr_scheduler, num_epochs = task.build_scheduler(optimizer, args)
+    start_epoch = 0
+    if args.start_epoch is not None:
+        # a specified start_epoch will always override the resume epoch
+        start_epoch = args.start_epoch
+    elif resume_epoch is not None:
+        start_epoch = resume_epoch
+    if lr_scheduler is not None and start_epoch > 0:
+        lr_scheduler.step(start_epoch)
+
+    if args.local_rank == 0:
+        _logger.info('Scheduled epochs: {}'.format(num_epochs))
+
+    # create the train and eval datasets
+    loader_train, loader_eval = task.build_loaders(args)
+
+    train_loss_fn = task.build_loss(args).to(args.device)
+    validate_loss_fn = task.build_loss(args).to(args.device)
+
+    # setup checkpoint saver and eval metric tracking
+    eval_metric = args.eval_metric
+    best_metric = None
+    best_epoch = None
+    saver = None
+    output_dir = None
+    writer = None
+    if args.rank == 0:
+        exp_name = args.experiment if args.experiment else task.experiment_name(args)
+        output_dir = get_outdir(args.output if args.output else './output/train', exp_name)
+        decreasing = True if eval_metric == 'loss' else False
+        saver = CheckpointSaver(model=model, optimizer=optimizer, args=args, model_ema=None, amp_scaler=loss_scaler,
+            checkpoint_dir=output_dir, recovery_dir=output_dir, decreasing=decreasing, max_history=args.checkpoint_hist)
+        with open(os.path.join(output_dir, 'args.yaml'), 'w') as f:
+            f.write(args_text)
+        writer = SummaryWriter(log_dir=output_dir)
+
+    try:
+        for epoch in range(start_epoch, num_epochs):
+            for sampler in (getattr(loader_train, 'sampler', None), getattr(loader_train, 'batch_sampler', None)):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
+
+            train_metrics = train_one_epoch(
+                epoch, model, loader_train, optimizer, train_loss_fn, task, args,
+                lr_scheduler=lr_scheduler, saver=saver, output_dir=output_dir,
+                amp_autocast=amp_autocast, loss_scaler=loss_scaler, writer=writer)
+
+            if args.distributed and args.dist_bn in ('broadcast', 'reduce'):
+                if args.local_rank == 0:
+                    _logger.info("Distributing BatchNorm running means and vars")
+                distribute_bn(model, args.world_size, args.dist_bn == 'reduce')
+
+            eval_metrics = validate(epoch, model, loader_eval, validate_loss_fn, task, args,
+                                    amp_autocast=amp_autocast, writer=writer)
+
+            if lr_scheduler is not None:
+                # step LR for next epoch
+                lr_scheduler.step(epoch + 1, eval_metrics[eval_metric])
+
+            if output_dir is not None:
+                update_summary(
+                    epoch, train_metrics, eval_metrics, os.path.join(output_dir, 'summary.csv'),
+                    write_header=best_metric is None, log_wandb=args.log_wandb and has_wandb)
+
+            if saver is not None:
+                # save proper checkpoint with eval metric
+                save_metric = eval_metrics[eval_metric]
+                best_metric, best_epoch = saver.save_checkpoint(epoch, metric=save_metric)
+
+    except KeyboardInterrupt:
+        pass
+    if best_metric is not None:
+        _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
+    if args.distributed:
+        torch.distributed.destroy_process_group()
+
+
+def train_one_epoch(epoch, model, loader, optimizer, loss_fn, task, args,
+                    lr_scheduler=None, saver=None, output_dir=None, amp_autocast=suppress,
+                    loss_scaler=None, writer=None):
+
+    second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+    batch_time_m = AverageMeter()
+    data_time_m = AverageMeter()
+    losses_m = AverageMeter()
+    pending_loss, pending_count = 0, 0
+
+    model.train()
+
+    end = time.time()
+    last_idx = len(loader) - 1
+    num_updates = epoch * len(loader)
+    for batch_idx, batch in enumerate(loader):
+        last_batch = batch_idx == last_idx
+        data_time_m.update(time.time() - end)
+
+        with amp_autocast():
+            loss, batch_size, output = task.step(model, batch, loss_fn, args.device)
+
+        if not args.distributed:
+            # summed on the device, read at the next log not to wait for the device every step
+            pending_loss = pending_loss + loss.detach() * batch_size
+            pending_count += batch_size
+
+        optimizer.zero_grad()
+        if loss_scaler is not None:
+            loss_scaler(
+                loss, optimizer,
+                clip_grad=args.clip_grad, clip_mode=args.clip_mode,
+                parameters=model_parameters(model, exclude_head='agc' in args.clip_mode),
+                create_graph=second_order)
+        else:
+            loss.backward(create_graph=second_order)
+            if args.clip_grad is not None:
+                dispatch_clip_grad(
+                    model_parameters(model, exclude_head='agc' in args.clip_mode),
+                    value=args.clip_grad, mode=args.clip_mode)
+            optimizer.step()
+
+        num_updates += 1
+        if last_batch or batch_idx % args.log_interval == 0:
+            # only wait for the device when the timings are reported
+            synchronize(args.device)
+            lrl = [param_group['lr'] for param_group in optimizer.param_groups]
+            lr = sum(lrl) / len(lrl)
+
+            if args.distributed:
+                reduced_loss = reduce_tensor(loss.data, args.world_size)
+                losses_m.update(reduced_loss.item(), batch_size)
+            elif pending_count > 0:
+                losses_m.update(pending_loss.item() / pending_count, pending_count)
+                pending_loss, pending_count = 0, 0
+
+            if args.local_rank == 0:
+                _logger.info(
+                    'Train: {} [{:>4d}/{} ({:>3.0f}%)]  '
+                    'Loss: {loss.avg:#.3g}  '
+                    'LR: {lr:.3e}'.format(epoch, batch_idx, len(loader), 100. * batch_idx / max(last_idx, 1),
+                                          loss=losses_m, lr=lr))
+
+                if args.save_images and output_dir:
+                    task.save_images(output, batch, os.path.join(
+                        output_dir, 'train-epoch-{}-batch-{}.jpg'.format(epoch, batch_idx)))
+        batch_time_m.update(time.time() - end)
+
+        if saver is not None and args.recovery_interval and (
+                last_batch or (batch_idx + 1) % args.recovery_interval == 0):
+            saver.save_recovery(epoch, batch_idx=batch_idx)
+
+        if lr_scheduler is not None:
+            lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
+
+        if writer is not None:
+            writer.add_scalar('Loss/train', losses_m.avg, epoch)
+
+        end = time.time()
+        # end for
+
+    if hasattr(optimizer, 'sync_lookahead'):
+        optimizer.sync_lookahead()
+
+    return OrderedDict([('loss', losses_m.avg)])
+
+
+def validate(epoch, model, loader, loss_fn, task, args, amp_autocast=suppress, log_suffix='', writer=None):
+    batch_time_m = AverageMeter()
+    losses_m = AverageMeter()
+
+    model.eval()
+
+    end = time.time()
+    last_idx = len(loader) - 1
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(loader):
+            last_batch = batch_idx == last_idx
+
+            with amp_autocast():
+                loss, batch_size, _ = task.step(model, batch, loss_fn, args.device)
+
+            if args.distributed:
+                reduced_loss = reduce_tensor(loss.data, args.world_size)
+            else:
+                reduced_loss = loss.data
+
+            losses_m.update(reduced_loss.item(), batch_size)
+
+            batch_time_m.update(time.time() - end)
+            end = time.time()
+            if args.local_rank == 0 and (last_batch or batch_idx % args.log_interval == 0):
+                log_name = 'Test' + log_suffix
+                _logger.info(
+                    '{0}: [{1:>4d}/{2}]  '
+                    'Loss: {loss.avg:>6.4f}  '.format(log_name, batch_idx, last_idx, loss=losses_m))
+
+    metrics = OrderedDict([('loss', losses_m.avg)])
+
+    if writer is not None:
+        writer.add_scalar('Loss/test', losses_m.avg, epoch)
+
+    return metrics
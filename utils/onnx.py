@@ -3,6 +3,7 @@
 __author__ = 'cleardusk'
 
 import sys
+import os.path as osp
 
 sys.path.append('../../3DDFA')
 
@@ -24,7 +25,7 @@ def convert_to_onnx(**kvs):
     model = load_model(model, checkpoint_fp)
     model.eval()
 
-    # 2. convert
+    # 2. convert, the batch dimension is dynamic to forward several crops at once
     batch_size = 1
     dummy_input = torch.randn(batch_size, 3, size, size)
     wfp = checkpoint_fp.replace('.pth', '.onnx')
@@ -34,7 +35,13 @@ def convert_to_onnx(**kvs):
         wfp,
         input_names=['input'],
         output_names=['output'],
+        dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
         do_constant_folding=True
     )
     print(f'Convert {checkpoint_fp} to {wfp} done.')
     return wfp
+
+
+def quantized_onnx_fp(onnx_fp, quantization):
+    # path of the INT8 variant of onnx_fp, quantization being 'dynamic' or 'static'
+    return osp.splitext(onnx_fp)[0] + f'_int8_{quantization}.onnx'
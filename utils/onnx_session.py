@@ -0,0 +1,99 @@
+# coding: utf-8
+
+import os
+import os.path as osp
+import hashlib
+import threading
+
+import onnxruntime
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+# options of get_session which can be given to TDDFA_ONNX and FaceBoxes_ONNX, num_threads being intra_op_num_threads
+SESSION_KEYS = ('num_threads', 'inter_op_num_threads', 'execution_mode', 'graph_optimization_level', 'optimized_dir')
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def session_kvs(kvs):
+    """
+    :return: the options of get_session set in kvs
+    """
+    return {key: kvs[key] for key in SESSION_KEYS if kvs.get(key) is not None}
+
+
+def _session_options(num_threads, inter_op_num_threads, execution_mode, graph_optimization_level):
+    sess_options = onnxruntime.SessionOptions()
+    # onnxruntime defaults for the thread counts which are not set
+    if num_threads is not None:
+        sess_options.intra_op_num_threads = num_threads
+    if inter_op_num_threads is not None:
+        sess_options.inter_op_num_threads = inter_op_num_threads
+    sess_options.execution_mode = EXECUTION_MODES[execution_mode]
+    sess_options.graph_optimization_level = OPTIMIZATION_LEVELS[graph_optimization_level]
+    return sess_options
+
+
+def _create_session(onnx_fp, num_threads, inter_op_num_threads, execution_mode, graph_optimization_level,
+                    optimized_dir):
+    if optimized_dir is None:
+        sess_options = _session_options(num_threads, inter_op_num_threads, execution_mode, graph_optimization_level)
+        return onnxruntime.InferenceSession(onnx_fp, sess_options)
+
+    # the optimized graph is saved on the first run and loaded as is by the next ones
+    # models of the same name in different folders get their own file
+    name = osp.splitext(osp.basename(onnx_fp))[0]
+    path_hash = hashlib.sha1(osp.realpath(onnx_fp).encode()).hexdigest()[:8]
+    optimized_fp = osp.join(optimized_dir, f'{name}.{path_hash}.{graph_optimization_level}.onnx')
+    if osp.exists(optimized_fp) and osp.getmtime(optimized_fp) >= osp.getmtime(onnx_fp):
+        sess_options = _session_options(num_threads, inter_op_num_threads, execution_mode, 'disable')
+        return onnxruntime.InferenceSession(optimized_fp, sess_options)
+
+    os.makedirs(optimized_dir, exist_ok=True)
+    sess_options = _session_options(num_threads, inter_op_num_threads, execution_mode, graph_optimization_level)
+    # several processes may optimize the same model, the last one replaces the file
+    tmp_fp = f'{optimized_fp}.{os.getpid()}.tmp'
+    sess_options.optimized_model_filepath = tmp_fp
+    session = onnxruntime.InferenceSession(onnx_fp, sess_options)
+    os.replace(tmp_fp, optimized_fp)
+    print(f'Saved the optimized graph of {onnx_fp} to {optimized_fp}')
+    return session
+
+
+def get_session(onnx_fp, num_threads=None, inter_op_num_threads=None, execution_mode='sequential',
+                graph_optimization_level='all', optimized_dir=None):
+    """
+    Sessions are shared within the process, one per model and options.
+    :param onnx_fp: path of the .onnx model
+    :param num_threads: intra_op_num_threads of the session, onnxruntime default if None
+    :param inter_op_num_threads: threads running independent nodes in parallel execution mode
+    :param execution_mode: 'sequential' or 'parallel'
+    :param graph_optimization_level: 'disable', 'basic', 'extended' or 'all'
+    :param optimized_dir: folder where the optimized graph is saved, so later processes skip the optimization
+    :return: an onnxruntime.InferenceSession
+    """
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(f'Unknown execution mode {execution_mode}')
+    if graph_optimization_level not in OPTIMIZATION_LEVELS:
+        raise ValueError(f'Unknown graph optimization level {graph_optimization_level}')
+    key = (osp.realpath(onnx_fp), num_threads, inter_op_num_threads, execution_mode, graph_optimization_level,
+           optimized_dir)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = _create_session(onnx_fp, num_threads, inter_op_num_threads, execution_mode,
+                                             graph_optimization_level, optimized_dir)
+        return _sessions[key]
+
+
+def clear_sessions():
+    with _lock:
+        _sessions.clear()
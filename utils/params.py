@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+"""
+Training constants of train.configs, each one loaded on its first access as `params.<name>` and kept afterwards.
+The .npy files are memory-mapped, importing this module reads nothing.
+"""
+
 import os.path as osp
 import numpy as np
 from .io import _load
@@ -11,33 +16,58 @@ def make_abs_path(d):
 
 
 d = make_abs_path('../train.configs')
-keypoints = _load(osp.join(d, 'keypoints_sim.npy'))
-w_shp = _load(osp.join(d, 'w_shp_sim.npy'))
-w_exp = _load(osp.join(d, 'w_exp_sim.npy'))  # simplified version
-meta = _load(osp.join(d, 'param_whitening.pkl'))
-# param_mean and param_std are used for re-whitening
-param_mean = meta.get('param_mean')
-param_std = meta.get('param_std')
-u_shp = _load(osp.join(d, 'u_shp.npy'))
-u_exp = _load(osp.join(d, 'u_exp.npy'))
-u = u_shp + u_exp
-w = np.concatenate((w_shp, w_exp), axis=1)
-w_base = w[keypoints]
-w_norm = np.linalg.norm(w, axis=0)
-w_base_norm = np.linalg.norm(w_base, axis=0)
-
-# for inference
-dim = w_shp.shape[0] // 3
-u_base = u[keypoints].reshape(-1, 1)
-w_shp_base = w_shp[keypoints]
-w_exp_base = w_exp[keypoints]
 std_size = 120
 
-# for paf (pac)
-paf = _load(osp.join(d, 'Model_PAF.pkl'))
-u_filter = paf.get('mu_filter')
-w_filter = paf.get('w_filter')
-w_exp_filter = paf.get('w_exp_filter')
 
-# pncc code (mean shape)
-pncc_code = _load(osp.join(d, 'pncc_code.npy'))
\ No newline at end of file
+def _load_npy(fn):
+    return np.load(osp.join(d, fn), mmap_mode='r')
+
+
+def _get(name):
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+_loaders = {
+    'keypoints': lambda: _load_npy('keypoints_sim.npy'),
+    'w_shp': lambda: _load_npy('w_shp_sim.npy'),
+    'w_exp': lambda: _load_npy('w_exp_sim.npy'),  # simplified version
+    'meta': lambda: _load(osp.join(d, 'param_whitening.pkl')),
+    # param_mean and param_std are used for re-whitening
+    'param_mean': lambda: _get('meta').get('param_mean'),
+    'param_std': lambda: _get('meta').get('param_std'),
+    'u_shp': lambda: _load_npy('u_shp.npy'),
+    'u_exp': lambda: _load_npy('u_exp.npy'),
+    'u': lambda: _get('u_shp') + _get('u_exp'),
+    'w': lambda: np.concatenate((_get('w_shp'), _get('w_exp')), axis=1),
+    'w_base': lambda: _get('w')[_get('keypoints')],
+    'w_norm': lambda: np.linalg.norm(_get('w'), axis=0),
+    'w_base_norm': lambda: np.linalg.norm(_get('w_base'), axis=0),
+
+    # for inference
+    'dim': lambda: _get('w_shp').shape[0] // 3,
+    'u_base': lambda: _get('u')[_get('keypoints')].reshape(-1, 1),
+    'w_shp_base': lambda: _get('w_shp')[_get('keypoints')],
+    'w_exp_base': lambda: _get('w_exp')[_get('keypoints')],
+
+    # for paf (pac)
+    'paf': lambda: _load(osp.join(d, 'Model_PAF.pkl')),
+    'u_filter': lambda: _get('paf').get('mu_filter'),
+    'w_filter': lambda: _get('paf').get('w_filter'),
+    'w_exp_filter': lambda: _get('paf').get('w_exp_filter'),
+
+    # pncc code (mean shape)
+    'pncc_code': lambda: _load_npy('pncc_code.npy'),
+}
+
+
+def __getattr__(name):
+    # only called for the names which are not loaded yet
+    if name not in _loaders:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = _loaders[name]()
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_loaders))
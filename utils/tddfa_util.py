@@ -77,6 +77,23 @@ def similar_transform(pts3d, roi_box, size):
     return np.array(pts3d, dtype=np.float32)
 
 
+def similar_transform_batch(pts3d, roi_boxes, size):
+    """vectorized similar_transform
+    pts3d: shape=(N, 3, V), roi_boxes: shape=(N, 4)
+    """
+    roi_boxes = np.asarray(roi_boxes, dtype=np.float64).reshape(-1, 4)
+    scale_x = ((roi_boxes[:, 2] - roi_boxes[:, 0]) / size).astype(np.float32)[:, None]
+    scale_y = ((roi_boxes[:, 3] - roi_boxes[:, 1]) / size).astype(np.float32)[:, None]
+    s = (scale_x + scale_y) / 2
+
+    res = np.empty(pts3d.shape, dtype=np.float32)
+    res[:, 0] = (pts3d[:, 0] - 1) * scale_x + roi_boxes[:, 0:1].astype(np.float32)  # -1 for Python compatibility
+    res[:, 1] = (size - pts3d[:, 1]) * scale_y + roi_boxes[:, 1:2].astype(np.float32)
+    res[:, 2] = (pts3d[:, 2] - 1) * s
+    res[:, 2] -= res[:, 2].min(axis=1, keepdims=True)
+    return res
+
+
 def _parse_param(param):
     """matrix pose form
     param: shape=(trans_dim+shape_dim+exp_dim,), i.e., 62 = 12 + 40 + 10
@@ -100,3 +117,42 @@ def _parse_param(param):
     alpha_exp = param[trans_dim + shape_dim:].reshape(-1, 1)
 
     return R, offset, alpha_shp, alpha_exp
+
+
+def _parse_params(params):
+    """batch version of _parse_param
+    params: shape=(N, trans_dim+shape_dim+exp_dim)
+    """
+    params = np.asarray(params).reshape(len(params), -1)
+    n = params.shape[1]
+    if n == 62:
+        trans_dim, shape_dim, exp_dim = 12, 40, 10
+    elif n == 72:
+        trans_dim, shape_dim, exp_dim = 12, 40, 20
+    elif n == 141:
+        trans_dim, shape_dim, exp_dim = 12, 100, 29
+    else:
+        raise Exception(f'Undefined templated param parsing rule')
+
+    R_ = params[:, :trans_dim].reshape(-1, 3, trans_dim // 3)
+    R = R_[:, :, :3]
+    offset = R_[:, :, -1:]
+    alpha_shp = params[:, trans_dim:trans_dim + shape_dim]
+    alpha_exp = params[:, trans_dim + shape_dim:]
+
+    return R, offset, alpha_shp, alpha_exp
+
+
+def recon_vers_batch(params, roi_boxes, u, w_shp, w_exp, size):
+    """vertices of N faces at once
+    params: shape=(N, 62), roi_boxes: shape=(N, 4), u, w_shp, w_exp: the (sparse or dense) BFM bases
+    return: shape=(N, 3, V)
+    """
+    if len(params) == 0:
+        return np.zeros((0, 3, u.size // 3), dtype=np.float32)
+    R, offset, alpha_shp, alpha_exp = _parse_params(params)
+    # (N, 3V) flattened in Fortran order, i.e. (N, V, 3) in C order
+    vertex = u.reshape(1, -1) + alpha_shp @ w_shp.T + alpha_exp @ w_exp.T
+    vertex = vertex.reshape(len(vertex), -1, 3).transpose(0, 2, 1)
+    pts3d = R @ vertex + offset
+    return similar_transform_batch(pts3d, roi_boxes, size)
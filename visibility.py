@@ -0,0 +1,87 @@
+import numpy as np
+
+# fixed triangulation of the 68 landmarks used for occlusion and back-facing tests
+TRIANGLES = np.asarray([
+    [0, 1, 36], [1, 48, 36], [1, 2, 48], [2, 3, 48], [3, 4, 48], [4, 60, 48], [4, 5, 60], [5, 59, 60],
+    [5, 6, 59], [6, 58, 59], [6, 7, 58], [7, 57, 58], [7, 8, 57], [8, 9, 57], [9, 56, 57], [9, 10, 56],
+    [10, 55, 56], [10, 11, 55], [11, 64, 55], [11, 12, 64], [12, 64, 54], [12, 13, 54], [13, 14, 54],
+    [14, 15, 54], [15, 45, 54], [15, 16, 45], [16, 26, 45], [26, 25, 45], [25, 44, 45], [25, 24, 44],
+    [24, 43, 44], [23, 43, 24], [23, 42, 43], [22, 42, 23], [21, 22, 23], [20, 21, 23], [20, 39, 21],
+    [20, 38, 39], [19, 38, 20], [19, 37, 38], [18, 37, 19], [18, 36, 37], [17, 36, 18], [0, 36, 17],
+    [36, 41, 37], [36, 41, 40], [40, 38, 37], [38, 40, 39], [42, 47, 43], [43, 47, 44], [44, 47, 46],
+    [44, 46, 45], [21, 39, 27], [27, 39, 28], [28, 39, 29], [29, 39, 31], [39, 40, 31], [40, 41, 31],
+    [31, 41, 36], [31, 36, 48], [21, 27, 22], [22, 27, 42], [27, 28, 42], [28, 29, 42], [29, 35, 42],
+    [35, 47, 42], [35, 46, 47], [35, 45, 46], [35, 54, 45], [29, 31, 30], [30, 31, 32], [30, 32, 33],
+    [30, 33, 34], [30, 34, 35], [29, 30, 35], [31, 48, 49], [31, 49, 50], [31, 50, 32], [32, 50, 33],
+    [33, 50, 51], [33, 51, 52], [33, 52, 34], [34, 52, 35], [35, 52, 53], [35, 53, 54], [48, 60, 49],
+    [49, 61, 50], [50, 61, 51], [51, 61, 62], [51, 62, 63], [51, 63, 52], [52, 63, 53], [53, 64, 54],
+    [49, 60, 59], [49, 59, 61], [49, 67, 61], [61, 67, 62], [62, 67, 66], [62, 66, 65], [62, 65, 63],
+    [55, 63, 65], [53, 65, 55], [53, 55, 64], [58, 67, 59], [58, 66, 67], [57, 66, 58], [56, 66, 57],
+    [56, 65, 66], [55, 65, 56]])
+
+
+def _incidence(triangles, nb_points=68):
+    # incidence[i, t] is True when landmark i is a vertex of triangle t
+    incidence = np.zeros((nb_points, len(triangles)), dtype=bool)
+    incidence[triangles, np.arange(len(triangles))[:, np.newaxis]] = True
+    return incidence
+
+
+INCIDENCE = _incidence(TRIANGLES)
+
+
+def visibility_batch(clouds, triangles=TRIANGLES, incidence=None, tol=1e-3):
+    """
+    Visibility of every landmark of every cloud in a single broadcasted pass. A landmark is visible when no
+    triangle it does not belong to lies in front of it along z, and at least one of its own triangles is not
+    back-facing.
+    :param clouds: array of shape (N, 68, 3)
+    :param triangles: array of shape (T, 3) of landmark indexes
+    :param incidence: optional (68, T) boolean landmark/triangle incidence, computed from triangles if None
+    :param tol: tolerance of the area test deciding if a projected point lies within a triangle
+    :return: boolean array of shape (N, 68)
+    """
+    clouds = np.asarray(clouds, dtype=np.float64)
+    assert clouds.ndim == 3 and clouds.shape[-1] == 3
+    if incidence is None:
+        incidence = INCIDENCE if triangles is TRIANGLES else _incidence(triangles, clouds.shape[1])
+    # vertices and normals of every triangle, shape (N, 1, T, 3)
+    a, b, c = [clouds[:, triangles[:, k]][:, np.newaxis] for k in range(3)]
+    norm = np.cross(b - a, c - a)
+    area = np.linalg.norm(norm, axis=-1)
+    norm_z = norm[..., 2]
+    points = clouds[:, :, np.newaxis]
+    # orthogonal projection of every point on every triangle plane along z, shape (N, 68, T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        depth = -np.sum(norm * (points - a), axis=-1) / norm_z
+    in_front = (depth >= 0) & (norm_z != 0)
+    pt_on_tri = np.broadcast_to(points, depth.shape + (3,)).copy()
+    pt_on_tri[..., 2] += np.where(in_front, depth, 0)
+    # the projected point lies within the triangle if the sub-triangles areas sum to the triangle area
+    area_0 = np.linalg.norm(np.cross(b - pt_on_tri, c - pt_on_tri), axis=-1)
+    area_1 = np.linalg.norm(np.cross(c - pt_on_tri, a - pt_on_tri), axis=-1)
+    area_2 = np.linalg.norm(np.cross(a - pt_on_tri, b - pt_on_tri), axis=-1)
+    inside = np.abs(area - (area_0 + area_1 + area_2)) < tol
+    occluded = np.any(in_front & inside & ~incidence, axis=-1)
+    # at least one non-back-facing triangle among the ones holding the point
+    facing = np.any((norm_z < 0) & incidence, axis=-1)
+    return ~occluded & facing
+
+
+def visibility(cloud, triangles=TRIANGLES, incidence=None, tol=1e-3):
+    assert cloud.ndim == 2
+    return visibility_batch(cloud[np.newaxis], triangles, incidence, tol)[0]
+
+
+def attention_batch(clouds, visible_weight=1., occluded_weight=.1, triangles=TRIANGLES):
+    """
+    :param clouds: array of shape (N, 68, 3)
+    :return: attention weights of shape (N, 68, 1)
+    """
+    visible = visibility_batch(clouds, triangles)
+    return np.where(visible, visible_weight, occluded_weight)[..., np.newaxis]
+
+
+def attention(cloud, visible_weight=1., occluded_weight=.1, triangles=TRIANGLES):
+    assert cloud.ndim == 2
+    return attention_batch(cloud[np.newaxis], visible_weight, occluded_weight, triangles)[0]